@@ -0,0 +1,152 @@
+import array
+import math
+import oceanproteinportal.fasta
+"""
+Sample-level normalised protein abundances for the OceanProteinPortal.
+
+For protein i in sample s with spectral count SpC and sequence length L:
+
+  relativeAbundance = SpC(i,s) / sum_j SpC(j,s)
+  NSAF              = (SpC(i,s) / L(i)) / sum_j (SpC(j,s) / L(j))
+
+A first pass over the protein rows sums each sample's totals. The samples are
+then processed a block at a time: one more pass fills a dense proteins x
+block matrix of counts in a typed array, the block's columns are normalised
+and the values handed back per protein. Memory is bounded by the proteins
+times the block size, not by the width of the dataset.
+"""
+
+# Samples normalised per pass over the protein rows
+SAMPLE_BLOCK_SIZE = 32
+MISSING = float('nan')
+
+def proteinLengths(records):
+    """Map the proteinIds of (id, sequence) FASTA records to their cleaned sequence lengths"""
+    lengths = {}
+    for record_id, sequence in records:
+        lengths[record_id] = len(oceanproteinportal.fasta.cleanSequence(sequence))
+    return lengths
+
+
+class SampleAbundance:
+    """Per-sample totals of a dataset's spectral counts and the blocks of samples to normalise"""
+
+    def __init__(self, lengths=None):
+        self.__lengths = lengths if lengths is not None else {}
+        self.__proteins = {}
+        self.__proteinIds = []
+        self.__samples = {}
+        self.__sampleIds = []
+        # Per sample: sum of counts, and sum of counts / length over the proteins with a length
+        self.__totals = array.array('d')
+        self.__weighted = array.array('d')
+
+    def __len__(self):
+        return len(self.__sampleIds)
+
+    def proteinIndex(self, proteinId):
+        """The row of a protein in the block matrices, None if it was not counted"""
+        return self.__proteins.get(proteinId, None)
+
+    def proteinIds(self):
+        """The proteinIds in row order"""
+        return self.__proteinIds
+
+    def add(self, proteinId, sampleId, count):
+        """Add a spectral count to its sample's totals (first pass)"""
+        if proteinId is None or sampleId is None or count is None:
+            return
+        if proteinId not in self.__proteins:
+            self.__proteins[proteinId] = len(self.__proteinIds)
+            self.__proteinIds.append(proteinId)
+        sample = self.__samples.get(sampleId, None)
+        if sample is None:
+            sample = len(self.__sampleIds)
+            self.__samples[sampleId] = sample
+            self.__sampleIds.append(sampleId)
+            self.__totals.append(0.0)
+            self.__weighted.append(0.0)
+        count = float(count)
+        self.__totals[sample] += count
+        length = self.__lengths.get(proteinId, None)
+        if length:
+            self.__weighted[sample] += count / length
+
+    def blocks(self, block_size=SAMPLE_BLOCK_SIZE):
+        """Split the samples into blocks"""
+        for offset in range(0, len(self.__sampleIds), block_size):
+            yield SampleBlock(self, self.__sampleIds[offset:offset + block_size])
+
+    def totals(self, sampleId):
+        """(sum of counts, sum of counts / length) of a sample"""
+        sample = self.__samples[sampleId]
+        return self.__totals[sample], self.__weighted[sample]
+
+    def length(self, proteinId):
+        return self.__lengths.get(proteinId, None)
+
+
+class SampleBlock:
+    """A dense proteins x samples matrix of spectral counts for a block of samples"""
+
+    def __init__(self, abundance, sampleIds):
+        self.__abundance = abundance
+        self.__sampleIds = sampleIds
+        self.__columns = dict((sampleId, column) for column, sampleId in enumerate(sampleIds))
+        self.__width = len(sampleIds)
+        self.__counts = array.array('d', [MISSING]) * (len(abundance.proteinIds()) * self.__width)
+
+    def sampleIds(self):
+        return list(self.__sampleIds)
+
+    def add(self, proteinId, sampleId, count):
+        """Add a spectral count, ignoring samples outside the block (block passes)"""
+        column = self.__columns.get(sampleId, None)
+        row = self.__abundance.proteinIndex(proteinId)
+        if column is None or row is None or count is None:
+            return
+        cell = row * self.__width + column
+        if math.isnan(self.__counts[cell]):
+            self.__counts[cell] = float(count)
+        else:
+            self.__counts[cell] += float(count)
+
+    def normalise(self):
+        """Normalise the block column by column, returning the relative abundance and NSAF matrices"""
+        width = self.__width
+        relative = array.array('d', [MISSING]) * len(self.__counts)
+        nsaf = array.array('d', [MISSING]) * len(self.__counts)
+        # 1 / length per protein row; NaN without a length
+        inverse_lengths = array.array('d', [
+          (1.0 / length) if length else MISSING
+          for length in (self.__abundance.length(proteinId) for proteinId in self.__abundance.proteinIds())
+        ])
+        for column, sampleId in enumerate(self.__sampleIds):
+            total, weighted = self.__abundance.totals(sampleId)
+            counts = self.__counts[column::width]
+            if total:
+                relative[column::width] = array.array('d', [count / total for count in counts])
+            if weighted:
+                nsaf[column::width] = array.array('d', [count * inverse / weighted for count, inverse in zip(counts, inverse_lengths)])
+        return relative, nsaf
+
+    def abundances(self):
+        """Yield (proteinId, {sampleId: {'relativeAbundance', 'nsaf'}}) for the proteins counted in the block"""
+        relative, nsaf = self.normalise()
+        width = self.__width
+        for row, proteinId in enumerate(self.__abundance.proteinIds()):
+            values = {}
+            for column, sampleId in enumerate(self.__sampleIds):
+                cell = row * width + column
+                if math.isnan(self.__counts[cell]):
+                    continue
+                values[sampleId] = {
+                  'relativeAbundance': _value(relative[cell]),
+                  'nsaf': _value(nsaf[cell])
+                }
+            if values:
+                yield proteinId, values
+
+
+def _value(number):
+    return None if math.isnan(number) else number
@@ -0,0 +1,144 @@
+import argparse
+import sys
+"""
+Command line entry point for the OceanProteinPortal.
+
+Only argparse is imported up front; each subcommand imports the modules
+(and heavy dependencies such as datapackage, tableschema or elasticsearch)
+it needs when it runs, so `--help` and light commands start quickly.
+"""
+
+def buildPackage(args):
+    """Build a tabular datapackage from a datapackage config"""
+    import oceanproteinportal.datapackage
+    dp_path = oceanproteinportal.datapackage.buildTabularPackage(args.config)
+    if dp_path is not None:
+        print(dp_path)
+
+def ingest(args):
+    """Ingest a datapackage into a store"""
+    import oceanproteinportal.oceanproteinportal
+    oceanproteinportal.oceanproteinportal.ingest(args.config, confirm=not args.yes)
+
+def reduceFasta(args):
+    """Reduce a FASTA database to the identified proteins"""
+    import oceanproteinportal.helpers.fastaReduce as fastaReduce
+    outputFileName = fastaReduce.outputFileNameFor(args.database, args.output_name)
+    fastaReduce.reduceFasta(args.database, args.proteinIDs, outputFileName, fast=not args.seqio, memoryBudget=args.memory_budget, profile=args.profile_memory)
+
+def compileResources(args):
+    """Compile a datapackage's tabular resources for fast re-ingest"""
+    import oceanproteinportal.oceanproteinportal
+    compiled = oceanproteinportal.oceanproteinportal.compileDatapackage(args.config, confirm=not args.yes, force=args.force)
+    for path in compiled.values():
+        print(path)
+
+def export(args):
+    """Export a dataset from the store to a datapackage"""
+    import oceanproteinportal.oceanproteinportal
+    dp_path = oceanproteinportal.oceanproteinportal.exportDataset(args.config, datasetId=args.datasetId, directory=args.directory, slices=args.slices, confirm=not args.yes)
+    print(dp_path)
+
+def stats(args):
+    """Recalculate the sample statistics of an ingested dataset"""
+    import oceanproteinportal.oceanproteinportal
+    oceanproteinportal.oceanproteinportal.updateStats(args.config, confirm=not args.yes)
+
+def buildTaxonomy(args):
+    """Build the local NCBI taxonomy index used to fill in taxon names and lineages"""
+    import oceanproteinportal.oceanproteinportal
+    oceanproteinportal.oceanproteinportal.buildTaxonomy(args.nodes, args.names, args.output)
+    print(args.output)
+
+def validate(args):
+    """Validate the data files of a datapackage before ingesting it"""
+    import oceanproteinportal.oceanproteinportal
+    summary = oceanproteinportal.oceanproteinportal.validate(args.config, mode='full' if args.full else None, confirm=not args.yes)
+    return 0 if summary['valid'] else 1
+
+def verify(args):
+    """Verify an ingested dataset against its ingest manifest (exits 1 on a mismatch)"""
+    import oceanproteinportal.oceanproteinportal
+    summary = oceanproteinportal.oceanproteinportal.verify(args.config, sample_size=args.sample, confirm=not args.yes)
+    return 0 if summary['valid'] else 1
+
+def replay(args):
+    """Re-ingest the rows quarantined in a dead-letter file"""
+    import oceanproteinportal.oceanproteinportal
+    oceanproteinportal.oceanproteinportal.replay(args.config, args.dead_letter_file, confirm=not args.yes)
+
+def buildParser():
+    """Build the argument parser for the command line"""
+    parser = argparse.ArgumentParser(prog='oceanproteinportal', description='Ocean Protein Portal data submissions and ingests')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    build_package = subparsers.add_parser('build-package', help=buildPackage.__doc__)
+    build_package.add_argument('config', help='datapackage config file (see examples/sample-datapackage-config.yaml)')
+    build_package.set_defaults(func=buildPackage)
+
+    ingest_ = subparsers.add_parser('ingest', help=ingest.__doc__)
+    ingest_.add_argument('config', help='ingest config file')
+    ingest_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    ingest_.set_defaults(func=ingest)
+
+    reduce_fasta = subparsers.add_parser('reduce-fasta', help=reduceFasta.__doc__)
+    reduce_fasta.add_argument('-d', '--database', required=True, help='fasta database file used for searching PSMs')
+    reduce_fasta.add_argument('-p', '--proteinIDs', required=True, help='txt file listing the identified proteins, without a header')
+    reduce_fasta.add_argument('-o', '--output_name', default=None, help='output file name (without .fasta)')
+    reduce_fasta.add_argument('--seqio', action='store_true', help='parse the fasta database with Bio.SeqIO')
+    reduce_fasta.add_argument('--memory-budget', default=None, help='spill the kept sequences to disk beyond this much memory, e.g. 2G')
+    reduce_fasta.add_argument('--profile-memory', action='store_true', help='print the peak memory of each step')
+    reduce_fasta.set_defaults(func=reduceFasta)
+
+    compile_ = subparsers.add_parser('compile', help=compileResources.__doc__)
+    compile_.add_argument('config', help='ingest config file')
+    compile_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    compile_.add_argument('--force', action='store_true', help='recompile resources already in the cache')
+    compile_.set_defaults(func=compileResources)
+
+    export_ = subparsers.add_parser('export', help=export.__doc__)
+    export_.add_argument('config', help='ingest config file (for the store)')
+    export_.add_argument('datasetId', help='the dataset to export')
+    export_.add_argument('directory', help='directory to write the datapackage to')
+    export_.add_argument('--slices', type=int, default=4, help='parallel scroll slices (default: 4)')
+    export_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    export_.set_defaults(func=export)
+
+    stats_ = subparsers.add_parser('stats', help=stats.__doc__)
+    stats_.add_argument('config', help='ingest config file')
+    stats_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    stats_.set_defaults(func=stats)
+
+    replay_ = subparsers.add_parser('replay', help=replay.__doc__)
+    replay_.add_argument('config', help='ingest config file')
+    replay_.add_argument('dead_letter_file', help='the dead-letter file of a previous ingest')
+    replay_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    replay_.set_defaults(func=replay)
+
+    validate_ = subparsers.add_parser('validate', help=validate.__doc__)
+    validate_.add_argument('config', help='ingest config file')
+    validate_.add_argument('--full', action='store_true', help='validate every row instead of sampled blocks')
+    validate_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    validate_.set_defaults(func=validate)
+
+    verify_ = subparsers.add_parser('verify', help=verify.__doc__)
+    verify_.add_argument('config', help='ingest config file (with its ingest-manifest)')
+    verify_.add_argument('--sample', type=int, default=None, help='rows sampled per resource (default: 100)')
+    verify_.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+    verify_.set_defaults(func=verify)
+
+    build_taxonomy = subparsers.add_parser('build-taxonomy', help=buildTaxonomy.__doc__)
+    build_taxonomy.add_argument('nodes', help='nodes.dmp of the NCBI taxdump')
+    build_taxonomy.add_argument('names', help='names.dmp of the NCBI taxdump')
+    build_taxonomy.add_argument('output', help='index file to write (the ingest config\'s ncbi-taxonomy-index)')
+    build_taxonomy.set_defaults(func=buildTaxonomy)
+
+    return parser
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
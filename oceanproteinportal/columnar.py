@@ -0,0 +1,281 @@
+import array
+import datetime
+import json
+import logging
+import mmap
+import os
+import shutil
+"""
+Compile tabular datapackage resources to a typed columnar cache.
+
+A compiled resource is a directory next to the datapackage holding one
+binary file per column (fixed-width typed arrays for integer, number and
+boolean fields; offsets plus a UTF-8 blob for everything else) and a null
+mask, keyed by the resource's hash and schema. Re-ingests of the same
+package read the memory-mapped columns instead of parsing the CSV again.
+"""
+
+COLUMNAR_CACHE_DIR = '.opp-cache'
+COLUMNAR_FORMAT_VERSION = 1
+# Rows buffered per column before they are appended to its file
+WRITE_BATCH_ROWS = 65536
+# (path, size, mtime) -> content hash of the sources hashed by this process
+_content_hashes = {}
+
+# Table Schema type -> array typecode for fixed-width columns
+FIXED_WIDTH_TYPES = {
+  'integer': 'q',
+  'number': 'd',
+  'boolean': 'b',
+}
+# Types stored as text and converted back when read
+TEXT_DECODERS = {
+  'date': datetime.date.fromisoformat,
+  'datetime': datetime.datetime.fromisoformat,
+  'time': datetime.time.fromisoformat,
+  'object': json.loads,
+  'array': json.loads,
+}
+
+class ColumnWriter:
+    """Stream the values of one column to its files"""
+
+    def __init__(self, directory, index, field_type):
+        self.__typecode = FIXED_WIDTH_TYPES.get(field_type, None)
+        self.__nulls = open(os.path.join(directory, '%s.nulls' % (index)), 'wb')
+        self.__values = open(os.path.join(directory, '%s.values' % (index)), 'wb')
+        self.__offsets = None
+        self.__offset = 0
+        self.__null_batch = bytearray()
+        if self.__typecode is not None:
+            self.__batch = array.array(self.__typecode)
+        else:
+            self.__offsets = open(os.path.join(directory, '%s.offsets' % (index)), 'wb')
+            self.__batch = bytearray()
+            self.__offset_batch = array.array('q', [0])
+
+    def append(self, value):
+        self.__null_batch.append(value is None)
+        if self.__typecode is not None:
+            self.__batch.append(0 if value is None else self.__encodeFixed(value))
+        else:
+            if value is not None:
+                self.__batch += encodeText(value)
+            self.__offset_batch.append(self.__offset + len(self.__batch))
+        if len(self.__null_batch) >= WRITE_BATCH_ROWS:
+            self.flush()
+
+    def __encodeFixed(self, value):
+        if self.__typecode == 'd':
+            return float(value)
+        return int(value)
+
+    def flush(self):
+        self.__nulls.write(self.__null_batch)
+        self.__null_batch = bytearray()
+        if self.__typecode is not None:
+            self.__batch.tofile(self.__values)
+            self.__batch = array.array(self.__typecode)
+        else:
+            self.__values.write(self.__batch)
+            self.__offset += len(self.__batch)
+            self.__batch = bytearray()
+            self.__offset_batch.tofile(self.__offsets)
+            self.__offset_batch = array.array('q')
+
+    def close(self):
+        self.flush()
+        for handle in (self.__nulls, self.__values, self.__offsets):
+            if handle is not None:
+                handle.close()
+
+
+class ColumnarTable:
+    """A compiled resource, read through memory-mapped columns.
+
+    iter(keyed=True) yields rows the way tableschema's Table.iter does.
+    """
+
+    def __init__(self, directory):
+        self.__directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as meta_file:
+            self.__meta = json.load(meta_file)
+        self.__maps = []
+        self.__columns = []
+        for index, field in enumerate(self.__meta['fields']):
+            self.__columns.append(self.__openColumn(index, field['type']))
+
+    def __mapFile(self, name):
+        path = os.path.join(self.__directory, name)
+        if os.path.getsize(path) == 0:
+            return b''
+        with open(path, 'rb') as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__maps.append(mapped)
+        return mapped
+
+    def __openColumn(self, index, field_type):
+        nulls = self.__mapFile('%s.nulls' % (index))
+        values = memoryview(self.__mapFile('%s.values' % (index)))
+        typecode = FIXED_WIDTH_TYPES.get(field_type, None)
+        if typecode is not None:
+            return (nulls, values.cast(typecode) if len(values) else [], None, None)
+        offsets = memoryview(self.__mapFile('%s.offsets' % (index))).cast('q')
+        return (nulls, values, offsets, TEXT_DECODERS.get(field_type, None))
+
+    @property
+    def headers(self):
+        return [field['name'] for field in self.__meta['fields']]
+
+    def __len__(self):
+        return self.__meta['rows']
+
+    def getMeta(self):
+        """Return the compiled resource's metadata"""
+        return self.__meta
+
+    def value(self, column, row):
+        """Read a single value"""
+        nulls, values, offsets, decoder = self.__columns[column]
+        if nulls[row]:
+            return None
+        if offsets is None:
+            value = values[row]
+            if self.__meta['fields'][column]['type'] == 'boolean':
+                return bool(value)
+            return value
+        text = bytes(values[offsets[row]:offsets[row + 1]]).decode('utf-8')
+        return decoder(text) if decoder is not None else text
+
+    def iter(self, keyed=False, start=0, stop=None):
+        """Iterate rows (as lists, or dicts when keyed) from row index start to stop"""
+        headers = self.headers
+        columns = range(len(headers))
+        if stop is None or stop > len(self):
+            stop = len(self)
+        for row in range(start, stop):
+            values = [self.value(column, row) for column in columns]
+            if keyed:
+                yield dict(zip(headers, values))
+            else:
+                yield values
+
+    def close(self):
+        self.__columns = []
+        for mapped in self.__maps:
+            mapped.close()
+        self.__maps = []
+
+
+def encodeText(value):
+    """Encode a non-numeric value as UTF-8 text"""
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat().encode('utf-8')
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str).encode('utf-8')
+    return str(value).encode('utf-8')
+
+def cacheDirectory(datapackage, resource):
+    """The cache directory for a datapackage: next to datapackage.json (or the resource)"""
+    base_path = getattr(datapackage, 'base_path', None)
+    if not base_path:
+        base_path = os.path.dirname(resource.descriptor['path'])
+    return os.path.join(base_path or '.', COLUMNAR_CACHE_DIR)
+
+def contentHash(path):
+    """The md5 hash of a file, computed once per process while its size and modification time stay the same"""
+    import oceanproteinportal.datapackage
+
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    content_hash = _content_hashes.get(key, None)
+    if content_hash is None:
+        content_hash = oceanproteinportal.datapackage.fileStats(path)['hash']
+        _content_hashes[key] = content_hash
+    return content_hash
+
+def resourceCacheKey(resource):
+    """Key a resource by its content hash and schema"""
+    import hashlib
+
+    content_hash = resource.descriptor.get('hash', None)
+    if content_hash is None:
+        content_hash = contentHash(resource.descriptor['path'])
+    schema = json.dumps(resource.descriptor.get('schema', {}), sort_keys=True)
+    schema_hash = hashlib.md5(schema.encode('utf-8')).hexdigest()
+    return '%s-%s-%s' % (content_hash.split(':')[-1][:16], schema_hash[:8], COLUMNAR_FORMAT_VERSION)
+
+def compiledResourcePath(datapackage, resource):
+    """Where a resource is (or would be) compiled"""
+    name = resource.descriptor.get('name', 'resource')
+    return os.path.join(cacheDirectory(datapackage, resource), '%s.%s.oppcol' % (name, resourceCacheKey(resource)))
+
+def compileResource(datapackage, resource, force=False):
+    """Compile a tabular resource to the columnar cache, returning its directory"""
+    from tableschema import Table
+
+    target = compiledResourcePath(datapackage, resource)
+    if os.path.isdir(target) and not force:
+        logging.info('Already compiled: %s' % (target))
+        return target
+
+    building = target + '.tmp'
+    if os.path.isdir(building):
+        shutil.rmtree(building)
+    os.makedirs(building)
+
+    table = Table(resource.descriptor['path'], schema=resource.descriptor['schema'])
+    fields = {field['name']: field for field in resource.descriptor['schema']['fields']}
+    writers = None
+    meta_fields = []
+    rows = 0
+    try:
+        for values in table.iter(keyed=False):
+            if writers is None:
+                writers = []
+                for index, name in enumerate(table.headers):
+                    field_type = fields.get(name, {}).get('type', 'string')
+                    meta_fields.append({'name': name, 'type': field_type})
+                    writers.append(ColumnWriter(building, index, field_type))
+            for writer, value in zip(writers, values):
+                writer.append(value)
+            rows += 1
+    finally:
+        for writer in writers or []:
+            writer.close()
+
+    with open(os.path.join(building, 'meta.json'), 'w') as meta_file:
+        json.dump({
+          'format': COLUMNAR_FORMAT_VERSION,
+          'resource': resource.descriptor.get('name', None),
+          'path': resource.descriptor['path'],
+          'rows': rows,
+          'fields': meta_fields
+        }, meta_file)
+
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(building, target)
+    logging.info('Compiled %s rows of %s to %s' % (rows, resource.descriptor['path'], target))
+    return target
+
+def openCompiledResource(datapackage, resource):
+    """Open a resource's compiled columns, or None if it has not been compiled"""
+    directory = compiledResourcePath(datapackage, resource)
+    if not os.path.isfile(os.path.join(directory, 'meta.json')):
+        return None
+    return ColumnarTable(directory)
+
+def compileDatapackage(datapackage, resource_types=('protein', 'peptide'), force=False):
+    """Compile the datapackage's protein and peptide resources"""
+    import oceanproteinportal.datapackage
+
+    compiled = {}
+    for resource_type in resource_types:
+        resource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type=resource_type)
+        if resource is None:
+            continue
+        compiled[resource_type] = compileResource(datapackage, resource, force=force)
+    return compiled
@@ -0,0 +1,155 @@
+import collections
+import oceanproteinportal.fasta
+"""
+Match peptide sequences against protein sequences for the OceanProteinPortal.
+
+An Aho-Corasick automaton is built once over every distinct peptide, so each
+protein sequence is scanned a single time no matter how many peptides there
+are, rather than searching for every peptide in every protein.
+"""
+
+class PeptideMatcher:
+    """An Aho-Corasick automaton over a set of peptide sequences.
+
+    Positions reported by the matcher are 1-based and inclusive, the same
+    convention as the peptide start/stop index columns.
+    """
+
+    def __init__(self, peptides=None):
+        # goto[state] maps a residue to the next state
+        self.__goto = [{}]
+        self.__fail = [0]
+        # out[state] lists the ids of the peptides ending at that state
+        self.__out = [[]]
+        self.__peptides = []
+        self.__peptide_ids = {}
+        self.__built = False
+        if peptides is not None:
+            for peptide in peptides:
+                self.add(peptide)
+
+    def __len__(self):
+        return len(self.__peptides)
+
+    def __contains__(self, peptide):
+        return cleanPeptideSequence(peptide) in self.__peptide_ids
+
+    def getPeptides(self):
+        """Return the distinct peptide sequences in the automaton"""
+        return list(self.__peptides)
+
+    def add(self, peptide):
+        """Add a peptide sequence to the automaton"""
+        peptide = cleanPeptideSequence(peptide)
+        if not peptide or peptide in self.__peptide_ids:
+            return
+        if self.__built:
+            raise Exception('Cannot add peptides after the matcher has been built')
+
+        goto = self.__goto
+        state = 0
+        for residue in peptide:
+            next_state = goto[state].get(residue, None)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][residue] = next_state
+                goto.append({})
+                self.__fail.append(0)
+                self.__out.append([])
+            state = next_state
+
+        peptide_id = len(self.__peptides)
+        self.__peptides.append(peptide)
+        self.__peptide_ids[peptide] = peptide_id
+        self.__out[state].append(peptide_id)
+
+    def build(self):
+        """Compute the failure links (breadth first over the trie)"""
+        goto = self.__goto
+        fail = self.__fail
+        out = self.__out
+
+        queue = collections.deque()
+        for state in goto[0].values():
+            fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            state = queue.popleft()
+            for residue, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and residue not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(residue, 0)
+                if out[fail[next_state]]:
+                    out[next_state] = out[next_state] + out[fail[next_state]]
+        self.__built = True
+
+    def match(self, sequence):
+        """Yield (start, stop, peptide) for every peptide occurrence in a protein sequence"""
+        if not self.__built:
+            self.build()
+
+        goto = self.__goto
+        fail = self.__fail
+        out = self.__out
+        peptides = self.__peptides
+
+        state = 0
+        for position, residue in enumerate(sequence.upper(), start=1):
+            while state and residue not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(residue, 0)
+            for peptide_id in out[state]:
+                peptide = peptides[peptide_id]
+                yield (position - len(peptide) + 1, position, peptide)
+
+    def coverage(self, sequence):
+        """Describe how a protein sequence is covered by the peptides.
+
+        Returns a dict holding the 'sequenceCoverage' percentage and the
+        'peptideMatches' found, or None if no peptide matches.
+        """
+        matches = []
+        for start, stop, peptide in self.match(sequence):
+            matches.append({'sequence': peptide, 'start': start, 'stop': stop})
+        if not matches:
+            return None
+
+        return {
+          'sequenceCoverage': sequenceCoverage(len(sequence), [(match['start'], match['stop']) for match in matches]),
+          'peptideMatches': matches
+        }
+
+
+def cleanPeptideSequence(peptide):
+    """Normalize a peptide sequence for matching"""
+    if peptide is None:
+        return None
+    return peptide.strip().upper()
+
+def sequenceCoverage(length, intervals):
+    """Percentage of a sequence of some length covered by 1-based inclusive intervals"""
+    if not length:
+        return 0.0
+
+    covered = 0
+    last_stop = 0
+    for start, stop in sorted(intervals):
+        if stop <= last_stop:
+            continue
+        covered += stop - max(start, last_stop + 1) + 1
+        last_stop = stop
+    return round(100.0 * covered / length, 2)
+
+def matchProteins(matcher, records):
+    """Yield (proteinId, coverage) for every (proteinId, sequence) record matched by a peptide
+
+    Sequences are cleaned first, so whitespace and a trailing stop neither
+    shift the match positions nor count towards the coverage.
+    """
+    for proteinId, sequence in records:
+        coverage = matcher.coverage(oceanproteinportal.fasta.cleanSequence(sequence))
+        if coverage is not None:
+            yield proteinId, coverage
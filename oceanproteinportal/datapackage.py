@@ -1,26 +1,37 @@
+import csv
+import datetime
+import hashlib
+import io
 import logging
+import oceanproteinportal.ontology
+import os
 import re
 import string
 import sys
-import yaml
-from datapackage import *
 """
 Create a Frictionlessdata Data Package for the OceanProteinPortal.
+
+The datapackage library is imported by buildTabularPackage when a package is
+built, not when this module is imported.
 """
 
 DATAPACKAGE_ONTOLOGY_KEY = '_ontology'
-
-if __name__ == "__main__":
-    buildTabularPackage(sys.argv[1])
+# Fast inference: rows sniffed per block, and blocks spread across the file
+INFER_SAMPLE_ROWS = 100
+INFER_SAMPLE_BLOCKS = 10
+INFER_CHUNK_SIZE = 1024 * 1024
 
 def buildTabularPackage(config_file):
     """Build a tabular OPP DataPackage.
 
     See examples/sample-datapackage-confgi.yaml"""
+    import datapackage
+    import yaml
+    from datapackage import Package, Resource, exceptions
 
     # Read the configuration
     with open(config_file, 'r') as yamlfile:
-        pkg_descriptor = yaml.load(yamlfile)
+        pkg_descriptor = yaml.safe_load(yamlfile)
 
     # Required metadata
     submission_name = pkg_descriptor.get('name', None)
@@ -44,6 +55,8 @@ def buildTabularPackage(config_file):
 
     #remove the files from the config for the datapackage descriptor
     del pkg_descriptor['files']
+    # 'fast' infers types from the template mappings and sampled rows, 'full' uses Resource.infer()
+    inference = pkg_descriptor.pop('infer', 'fast')
 
     # Data provider tells us which ontology they used
     ontology_version = pkg_descriptor.get('ontology-version', oceanproteinportal.ontology.getLatestOntologyVersion())
@@ -63,17 +76,15 @@ def buildTabularPackage(config_file):
     # Build the pkg
     package = Package(pkg_descriptor)
     # Protein data
-    proteins = Resource({
+    proteins = inferResource(Resource, {
       'profile': 'tabular-data-resource',
       'path': protein_data['filename'],
       'name': pkg_name + '-proteins',
       'odo-dt:dataType': { '@id': oceanproteinportal.ontology.getDataFileType(type='protein', ontology_version=ontology_version) }
-    })
-    # Infer the field types
-    proteins.infer()
+    }, field_mappings=template_mappings[ontology_version]['protein'], inference=inference)
     logging.info('PROTEIN Data:')
     # Map any known field names to the ontology knowledge
-    for index, field in proteins.descriptor['schema']['fields']:
+    for index, field in enumerate(proteins.descriptor['schema']['fields']):
         if (field['name'] in template_mappings[ontology_version]['protein']):
             mapping = template_mappings[ontology_version]['protein'][field['name']]
             proteins.descriptor['schema']['fields'][index]['rdfType'] = mapping['class']
@@ -101,19 +112,17 @@ def buildTabularPackage(config_file):
     logging.info('Added protein FASTA data.')
 
     # Peptide data
-    peptides = Resource({
+    peptides = inferResource(Resource, {
       'profile': 'tabular-data-resource',
       'path': peptide_data['filename'],
       'name': pkg_name + '-peptides',
       'odo-dt:dataType': { '@id': oceanproteinportal.ontology.getDataFileType(type='peptide', ontology_version=ontology_version) }
-    })
-    # Infer the field types
-    peptides.infer()
+    }, field_mappings=template_mappings[ontology_version]['peptide'], inference=inference)
     logging.info('PEPTIDE Data:')
     # Map any known field names to the ontology knowledge
-    for index, field in peptides.descriptor['schema']['fields']:
+    for index, field in enumerate(peptides.descriptor['schema']['fields']):
         if (field['name'] in template_mappings[ontology_version]['peptide']):
-            mapping = template_mappings[ontology_version]['protein'][field['name']]
+            mapping = template_mappings[ontology_version]['peptide'][field['name']]
             peptides.descriptor['schema']['fields'][index]['rdfType'] = mapping['class']
             peptides.descriptor['schema']['fields'][index]['type'] = mapping['type']
             logging.info('- PEPTIDE field: %s' % (field))
@@ -141,6 +150,238 @@ def buildTabularPackage(config_file):
 
     return None
 
+def inferResource(resource_class, descriptor, field_mappings=None, inference='fast'):
+    """Build a tabular Resource, inferring its schema"""
+    if inference == 'full':
+        resource = resource_class(descriptor)
+        resource.infer()
+        return resource
+    return resource_class(inferTabularDescriptor(descriptor, field_mappings=field_mappings))
+
+def inferTabularDescriptor(descriptor, field_mappings=None, sample_rows=INFER_SAMPLE_ROWS, sample_blocks=INFER_SAMPLE_BLOCKS, stats=True):
+    """Infer a tabular resource descriptor without reading the data through tableschema.
+
+    Field types come from the template mappings when the column is mapped;
+    only unmapped columns are sniffed, from blocks of rows read at offsets
+    spread across the file. The bytes, hash and row (CSV record) count are
+    computed in a single streaming pass. The descriptor has the same shape as
+    the one produced by Resource.infer().
+    """
+    descriptor = dict(descriptor)
+    path = descriptor['path']
+    encoding = descriptor.get('encoding', 'utf-8')
+    if field_mappings is None:
+        field_mappings = {}
+
+    header, samples = sampleCsvRows(path, encoding=encoding, sample_rows=sample_rows, sample_blocks=sample_blocks)
+
+    fields = []
+    for column, name in enumerate(header):
+        mapping = field_mappings.get(name, None)
+        if mapping is not None and mapping.get('type', None) is not None:
+            field_type = mapping['type']
+        else:
+            field_type = inferFieldType([row[column] for row in samples if column < len(row)])
+        fields.append({'name': name, 'type': field_type, 'format': 'default'})
+
+    descriptor['encoding'] = encoding
+    descriptor['format'] = descriptor.get('format', 'csv')
+    descriptor['mediatype'] = descriptor.get('mediatype', 'text/csv')
+    descriptor['schema'] = {'fields': fields, 'missingValues': ['']}
+
+    if stats:
+        file_stats = fileStats(path)
+        descriptor['bytes'] = file_stats['bytes']
+        descriptor['hash'] = file_stats['hash']
+        # records after the header
+        descriptor['opp:rowCount'] = max(file_stats['records'] - 1, 0)
+    return descriptor
+
+def sampleCsvRows(path, encoding='utf-8', sample_rows=INFER_SAMPLE_ROWS, sample_blocks=INFER_SAMPLE_BLOCKS):
+    """Read a CSV header plus blocks of rows sampled by seeking across the file"""
+    size = os.path.getsize(path)
+    samples = []
+    with open(path, 'rb') as handle:
+        header_line = handle.readline()
+        header = next(csv.reader([header_line.decode(encoding).lstrip('\ufeff')]), [])
+        data_start = handle.tell()
+
+        seen_offsets = set()
+        for block in range(sample_blocks):
+            offset = data_start + (size - data_start) * block // sample_blocks
+            handle.seek(offset)
+            if offset != data_start:
+                # skip the partial line we landed in
+                handle.readline()
+            if handle.tell() in seen_offsets:
+                continue
+            seen_offsets.add(handle.tell())
+
+            lines = []
+            for _ in range(sample_rows):
+                line = handle.readline()
+                if not line:
+                    break
+                lines.append(line.decode(encoding, errors='replace'))
+            samples.extend(row for row in csv.reader(io.StringIO(''.join(lines))) if row)
+    return header, samples
+
+def inferFieldType(values):
+    """Infer the narrowest Table Schema type matching every sampled value"""
+    values = [value for value in values if value != '']
+    if not values:
+        return 'string'
+    for field_type, check in FIELD_TYPE_CHECKS:
+        if all(check(value) for value in values):
+            return field_type
+    return 'string'
+
+def _isInteger(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+def _isNumber(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def _isBoolean(value):
+    return value.lower() in ('true', 'false')
+
+def _isDate(value):
+    try:
+        datetime.datetime.strptime(value, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+def _isDatetime(value):
+    try:
+        datetime.datetime.strptime(value.rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+        return True
+    except ValueError:
+        return False
+
+FIELD_TYPE_CHECKS = [
+    ('integer', _isInteger),
+    ('number', _isNumber),
+    ('boolean', _isBoolean),
+    ('date', _isDate),
+    ('datetime', _isDatetime),
+]
+
+def fileStats(path, chunk_size=INFER_CHUNK_SIZE):
+    """Compute the bytes, md5 hash, line count and CSV record count of a file in one streaming pass
+
+    Records end at newlines outside quoted values, so a quoted value holding
+    line breaks counts once; blank lines count as records.
+    """
+    md5 = hashlib.md5()
+    size = 0
+    lines = 0
+    records = 0
+    quoted = False
+    last = b''
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            md5.update(chunk)
+            size += len(chunk)
+            lines += chunk.count(b'\n')
+            if b'"' not in chunk:
+                if not quoted:
+                    records += chunk.count(b'\n')
+            else:
+                # Every other segment between quotes is outside a quoted value ("" escapes toggle twice)
+                segments = chunk.split(b'"')
+                records += sum(segment.count(b'\n') for segment in segments[1 if quoted else 0::2])
+                if len(segments) % 2 == 0:
+                    quoted = not quoted
+            last = chunk[-1:]
+    if size and last != b'\n':
+        lines += 1
+        records += 1
+    return {'bytes': size, 'hash': md5.hexdigest(), 'lines': lines, 'records': records}
+
+def iterUnquoted(path, chunk_size=INFER_CHUNK_SIZE):
+    """Yield (offset, bytes) for the non-empty parts of a CSV file outside quoted values"""
+    position = 0
+    quoted = False
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            segments = chunk.split(b'"')
+            start = position
+            for index, segment in enumerate(segments):
+                if segment and (index % 2 == 0) != quoted:
+                    yield start, segment
+                start += len(segment) + 1
+            if len(segments) % 2 == 0:
+                quoted = not quoted
+            position += len(chunk)
+
+def recordOffsets(path, records, chunk_size=INFER_CHUNK_SIZE):
+    """Find the byte offsets at which CSV records start, as {record: offset}
+
+    Records are numbered from 0 (the header) and end at newlines outside
+    quoted values, as fileStats counts them. Parts of the file before the
+    next wanted record are only counted.
+    """
+    wanted = sorted(set(records), reverse=True)
+    offsets = {}
+    if wanted and wanted[-1] == 0:
+        offsets[wanted.pop()] = 0
+    record = 0
+    for start, segment in iterUnquoted(path, chunk_size):
+        if not wanted:
+            break
+        newlines = segment.count(b'\n')
+        if record + newlines < wanted[-1]:
+            record += newlines
+            continue
+        newline = segment.find(b'\n')
+        while newline != -1 and wanted:
+            record += 1
+            if record == wanted[-1]:
+                offsets[wanted.pop()] = start + newline + 1
+            newline = segment.find(b'\n', newline + 1)
+        record += segment.count(b'\n', newline + 1) if newline != -1 else 0
+    return offsets
+
+def recordStarts(path, positions, chunk_size=INFER_CHUNK_SIZE):
+    """Find the first CSV record starting at or after each byte position, as {position: (offset, record)}
+
+    Records are numbered as by recordOffsets. Positions no record starts
+    after map to (file size, None).
+    """
+    size = os.path.getsize(path)
+    wanted = sorted(set(positions), reverse=True)
+    starts = {}
+    while wanted and wanted[-1] <= 0:
+        starts[wanted.pop()] = (0, 0)
+    record = 0
+    for start, segment in iterUnquoted(path, chunk_size):
+        searched = 0
+        while wanted:
+            # A record starting at the position follows a newline just before it
+            newline = segment.find(b'\n', max(wanted[-1] - 1 - start, searched))
+            if newline == -1:
+                break
+            record += segment.count(b'\n', searched, newline) + 1
+            searched = newline + 1
+            offset = start + newline + 1
+            while wanted and wanted[-1] <= offset:
+                starts[wanted.pop()] = (offset, record if offset < size else None)
+        if not wanted:
+            break
+        record += segment.count(b'\n', searched)
+    for position in wanted:
+        starts[position] = (size, None)
+    return starts
+
 def constructPackageName(submission_name, version_number):
     """Construct a package name.
 
@@ -249,3 +490,6 @@ def processField(value, descriptor, field_type, delimiterField='opp:fieldValueDe
         return values
     else:
         return values[0]
+
+if __name__ == "__main__":
+    buildTabularPackage(sys.argv[1])
@@ -0,0 +1,239 @@
+import csv
+import json
+import logging
+import os
+import shutil
+"""
+Turn OceanProteinPortal store documents back into a tabular datapackage.
+
+Protein documents are exploded into one row per spectralCount, peptide
+documents become one row each and protein sequences are written as FASTA.
+The column names are the v1.0 data template's, so an exported package can
+be ingested again. The files are written uncompressed, since validation,
+FASTA splitting and ingest verification all seek to byte offsets in them.
+"""
+
+EXPORT_DELIMITER = ' || '
+EXPORT_FILES = {
+  'protein': 'proteins.csv',
+  'peptide': 'peptides.csv',
+  'fasta': 'proteins.fasta',
+}
+# Columns holding several values joined by EXPORT_DELIMITER
+ARRAY_COLUMNS = ('kegg_pathway', 'other_identified_proteins', 'other_protein_ids')
+
+def _get(document, *path):
+    """Follow a path of keys through nested dicts, returning None when missing"""
+    value = document
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+def _joined(value):
+    if isinstance(value, list):
+        return EXPORT_DELIMITER.join(str(item) for item in value if item is not None)
+    return value
+
+def _date(dateTime):
+    return dateTime[:10] if dateTime else None
+
+def _time(dateTime):
+    return dateTime[11:19] if dateTime and len(dateTime) > 10 else None
+
+def _pathway(kegg):
+    if not isinstance(kegg, dict) or not kegg.get('pathway', None):
+        return None
+    pathway = sorted(kegg['pathway'], key=lambda path: path.get('index', 0))
+    return EXPORT_DELIMITER.join(str(path['value']) for path in pathway)
+
+# (template column, value of a (protein document, spectralCount) pair)
+PROTEIN_COLUMNS = [
+  ('sample_id', lambda doc, count: count.get('sampleId', None)),
+  ('cruise_id', lambda doc, count: _get(count, 'cruise', 'value')),
+  ('station_id', lambda doc, count: count.get('station', None)),
+  ('latitude_dd', lambda doc, count: _get(count, 'coordinate', 'lat')),
+  ('longitude_dd', lambda doc, count: _get(count, 'coordinate', 'lon')),
+  ('depth_m', lambda doc, count: count.get('depth', None)),
+  ('date_y-m-d', lambda doc, count: _date(count.get('dateTime', None))),
+  ('time_h-m-s', lambda doc, count: _time(count.get('dateTime', None))),
+  ('minimum_filter_size_microns', lambda doc, count: _get(doc, 'filterSize', 'minimum')),
+  ('maximum_filter_size_microns', lambda doc, count: _get(doc, 'filterSize', 'maximum')),
+  ('protein_id', lambda doc, count: doc.get('proteinId', None)),
+  ('protein_name', lambda doc, count: doc.get('productName', None)),
+  ('spectral_count', lambda doc, count: count.get('count', None)),
+  ('molecular_weight_kDa', lambda doc, count: doc.get('molecularWeight', None)),
+  ('ncbi_id', lambda doc, count: _get(doc, 'ncbiTaxon', 'id')),
+  ('ncbi_name', lambda doc, count: _get(doc, 'ncbiTaxon', 'name')),
+  ('kegg_id', lambda doc, count: _get(doc, 'kegg', 'id')),
+  ('kegg_description', lambda doc, count: _get(doc, 'kegg', 'description')),
+  ('kegg_pathway', lambda doc, count: _pathway(doc.get('kegg', None))),
+  ('pfams_id', lambda doc, count: _get(doc, 'pfams', 'id')),
+  ('pfams_name', lambda doc, count: _get(doc, 'pfams', 'name')),
+  ('uniprot_id', lambda doc, count: doc.get('uniprotId', None)),
+  ('enzyme_comm_id', lambda doc, count: doc.get('enzymeCommId', None)),
+  ('other_identified_proteins', lambda doc, count: _joined(doc.get('otherIdentifiedProteins', None))),
+]
+
+# (template column, value of a peptide document)
+PEPTIDE_COLUMNS = [
+  ('sample_id', lambda doc: doc.get('sampleId', doc.get('sampleName', None))),
+  ('cruise_id', lambda doc: doc.get('cruise', None)),
+  ('station_id', lambda doc: doc.get('station', None)),
+  ('latitude_dd', lambda doc: _get(doc, 'coordinate', 'lat')),
+  ('longitude_dd', lambda doc: _get(doc, 'coordinate', 'lon')),
+  ('depth_m', lambda doc: doc.get('depth', None)),
+  ('date_y-m-d', lambda doc: _date(doc.get('dateTime', None))),
+  ('time_h-m-s', lambda doc: _time(doc.get('dateTime', None))),
+  ('minimum_filter_size_microns', lambda doc: _get(doc, 'filterSize', 'minimum')),
+  ('maximum_filter_size_microns', lambda doc: _get(doc, 'filterSize', 'maximum')),
+  ('peptide_sequence', lambda doc: doc.get('peptideSequence', None)),
+  ('peptide_start_index', lambda doc: doc.get('peptideStartIndex', None)),
+  ('peptide_stop_index', lambda doc: doc.get('peptideStopIndex', None)),
+  ('protein_molecular_weight_kDa', lambda doc: doc.get('proteinMolecularWeight', None)),
+  ('protein_id', lambda doc: doc.get('proteinId', None)),
+  ('spectral_count_sum', lambda doc: doc.get('spectralCountSum', None)),
+  ('other_protein_ids', lambda doc: _joined(doc.get('identifiedProteins', None))),
+  ('best_protein_id_probability', lambda doc: doc.get('bestPeptideIdProb', None)),
+  ('best_sequest_DCn_score', lambda doc: doc.get('bestSequestDCnScore', None)),
+  ('best_sequest_Xcorr_score', lambda doc: doc.get('bestSequestXCorrScore', None)),
+  ('plus2H_spectra_count', lambda doc: doc.get('plus2HspectraCount', None)),
+  ('plus3H_spectra_count', lambda doc: doc.get('plus3HspectraCount', None)),
+  ('plus4H_spectra_count', lambda doc: doc.get('plus4HspectraCount', None)),
+  ('median_retention_time', lambda doc: doc.get('medianRetentionTime', None)),
+  ('total_precursor_intensity', lambda doc: doc.get('totalPrecursorIntensity', None)),
+  ('TIC', lambda doc: doc.get('totalTIC', None)),
+  ('absolute_units_fmol-L', lambda doc: doc.get('absoluteUnits_fmol-L', None)),
+]
+
+def proteinRows(protein):
+    """Explode a protein document into one template row per spectral count"""
+    counts = protein.get('spectralCount', None) or [{}]
+    for count in counts:
+        yield [getter(protein, count) for column, getter in PROTEIN_COLUMNS]
+
+def peptideRow(peptide):
+    """A peptide document as a template row"""
+    return [getter(peptide) for column, getter in PEPTIDE_COLUMNS]
+
+
+class ExportPartWriter:
+    """The part files written by one export worker"""
+
+    def __init__(self, directory, part):
+        self.__proteins = open(os.path.join(directory, 'protein.%s' % (part)), 'w', encoding='utf-8', newline='')
+        self.__peptides = open(os.path.join(directory, 'peptide.%s' % (part)), 'w', encoding='utf-8', newline='')
+        self.__fasta = open(os.path.join(directory, 'fasta.%s' % (part)), 'w', encoding='utf-8')
+        self.__protein_csv = csv.writer(self.__proteins)
+        self.__peptide_csv = csv.writer(self.__peptides)
+        self.counts = {'protein': 0, 'proteinRows': 0, 'peptide': 0}
+
+    def writeProtein(self, protein, sequence=None):
+        for row in proteinRows(protein):
+            self.__protein_csv.writerow(row)
+            self.counts['proteinRows'] += 1
+        self.counts['protein'] += 1
+        # Older indexes kept the residues on the protein
+        if sequence is None:
+            sequence = protein.get('fullSequence', None)
+        if sequence:
+            self.__fasta.write('>%s\n%s\n' % (protein['proteinId'], sequence))
+
+    def writePeptide(self, peptide):
+        self.__peptide_csv.writerow(peptideRow(peptide))
+        self.counts['peptide'] += 1
+
+    def close(self):
+        self.__proteins.close()
+        self.__peptides.close()
+        self.__fasta.close()
+
+
+def mergeParts(directory, parts_directory, parts):
+    """Concatenate the workers' parts (after a CSV header line) into the export files"""
+    headers = {
+      'protein': [column for column, getter in PROTEIN_COLUMNS],
+      'peptide': [column for column, getter in PEPTIDE_COLUMNS],
+    }
+    for kind, filename in EXPORT_FILES.items():
+        with open(os.path.join(directory, filename), 'wb') as merged:
+            if kind in headers:
+                merged.write((','.join(headers[kind]) + '\r\n').encode('utf-8'))
+            for part in range(parts):
+                with open(os.path.join(parts_directory, '%s.%s' % (kind, part)), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, merged)
+    shutil.rmtree(parts_directory)
+
+def exportDescriptor(dataset, datasetId, ontology_version=None):
+    """Build the datapackage.json descriptor of an exported dataset"""
+    import oceanproteinportal.ontology
+
+    if ontology_version is None:
+        ontology_version = oceanproteinportal.ontology.getLatestOntologyVersion()
+    template_mappings = oceanproteinportal.ontology.getTemplateMappings()[ontology_version]
+
+    def schema(kind, columns):
+        fields = []
+        for column, getter in columns:
+            mapping = template_mappings[kind].get(column, {})
+            field = {'name': column, 'type': mapping.get('type', 'string'), 'rdfType': mapping.get('class', None)}
+            if column in ARRAY_COLUMNS:
+                field['opp:fieldValueDelimiter'] = EXPORT_DELIMITER
+            fields.append(field)
+        return {'fields': fields}
+
+    name = dataset.get('guid', datasetId)
+    descriptor = {
+      'name': name,
+      'title': dataset.get('name', None),
+      'opp:shortName': dataset.get('opp:shortName', None),
+      'description': dataset.get('description', None),
+      'homepage': dataset.get('homepage', None),
+      'version': dataset.get('version', None),
+      'keywords': dataset.get('keywords', []),
+      'contributors': [
+        {'title': contributor.get('name', None), 'role': contributor.get('role', None), 'uri': contributor.get('uri', None), 'orcid': contributor.get('orcid', None)}
+        for contributor in dataset.get('contributors', [])
+      ],
+      'odo:hasDeployment': [
+        {'name': cruise.get('label', None), 'uri': cruise.get('uri', None)}
+        for cruise in dataset.get('cruises', [])
+      ],
+      'ontology-version': ontology_version,
+      'profile': 'data-package',
+      'opp:datasetId': datasetId,
+      'resources': [
+        {
+          'profile': 'tabular-data-resource',
+          'name': name + '-proteins',
+          'path': EXPORT_FILES['protein'],
+          'odo-dt:dataType': {'@id': oceanproteinportal.ontology.getDataFileType(type='protein', ontology_version=ontology_version)},
+          'schema': schema('protein', PROTEIN_COLUMNS)
+        },
+        {
+          'profile': 'data-resource',
+          'name': name + '-fasta',
+          'path': EXPORT_FILES['fasta'],
+          'format': 'fasta',
+          'mediatype': 'text/fasta',
+          'odo-dt:dataType': {'@id': oceanproteinportal.ontology.getDataFileType(type='fasta', ontology_version=ontology_version)}
+        },
+        {
+          'profile': 'tabular-data-resource',
+          'name': name + '-peptides',
+          'path': EXPORT_FILES['peptide'],
+          'odo-dt:dataType': {'@id': oceanproteinportal.ontology.getDataFileType(type='peptide', ontology_version=ontology_version)},
+          'schema': schema('peptide', PEPTIDE_COLUMNS)
+        }
+      ]
+    }
+    return descriptor
+
+def writeDescriptor(directory, descriptor):
+    """Save the exported datapackage.json"""
+    dp_path = os.path.join(directory, 'datapackage.json')
+    with open(dp_path, 'w') as dp_file:
+        json.dump(descriptor, dp_file, indent=2)
+    logging.info('Saved the data package: %s' % (dp_path))
+    return dp_path
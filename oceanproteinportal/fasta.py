@@ -0,0 +1,111 @@
+import hashlib
+import mmap
+import os
+"""
+Read protein FASTA files for the OceanProteinPortal.
+
+The fast path memory-maps the file and scans it for '>' headers with bytes
+operations, yielding plain (id, sequence) strings instead of building a
+Bio.SeqIO SeqRecord per entry. Bio.SeqIO remains available as a fallback.
+Sequences are content-addressed by the hash of their cleaned residues.
+"""
+
+SEQUENCE_WHITESPACE = b' \t\r\n'
+SEQUENCE_STRIP = ' \t\r\n*'
+
+def iterFasta(path, fast=True, descriptions=False):
+    """Iterate the (id, sequence) records of a FASTA file.
+
+    With descriptions=True records are (id, description, sequence), where
+    the description is the full header line as Bio.SeqIO reports it.
+    """
+    if fast:
+        return readFasta(path, descriptions=descriptions)
+    return readFastaSeqIO(path, descriptions=descriptions)
+
+def readFasta(path, start=0, stop=None, descriptions=False):
+    """Read FASTA records from a memory-mapped file.
+
+    Only records whose header starts within the byte range [start, stop) are
+    read, so the ranges returned by splitFasta can be parsed independently.
+    """
+    with open(path, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end_of_file = len(data)
+            if stop is None or stop > end_of_file:
+                stop = end_of_file
+
+            if start == 0 and data[:1] == b'>':
+                position = 0
+            else:
+                position = data.find(b'\n>', max(start - 1, 0), stop)
+                if position != -1:
+                    position += 1
+
+            while position != -1 and position < stop:
+                end_of_header = data.find(b'\n', position)
+                if end_of_header == -1:
+                    end_of_header = end_of_file
+                header = data[position + 1:end_of_header].strip()
+
+                next_header = data.find(b'\n>', end_of_header)
+                end_of_record = end_of_file if next_header == -1 else next_header
+                sequence = data[end_of_header + 1:end_of_record].translate(None, SEQUENCE_WHITESPACE)
+
+                fields = header.split(None, 1)
+                record_id = fields[0].decode('utf-8') if fields else ''
+                if descriptions:
+                    yield record_id, header.decode('utf-8'), sequence.decode('ascii')
+                else:
+                    yield record_id, sequence.decode('ascii')
+
+                position = -1 if next_header == -1 else next_header + 1
+
+def readFastaSeqIO(path, descriptions=False):
+    """Read FASTA records with Bio.SeqIO (compatibility fallback)"""
+    from Bio import SeqIO
+
+    for record in SeqIO.parse(path, "fasta"):
+        if descriptions:
+            yield record.id, record.description, str(record.seq)
+        else:
+            yield record.id, str(record.seq)
+
+def splitFasta(path, parts):
+    """Split a FASTA file into at most `parts` header-aligned (start, stop) byte ranges.
+
+    Each range can be handed to readFasta in a separate process.
+    """
+    size = os.path.getsize(path)
+    if size == 0 or parts < 2:
+        return [(0, size)]
+
+    offsets = [0]
+    with open(path, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for part in range(1, parts):
+                boundary = data.find(b'\n>', max(size * part // parts, offsets[-1]))
+                if boundary == -1:
+                    break
+                if boundary + 1 > offsets[-1]:
+                    offsets.append(boundary + 1)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def writeFasta(handle, records, width=60):
+    """Write (header, sequence) records to an open text handle"""
+    for header, sequence in records:
+        handle.write('>%s\n' % (header))
+        for offset in range(0, len(sequence), width):
+            handle.write(sequence[offset:offset + width])
+            handle.write('\n')
+
+def cleanSequence(sequence):
+    """Normalize a protein sequence: upper case residues without whitespace or a trailing stop"""
+    return ''.join(sequence.split()).upper().strip(SEQUENCE_STRIP)
+
+def sequenceHash(sequence):
+    """The content address of a cleaned protein sequence (SHA-256, hex)"""
+    return hashlib.sha256(sequence.encode('ascii')).hexdigest()
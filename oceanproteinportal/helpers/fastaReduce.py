@@ -5,70 +5,125 @@ import re
 import os
 import os.path
 import shutil
+import shelve
+import tempfile
 from optparse import OptionParser
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.Alphabet import generic_protein
+try:
+	from oceanproteinportal.fasta import iterFasta, writeFasta
+	from oceanproteinportal.memory import MemoryBudget, MemoryProfiler, formatSize
+except ImportError:
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+	from oceanproteinportal.fasta import iterFasta, writeFasta
+	from oceanproteinportal.memory import MemoryBudget, MemoryProfiler, formatSize
 
 usage= """
 Takes the full fasta file of a database used to search for PSMs and returns only sequences with identified peptide matches
 
 usage: %prog [-d FILE] [-p FILE] [-o STR]"""
 
-parser = OptionParser(usage=usage, version="%prog 0.1")
+def reduceFasta(dbFile, protFile, outputFileName, fast=True, memoryBudget=None, profile=False):
+	"""Write the sequences of the proteins listed in protFile from dbFile to outputFileName
 
-parser.add_option("-d", "--database", dest="dbFile",
-                  help="Specify the fasta database file used for searching PSMs",
-                  metavar="FILE")
-parser.add_option("-p", "--proteinIDs", dest="protFile",
-                  help="Specify a txt file with all the proteins identified from the fasta file in a list without a header",
-                  metavar="FILE")
-parser.add_option("-o", "--output_name", dest="outputFile",
-                  help="Specify the your desire output file name",
-                  metavar="STR")
+	With a memoryBudget (e.g. '2G') the sequences kept are spilled to a
+	temporary shelve on disk once it is exceeded; profile prints the peak
+	memory of reading the database and writing the output.
+	"""
+	budget = MemoryBudget(memoryBudget) if memoryBudget is not None else None
+	profiler = MemoryProfiler() if profile else None
+	if profiler is not None:
+		profiler.start()
+	spillDir = None
+	spilled = None
+	try:
+		#Read the identified proteins first so only their sequences are kept
+		protFileRead = [element.strip("\n") for element in open(protFile, "r").readlines()]
+		wantedIds = set(protFileRead)
 
-(options, args) = parser.parse_args()
+		if profiler is not None:
+			profiler.begin('read-database')
+		cleanDict = {}
+		for record_id, description, sequence in iterFasta(dbFile, fast=fast, descriptions=True):
+			if record_id in wantedIds and record_id not in cleanDict and (spilled is None or record_id not in spilled):
+				cleanDict[record_id] = (description, sequence)
+				if budget is not None and budget.exceeded():
+					if spilled is None:
+						spillDir = tempfile.mkdtemp(prefix='fastaReduce')
+						spilled = shelve.open(os.path.join(spillDir, 'sequences'))
+					spilled.update(cleanDict)
+					cleanDict.clear()
+					budget.spilled()
+		if profiler is not None:
+			profiler.end('read-database')
+			profiler.begin('write-output')
 
-#Makes sure all mandatory options appear
-mandatories = ["dbFile", "protFile"]
-for m in mandatories:
-	if not options.__dict__[m]:
-		print("A mandatory option is missing!\n See the HELP menu - 'fastaReduce.py -h'" )
-		parser.print_help()
-		exit(-1)
-#Sets the default outputfile name	
-if options.outputFile == None:
-	outputName = options.dbFile
-	outputFileName = outputName + "_only_PSM_match_sequences.fasta"
-else: 
-	outputName = options.outputFile
-	outputFileName = outputName + ".fasta"
+		def results():
+			written = set()
+			for element in protFileRead:
+				if element in written:
+					continue
+				found = cleanDict.get(element, None)
+				if found is None and spilled is not None:
+					found = spilled.get(element, None)
+				if found is None:
+					print("WARNING: A sequence for the following does not exist in this fasta file: " + str(element))
+					continue
+				written.add(element)
+				description, str_seq = found
+				yield description, re.sub('[Xx\*]',"", str_seq)
 
-#Set variables based on collected input
-outputFile = open(outputFileName, "w")
+		with open(outputFileName, "w") as outputFile:
+			writeFasta(outputFile, results())
+		if profiler is not None:
+			profiler.end('write-output')
+			for phase, measured in profiler.report().items():
+				print("%s: %s" % (phase, profiler.describe(phase)))
+		if spilled is not None:
+			print("Spilled sequences to disk %s times (memory budget %s)" % (budget.spills, formatSize(budget.limit)))
+	finally:
+		if profiler is not None:
+			profiler.stop()
+		if spilled is not None:
+			spilled.close()
+			shutil.rmtree(spillDir, ignore_errors=True)
+	return outputFileName
 
-#recordIx = SeqIO.index(options.dbFile, "fasta")
-cleanDict = {}
-record_ids = list()
-for record in SeqIO.parse(options.dbFile, "fasta"):
-	if record.id not in record_ids:
-		record_ids.append(record.id)
-		cleanDict[record.id] = record
+def outputFileNameFor(dbFile, outputFile=None):
+	"""Sets the default outputfile name"""
+	if outputFile == None:
+		return dbFile + "_only_PSM_match_sequences.fasta"
+	return outputFile + ".fasta"
 
+def main(argv=None):
+	parser = OptionParser(usage=usage, version="%prog 0.1")
 
-resultsDict = {}
+	parser.add_option("-d", "--database", dest="dbFile",
+	                  help="Specify the fasta database file used for searching PSMs",
+	                  metavar="FILE")
+	parser.add_option("-p", "--proteinIDs", dest="protFile",
+	                  help="Specify a txt file with all the proteins identified from the fasta file in a list without a header",
+	                  metavar="FILE")
+	parser.add_option("-o", "--output_name", dest="outputFile",
+	                  help="Specify the your desire output file name",
+	                  metavar="STR")
+	parser.add_option("--seqio", dest="seqio", action="store_true", default=False,
+	                  help="Parse the fasta database with Bio.SeqIO instead of the fast reader")
+	parser.add_option("--memory-budget", dest="memoryBudget", default=None,
+	                  help="Spill the kept sequences to disk beyond this much memory, e.g. 2G",
+	                  metavar="SIZE")
+	parser.add_option("--profile-memory", dest="profile", action="store_true", default=False,
+	                  help="Print the peak memory of reading the database and writing the output")
 
-protFileRead = open(options.protFile, "r").readlines()
+	(options, args) = parser.parse_args(argv)
 
-for element in protFileRead:
-	element = element.strip("\n")
-	try:
-		seq_record = cleanDict[element]
-		str_seq = str(seq_record.seq)
-		str_seq = re.sub('[Xx\*]',"", str_seq)
-		seq_record.seq = Seq(str_seq, generic_protein)
-		resultsDict[element] = seq_record
-	except:
-		print("WARNING: A sequence for the following does not exist in this fasta file: " + str(element))
+	#Makes sure all mandatory options appear
+	mandatories = ["dbFile", "protFile"]
+	for m in mandatories:
+		if not options.__dict__[m]:
+			print("A mandatory option is missing!\n See the HELP menu - 'fastaReduce.py -h'" )
+			parser.print_help()
+			exit(-1)
+
+	reduceFasta(options.dbFile, options.protFile, outputFileNameFor(options.dbFile, options.outputFile), fast=not options.seqio, memoryBudget=options.memoryBudget, profile=options.profile)
 
-SeqIO.write(resultsDict.values(), outputFile, "fasta")
\ No newline at end of file
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+"""
+Persistent per-dataset identifier maps for the OceanProteinPortal.
+
+The loaders record every document they write (proteinId -> guid, dataset
+version, rows merged into it and a hash of what was last written) in a small
+embedded SQLite database kept next to the ingest, so later rows and later
+runs can tell whether a document exists, or is unchanged, without asking
+the store. A map remembers the UUID of the index it describes and is
+cleared when it meets a recreated index.
+"""
+
+# Commit after this many writes
+COMMIT_INTERVAL = 10000
+# SQLite limits the number of host parameters in a statement
+MEMBERSHIP_BATCH_SIZE = 500
+
+class IdentifierMap:
+    """A key -> (guid, version, rows, hash) map for the documents of one dataset.
+
+    Keys are grouped by kind ('protein', 'peptide'); guids are stored as 16
+    byte UUIDs and hashes as 8 byte digests to keep tens of millions of
+    entries compact.
+    """
+
+    def __init__(self, path, version=None, commit_interval=COMMIT_INTERVAL):
+        self.__path = path
+        self.__version = version
+        self.__commit_interval = commit_interval
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute(
+          'CREATE TABLE IF NOT EXISTS ids ('
+          ' kind TEXT NOT NULL, key TEXT NOT NULL, guid BLOB NOT NULL,'
+          ' version TEXT, rows INTEGER NOT NULL DEFAULT 0, hash BLOB,'
+          ' PRIMARY KEY (kind, key)) WITHOUT ROWID'
+        )
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getPath(self):
+        """Return the path of the map's database"""
+        return self.__path
+
+    def get(self, kind, key):
+        """Get the entry for a key as a dict, or None"""
+        with self.__lock:
+            found = self.__db.execute(
+              'SELECT guid, version, rows, hash FROM ids WHERE kind = ? AND key = ?', (kind, key)
+            ).fetchone()
+        if found is None:
+            return None
+        return {
+          'guid': str(uuid.UUID(bytes=found[0])),
+          'version': found[1],
+          'rows': found[2],
+          'hash': found[3]
+        }
+
+    def contains(self, kind, keys):
+        """Return the subset of keys that are in the map"""
+        keys = list(keys)
+        existing = set()
+        with self.__lock:
+            for offset in range(0, len(keys), MEMBERSHIP_BATCH_SIZE):
+                batch = keys[offset:offset + MEMBERSHIP_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                for (key,) in self.__db.execute(
+                  'SELECT key FROM ids WHERE kind = ? AND key IN (%s)' % (placeholders), [kind] + batch
+                ):
+                    existing.add(key)
+        return existing
+
+    def isUnchanged(self, kind, key, doc_hash):
+        """Whether the document last written for a key had this hash"""
+        with self.__lock:
+            found = self.__db.execute(
+              'SELECT hash FROM ids WHERE kind = ? AND key = ?', (kind, key)
+            ).fetchone()
+        return found is not None and found[0] == doc_hash
+
+    def put(self, kind, key, guid, rows=1, doc_hash=None):
+        """Record a written document, adding rows to the rows already merged into it"""
+        with self.__lock:
+            self.__db.execute(
+              'INSERT INTO ids (kind, key, guid, version, rows, hash) VALUES (?, ?, ?, ?, ?, ?)'
+              ' ON CONFLICT (kind, key) DO UPDATE SET'
+              ' guid = excluded.guid, version = excluded.version,'
+              ' rows = rows + excluded.rows, hash = excluded.hash',
+              (kind, key, uuid.UUID(guid).bytes, self.__version, rows, doc_hash)
+            )
+            self.__pending += 1
+            if self.__pending >= self.__commit_interval:
+                self.__db.commit()
+                self.__pending = 0
+
+    def bindIndex(self, index_uuid):
+        """Tie the map to a store index by its UUID, clearing it if it was made for another index
+
+        Returns whether the map was cleared.
+        """
+        with self.__lock:
+            found = self.__db.execute("SELECT value FROM meta WHERE name = 'index'").fetchone()
+            if found is not None and found[0] == index_uuid:
+                return False
+            cleared = found is not None
+            if cleared:
+                self.__db.execute('DELETE FROM ids')
+            self.__db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('index', ?)", (index_uuid,))
+            self.__db.commit()
+            self.__pending = 0
+        return cleared
+
+    def count(self, kind):
+        """Count the keys of a kind"""
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM ids WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def clear(self, kind=None):
+        """Remove every key (of a kind)"""
+        with self.__lock:
+            if kind is None:
+                self.__db.execute('DELETE FROM ids')
+            else:
+                self.__db.execute('DELETE FROM ids WHERE kind = ?', (kind,))
+            self.__db.commit()
+
+    def commit(self):
+        """Commit pending writes"""
+        with self.__lock:
+            self.__db.commit()
+            self.__pending = 0
+
+    def close(self):
+        """Commit and close the map"""
+        self.commit()
+        self.__db.close()
+
+
+def openIdentifierMap(directory, datasetId, version=None):
+    """Open (creating if needed) the identifier map of a dataset in a directory"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return IdentifierMap(os.path.join(directory, datasetId + '.idmap.sqlite'), version=version)
+
+def documentHash(data):
+    """An 8 byte digest of a document, stable across runs"""
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=8).digest()
@@ -0,0 +1,297 @@
+import array
+import base64
+import bisect
+import json
+import mmap
+import oceanproteinportal.fasta
+import oceanproteinportal.utils
+import struct
+"""
+Peptide motif search over a dataset's protein sequences.
+
+At ingest every FASTA sequence is split into its distinct 3, 4 and 5 residue
+k-mers and each k-mer gets a posting list: the sorted ordinals (FASTA order)
+of the proteins containing it. A motif search intersects the postings of the
+motif's longest k-mers, shortest list first, and only checks the remaining
+candidates' residues for the whole motif. The postings are stored per dataset
+as 'kmer' documents (delta and varint encoded) next to blocks of the protein
+table, and can be written to a local index that KmerIndex memory-maps.
+"""
+
+KMER_LENGTHS = (3, 4, 5)
+# Proteins (ordinal -> proteinId and sequence hash) per protein table document
+PROTEIN_TABLE_SIZE = 10000
+KMER_INDEX_MAGIC = b'OPPKMR1\0'
+KMER_INDEX_HEADER = struct.Struct('<8sQQQQQ')
+# Between the residues in the local index, so a motif never spans two proteins
+RESIDUE_SEPARATOR = b'\n'
+
+def kmerCode(kmer):
+    """Pack a k-mer of letters into an integer (5 bits a residue), None for any other residue"""
+    code = 0
+    for residue in kmer:
+        value = ord(residue) - 64
+        if value < 1 or value > 26:
+            return None
+        code = (code << 5) | value
+    return code
+
+def kmerCodes(sequence, k):
+    """The distinct k-mer codes of a cleaned sequence"""
+    codes = set()
+    mask = (1 << (5 * k)) - 1
+    code = 0
+    run = 0
+    # Roll the code along the sequence, restarting after residues that aren't letters
+    for residue in sequence.encode('ascii', 'replace'):
+        value = residue - 64
+        if value < 1 or value > 26:
+            run = 0
+            code = 0
+            continue
+        code = ((code << 5) | value) & mask
+        run += 1
+        if run >= k:
+            codes.add(code)
+    return codes
+
+def queryLength(motif, lengths=KMER_LENGTHS):
+    """The k-mer length used to search a motif: the longest indexed one that fits, None if none does"""
+    fitting = [k for k in lengths if k <= len(motif)]
+    return max(fitting) if fitting else None
+
+def queryKmers(motif, lengths=KMER_LENGTHS):
+    """The distinct k-mers whose postings are intersected to search a motif"""
+    k = queryLength(motif, lengths)
+    if k is None:
+        return []
+    return sorted(set(motif[offset:offset + k] for offset in range(len(motif) - k + 1)))
+
+def intersect(postings):
+    """Intersect posting lists, smallest first, returning the sorted ordinals in all of them"""
+    postings = sorted(postings, key=len)
+    if not postings:
+        return []
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(posting)
+    return sorted(candidates)
+
+def encodePostings(ordinals):
+    """Encode sorted ordinals as base64 varints of their gaps (an ES binary field)"""
+    encoded = bytearray()
+    previous = 0
+    for ordinal in ordinals:
+        gap = ordinal - previous
+        previous = ordinal
+        while gap >= 0x80:
+            encoded.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        encoded.append(gap)
+    return base64.b64encode(bytes(encoded)).decode('ascii')
+
+def decodePostings(encoded):
+    """Decode the ordinals of encodePostings"""
+    ordinals = array.array('I')
+    previous = 0
+    gap = 0
+    shift = 0
+    for byte in base64.b64decode(encoded):
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += gap
+        ordinals.append(previous)
+        gap = 0
+        shift = 0
+    return ordinals
+
+def kmerGuid(datasetId, kmer):
+    """Generate the GUID of a dataset's k-mer posting document"""
+    return oceanproteinportal.utils.generateGuid(datasetId + '_kmer_' + kmer)
+
+def proteinTableGuid(datasetId, block):
+    """Generate the GUID of a block of a dataset's protein table"""
+    return oceanproteinportal.utils.generateGuid(datasetId + '_kmer_proteins_' + str(block))
+
+
+class KmerBuilder:
+    """Accumulate the k-mer postings of a dataset's sequences"""
+
+    def __init__(self, lengths=KMER_LENGTHS):
+        self.__lengths = tuple(sorted(lengths))
+        self.__proteins = {}
+        self.__proteinIds = []
+        self.__hashes = []
+        self.__residues = []
+        # k-mer code -> ordinals; appended in ordinal order, so already sorted
+        self.__postings = {}
+
+    def __len__(self):
+        return len(self.__proteinIds)
+
+    def kmers(self):
+        return len(self.__postings)
+
+    def add(self, proteinId, sequence):
+        """Add a protein's sequence (a repeated proteinId keeps its first sequence)"""
+        if proteinId in self.__proteins:
+            return
+        sequence = oceanproteinportal.fasta.cleanSequence(sequence)
+        ordinal = len(self.__proteinIds)
+        self.__proteins[proteinId] = ordinal
+        self.__proteinIds.append(proteinId)
+        self.__hashes.append(oceanproteinportal.fasta.sequenceHash(sequence))
+        self.__residues.append(sequence)
+        for k in self.__lengths:
+            for code in kmerCodes(sequence, k):
+                posting = self.__postings.get(code, None)
+                if posting is None:
+                    posting = array.array('I')
+                    self.__postings[code] = posting
+                posting.append(ordinal)
+
+    def documents(self, datasetId, table_size=PROTEIN_TABLE_SIZE):
+        """Yield the dataset's 'kmer' documents: a posting list per k-mer and the protein table blocks"""
+        for code, posting in self.__postings.items():
+            kmer = decodeKmer(code)
+            yield {
+              '_dataset': datasetId,
+              'guid': kmerGuid(datasetId, kmer),
+              'kind': 'kmer',
+              'kmer': kmer,
+              'k': len(kmer),
+              'count': len(posting),
+              'postings': encodePostings(posting)
+            }
+        for offset in range(0, len(self.__proteinIds), table_size):
+            yield {
+              '_dataset': datasetId,
+              'guid': proteinTableGuid(datasetId, offset // table_size),
+              'kind': 'proteins',
+              'offset': offset,
+              'count': len(self.__proteinIds[offset:offset + table_size]),
+              'proteinIds': self.__proteinIds[offset:offset + table_size],
+              'hashes': self.__hashes[offset:offset + table_size]
+            }
+
+    def write(self, index_file):
+        """Write the local index read by KmerIndex"""
+        codes = array.array('Q', sorted(self.__postings))
+        offsets = array.array('Q', [0])
+        postings = array.array('I')
+        for code in codes:
+            postings.extend(self.__postings[code])
+            offsets.append(len(postings))
+
+        id_offsets = array.array('Q', [0])
+        ids = bytearray()
+        for proteinId in self.__proteinIds:
+            ids += proteinId.encode('utf-8')
+            id_offsets.append(len(ids))
+        residue_offsets = array.array('Q', [0])
+        residues = bytearray()
+        for sequence in self.__residues:
+            residues += sequence.encode('ascii') + RESIDUE_SEPARATOR
+            residue_offsets.append(len(residues))
+
+        lengths = json.dumps(self.__lengths).encode('utf-8')
+        with open(index_file, 'wb') as index:
+            index.write(KMER_INDEX_HEADER.pack(KMER_INDEX_MAGIC, len(self.__proteinIds), len(codes), len(postings), len(ids), len(lengths)))
+            for section in (lengths, codes.tobytes(), offsets.tobytes(), postings.tobytes(), id_offsets.tobytes(), bytes(ids), residue_offsets.tobytes(), bytes(residues)):
+                index.write(section)
+                index.write(b'\0' * (-len(section) % 8))
+        return len(codes)
+
+
+def decodeKmer(code):
+    """Unpack a k-mer code"""
+    residues = []
+    while code:
+        residues.append(chr((code & 0x1f) + 64))
+        code >>= 5
+    return ''.join(reversed(residues))
+
+
+class KmerIndex:
+    """A memory-mapped local k-mer index written by KmerBuilder.write"""
+
+    def __init__(self, index_file):
+        self.__file = open(index_file, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, proteins, kmers, postings, ids_size, lengths_size = KMER_INDEX_HEADER.unpack_from(self.__map, 0)
+        if magic != KMER_INDEX_MAGIC:
+            raise Exception('Not a k-mer index: %s' % (index_file))
+
+        view = memoryview(self.__map)
+        position = KMER_INDEX_HEADER.size
+
+        def section(size, typecode=None):
+            nonlocal position
+            data = view[position:position + size]
+            position += size + (-size % 8)
+            return data.cast(typecode) if typecode is not None else data
+
+        self.__lengths = tuple(json.loads(bytes(section(lengths_size)).decode('utf-8')))
+        self.__codes = section(kmers * 8, 'Q')
+        self.__offsets = section((kmers + 1) * 8, 'Q')
+        self.__postings = section(postings * 4, 'I')
+        self.__id_offsets = section((proteins + 1) * 8, 'Q')
+        self.__ids = section(ids_size)
+        self.__residue_offsets = section((proteins + 1) * 8, 'Q')
+        # The rest of the file, less its padding
+        self.__residues_start = position
+        self.__residues = view[position:position + self.__residue_offsets[proteins]]
+
+    def __len__(self):
+        return len(self.__id_offsets) - 1
+
+    def lengths(self):
+        return self.__lengths
+
+    def postings(self, kmer):
+        """The ordinals of the proteins containing a k-mer (a view on the index)"""
+        code = kmerCode(kmer)
+        position = bisect.bisect_left(self.__codes, code) if code is not None else len(self.__codes)
+        if position == len(self.__codes) or self.__codes[position] != code:
+            return self.__postings[0:0]
+        return self.__postings[self.__offsets[position]:self.__offsets[position + 1]]
+
+    def proteinId(self, ordinal):
+        return bytes(self.__ids[self.__id_offsets[ordinal]:self.__id_offsets[ordinal + 1]]).decode('utf-8')
+
+    def residues(self, ordinal):
+        return bytes(self.__residues[self.__residue_offsets[ordinal]:self.__residue_offsets[ordinal + 1] - len(RESIDUE_SEPARATOR)]).decode('ascii')
+
+    def search(self, motif):
+        """The proteinIds (in FASTA order) whose sequences contain a motif"""
+        motif = oceanproteinportal.fasta.cleanSequence(motif)
+        if not motif:
+            return []
+        kmers = queryKmers(motif, self.__lengths)
+        if kmers:
+            candidates = intersect([self.postings(kmer) for kmer in kmers])
+            if len(motif) in self.__lengths:
+                # The motif is a k-mer itself: nothing left to verify
+                return [self.proteinId(ordinal) for ordinal in candidates]
+            return [self.proteinId(ordinal) for ordinal in candidates if motif in self.residues(ordinal)]
+
+        # Shorter than any k-mer: scan the residues
+        found = []
+        start = self.__residues_start
+        end = start + len(self.__residues)
+        needle = motif.encode('ascii')
+        position = self.__map.find(needle, start, end)
+        while position != -1:
+            ordinal = bisect.bisect_right(self.__residue_offsets, position - start) - 1
+            found.append(self.proteinId(ordinal))
+            position = self.__map.find(needle, start + self.__residue_offsets[ordinal + 1], end)
+        return found
+
+    def close(self):
+        self.__codes = self.__offsets = self.__postings = self.__id_offsets = self.__ids = self.__residue_offsets = self.__residues = None
+        self.__map.close()
+        self.__file.close()
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+"""
+Non-blocking logging for the OceanProteinPortal ingests.
+
+setupLogging puts a single QueueHandler on the root logger and writes the
+records to the console and log file from a background QueueListener, so a
+loader never waits on a stream or disk. Messages below ERROR are rate
+limited per call site (the dead-letter file keeps every quarantined row),
+and per-document results are summed into Counters that are logged
+periodically instead of once per write.
+"""
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+# Records passed per call site and interval; the rest are counted and reported with the next one passed
+RATE_LIMIT = 20
+RATE_INTERVAL = 10.0
+# Seconds between the periodic counter logs
+COUNTER_INTERVAL = 30.0
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most `limit` records per call site (file and line) every `interval` seconds, below a level"""
+
+    def __init__(self, limit=RATE_LIMIT, interval=RATE_INTERVAL, level=logging.ERROR):
+        logging.Filter.__init__(self)
+        self.__limit = limit
+        self.__interval = interval
+        self.__level = level
+        self.__lock = threading.Lock()
+        # (pathname, lineno) -> [window start, passed, suppressed]
+        self.__sites = {}
+
+    def filter(self, record):
+        if record.levelno >= self.__level or not self.__limit:
+            return True
+        now = time.time()
+        key = (record.pathname, record.lineno)
+        with self.__lock:
+            site = self.__sites.get(key, None)
+            if site is None or now - site[0] >= self.__interval:
+                suppressed = site[2] if site is not None else 0
+                site = [now, 0, 0]
+                self.__sites[key] = site
+                if suppressed:
+                    record.msg = '%s [%s similar messages suppressed]' % (record.getMessage(), suppressed)
+                    record.args = None
+            if site[1] >= self.__limit:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class Counters:
+    """Thread-safe named counters, logged every `interval` seconds and on flush"""
+
+    def __init__(self, name, interval=COUNTER_INTERVAL, level=logging.INFO):
+        self.__name = name
+        self.__interval = interval
+        self.__level = level
+        self.__lock = threading.Lock()
+        self.__counts = {}
+        self.__logged = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def add(self, key, amount=1):
+        """Count a result (e.g. 'created', 'updated'), logging the totals when the interval has passed"""
+        with self.__lock:
+            self.__counts[key] = self.__counts.get(key, 0) + amount
+            due = time.time() - self.__logged >= self.__interval
+            if due:
+                self.__logged = time.time()
+                counts = dict(self.__counts)
+        if due:
+            logging.log(self.__level, '%s: %s', self.__name, counts)
+
+    def get(self, key):
+        return self.__counts.get(key, 0)
+
+    def counts(self):
+        with self.__lock:
+            return dict(self.__counts)
+
+    def flush(self):
+        """Log the totals"""
+        logging.log(self.__level, '%s: %s', self.__name, self.counts())
+
+
+_listener = None
+
+def setupLogging(level=logging.WARNING, log_file=None, log_format=LOG_FORMAT, rate_limit=RATE_LIMIT, rate_interval=RATE_INTERVAL):
+    """Route the root logger through a queue to console (and file) handlers on a background thread"""
+    global _listener
+    stopLogging()
+
+    formatter = logging.Formatter(log_format)
+    handlers = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(filename=log_file, mode='a'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(limit=rate_limit, interval=rate_interval))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stopLogging():
+    """Flush the queued records and stop the background listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stopLogging)
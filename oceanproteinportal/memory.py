@@ -0,0 +1,209 @@
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+"""
+Memory profiling and budgets for the OceanProteinPortal ingests.
+
+A MemoryProfiler samples the process's resident set size (and, with trace,
+the memory traced by tracemalloc) on a background thread and reports the
+peak seen while each ingest phase ran, next to its run time. Phases running
+at once share their peaks.
+
+A MemoryBudget caps what the buffers growing with a dataset may hold: the
+protein grouping spills its grouped proteins to the store, the bulk buffer
+sends smaller chunks, caches evict entries and the FASTA reducer spills its
+sequences to disk once the budget is exceeded. Usage is the memory traced
+by tracemalloc while it is tracing, the resident set size otherwise. The
+allocator rarely hands freed memory back, so the resident set size can stay
+over the limit after a spill: the budget is then exceeded again only once
+usage has grown by RESPILL_SHARE of the limit since.
+"""
+
+# Seconds between memory samples
+SAMPLE_INTERVAL = 0.5
+# Seconds between budget checks; usage is cached in between
+CHECK_INTERVAL = 0.1
+# Share of the limit usage may grow by after a spill that left it over the limit
+RESPILL_SHARE = 0.5
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parseSize(size):
+    """Bytes of a size such as 512M, 2G or 1073741824 (None stays None)"""
+    if size is None or isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise Exception('Not a memory size: %s' % (size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def formatSize(size):
+    """A size in bytes for reading, e.g. 1.5G"""
+    if size is None:
+        return '-'
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit]:
+            return '%.1f%s' % (float(size) / SIZE_UNITS[unit], unit)
+    return '%sB' % (size)
+
+def currentRSS():
+    """The current resident set size in bytes (the peak where /proc is missing)"""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peakRSS()
+
+def peakRSS():
+    """The peak resident set size of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class MemoryBudget:
+    """A limit in bytes on the memory the ingest buffers and caches may grow to"""
+
+    def __init__(self, limit, check_interval=CHECK_INTERVAL, usage=None):
+        self.limit = parseSize(limit)
+        self.__check_interval = check_interval
+        self.__usage_function = usage
+        self.__lock = threading.Lock()
+        self.__checked = 0.0
+        self.__usage = 0
+        # Usage over which the budget is exceeded, raised by spills that leave usage over the limit
+        self.__threshold = self.limit
+        self.spills = 0
+
+    def usage(self):
+        """The memory in use: traced by tracemalloc while tracing, the resident set size otherwise"""
+        if self.__usage_function is not None:
+            return self.__usage_function()
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return currentRSS()
+
+    def exceeded(self):
+        """Whether usage is over the threshold, rechecked at most every check_interval seconds"""
+        now = time.monotonic()
+        with self.__lock:
+            if now - self.__checked >= self.__check_interval:
+                self.__checked = now
+                self.__usage = self.usage()
+            return self.__usage > self.__threshold
+
+    def spilled(self):
+        """Count a spill and measure again, moving the threshold RESPILL_SHARE of the limit past usage if still over"""
+        usage = self.usage()
+        with self.__lock:
+            self.spills += 1
+            self.__checked = time.monotonic()
+            self.__usage = usage
+            self.__threshold = max(self.limit, usage + int(self.limit * RESPILL_SHARE))
+
+    def copy(self):
+        """A budget with the same limit and usage whose spills only move its own threshold"""
+        return MemoryBudget(self.limit, check_interval=self.__check_interval, usage=self.__usage_function)
+
+    def share(self, fraction, maximum=None):
+        """A fraction of the limit, e.g. to size a buffer, at most maximum"""
+        size = int(self.limit * fraction)
+        return size if maximum is None else min(size, maximum)
+
+
+class MemoryProfiler:
+    """Sample the process memory in the background and keep each phase's peak"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, trace=False):
+        self.__interval = interval
+        self.__trace = trace
+        self.__lock = threading.Lock()
+        self.__running = {}
+        self.__phases = {}
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        if self.__trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__sample, name='memory-profiler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def __measure(self):
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        return currentRSS(), traced
+
+    def __sample(self):
+        while not self.__stop.wait(self.__interval):
+            self.__record()
+
+    def __record(self):
+        rss, traced = self.__measure()
+        with self.__lock:
+            for phase in self.__running.values():
+                phase['rss_peak'] = max(phase['rss_peak'], rss)
+                if traced is not None:
+                    phase['traced_peak'] = max(phase['traced_peak'] or 0, traced)
+
+    def begin(self, name):
+        """Start measuring a phase"""
+        rss, traced = self.__measure()
+        with self.__lock:
+            self.__running[name] = {'rss_start': rss, 'rss_peak': rss, 'rss_end': None, 'traced_peak': traced}
+
+    def end(self, name):
+        """Stop measuring a phase, returning its measurements"""
+        self.__record()
+        rss, traced = self.__measure()
+        with self.__lock:
+            phase = self.__running.pop(name)
+            phase['rss_end'] = rss
+            self.__phases[name] = phase
+        return phase
+
+    def phase(self, name):
+        """A context measuring a phase"""
+        profiler = self
+
+        class PhaseContext:
+            def __enter__(self):
+                profiler.begin(name)
+                return self
+
+            def __exit__(self, *exc):
+                profiler.end(name)
+
+        return PhaseContext()
+
+    def report(self):
+        """{phase: {'rss_start', 'rss_peak', 'rss_end', 'traced_peak'}} in bytes"""
+        with self.__lock:
+            return dict((name, dict(phase)) for name, phase in self.__phases.items())
+
+    def describe(self, name):
+        """A phase's peaks for a log line, e.g. 'peak RSS 1.2G, traced 800.0M'"""
+        phase = self.__phases.get(name, None)
+        if phase is None:
+            return ''
+        description = 'peak RSS %s' % (formatSize(phase['rss_peak']))
+        if phase['traced_peak'] is not None:
+            description += ', traced %s' % (formatSize(phase['traced_peak']))
+        return description
@@ -1,8 +1,9 @@
-import datapackage
+import importlib
 import logging
+import oceanproteinportal.utils
+import os
 import re
 import sys
-import yaml
 
 '''
 import pprint
@@ -20,14 +21,300 @@ import tableschema.exceptions
 from tableschema import Table
 from Bio import SeqIO'''
 
-if __name__ == "__main__":
-    ingest(sys.argv[1:])
-
-def ingest(config_file):
+def ingest(config_file, confirm=True):
     """Ingest a datapackage"""
 
     # Read the config file telling you what to do
-    cfg = initialize(config_file)
+    cfg = initialize(config_file, confirm=confirm)
+
+    dp = openDatapackage(cfg)
+
+    # Generate datasetId
+    datasetId = generateDatasetId(dp)
+    logging.info('Dataset ID: %s' % (datasetId))
+
+    # execute
+    store = createIngestStore(cfg, dp, datasetId)
+    if cfg['ingest'].get('verify-ingest', False) or cfg['ingest'].get('ingest-manifest', None) is not None:
+        import oceanproteinportal.verify
+        store.setManifest(oceanproteinportal.verify.IngestManifest())
+
+    # Optionally sample each phase's peak memory (tracemalloc too with memory-profile: trace)
+    profiler = None
+    memory_profile = cfg['ingest'].get('memory-profile', False)
+    if memory_profile:
+        import oceanproteinportal.memory
+        profiler = oceanproteinportal.memory.MemoryProfiler(trace=memory_profile == 'trace')
+        profiler.start()
+
+    # Run the phases selected by the config flags, concurrently where they don't depend on each other
+    phases = buildIngestPhases(cfg, store, dp, datasetId, profiler=profiler)
+    selected = [name for name in INGEST_PHASES if cfg['ingest'].get(name, False)]
+    failed = True
+    try:
+        timings = phases.run(selected)
+        logPhaseReport(timings, profiler)
+        failed = False
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        # A failed ingest reports its own error, not the error rate
+        closeQuarantine(store, check=not failed)
+
+
+def logPhaseReport(timings, profiler=None):
+    """Log the run time (and peak memory) of each phase that ran"""
+    for name in INGEST_PHASES:
+        if name not in timings:
+            continue
+        memory = ', ' + profiler.describe(name) if profiler is not None else ''
+        logging.info('%s: %.1fs%s' % (name, timings[name], memory))
+
+
+# Ingest phases in their sequential order, named by the config flags that select them
+INGEST_PHASES = [
+  'validate-datapackage',
+  'initialize-store',
+  'delete-dataset',
+  'load-dataset-metadata',
+  'load-protein-data',
+  'calculate-dataset-metadata-stats',
+  'calculate-abundance-rollups',
+  'calculate-station-tiles',
+  'load-fasta',
+  'calculate-kmer-index',
+  'load-peptide-data',
+  'add-peptides-to-proteins',
+  'calculate-peptide-coverage',
+  'calculate-protein-abundance',
+  'verify-ingest',
+]
+
+def buildIngestPhases(cfg, store, dp, datasetId, profiler=None):
+    """Declare the ingest phases and their dependencies.
+
+    cfg['ingest']['phase-workers'] sizes the shared thread pool and
+    cfg['ingest']['phase-budgets'] caps the phases drawing on a budget at
+    once, e.g. {'store': 2}.
+    """
+    import oceanproteinportal.phases
+    phases = oceanproteinportal.phases.PhaseGraph(
+      max_workers=cfg['ingest'].get('phase-workers', oceanproteinportal.phases.MAX_WORKERS),
+      budgets=cfg['ingest'].get('phase-budgets', None),
+      profiler=profiler
+    )
+
+    # Check the data files before anything is written
+    phases.add('validate-datapackage', lambda: checkDatapackage(cfg, dp), budget=None)
+
+    # Recreate the store's index, sized for this datapackage
+    def initializeStore():
+        import oceanproteinportal.store.mapping
+        store.initialize(expected_documents=oceanproteinportal.store.mapping.estimateDocuments(dp))
+    phases.add('initialize-store', initializeStore, depends=['validate-datapackage'])
+
+    # Reloads start from an empty dataset
+    phases.add('delete-dataset', lambda: store.deleteDataset(datasetId=datasetId), depends=['validate-datapackage', 'initialize-store'])
+
+    phases.add('load-dataset-metadata', lambda: store.loadDatasetMetadata(datapackage=dp, datasetId=datasetId), depends=['validate-datapackage', 'delete-dataset'])
+
+    def loadProteins():
+        protein_row_start = cfg['ingest'].get('protein-load-row-start', 0)
+        protein_row_stop = cfg['ingest'].get('protein-load-row-stop', None)
+        logging.info('***** LOADING PROTEINS (row=%s, %s) *****' % (protein_row_start, protein_row_stop))
+        protein_load_mode = cfg['ingest'].get('protein-load-mode', 'index')
+        store.loadProteins(datapackage=dp, datasetId=datasetId, row_start=protein_row_start, row_stop=protein_row_stop, mode=protein_load_mode)
+    phases.add('load-protein-data', loadProteins, depends=['validate-datapackage', 'delete-dataset'])
+
+    phases.add('calculate-dataset-metadata-stats', lambda: store.updateDatasetSampleStats(datasetId=datasetId), depends=['load-dataset-metadata', 'load-protein-data'])
+
+    # Rollups and tiles stream the protein rows from the datapackage, not the store
+    phases.add('calculate-abundance-rollups', lambda: store.updateDatasetRollups(datapackage=dp, datasetId=datasetId), depends=['validate-datapackage', 'delete-dataset'])
+
+    phases.add('calculate-station-tiles', lambda: store.updateDatasetTiles(datapackage=dp, datasetId=datasetId), depends=['validate-datapackage', 'delete-dataset'])
+
+    phases.add('load-fasta', lambda: store.loadProteinsFASTA(datapackage=dp, datasetId=datasetId, fast=cfg['ingest'].get('fast-fasta', True)), depends=['validate-datapackage', 'load-protein-data'])
+
+    # Motif search postings, optionally also written to a local index file
+    def updateKmers():
+        import oceanproteinportal.kmers
+        store.updateDatasetKmers(
+          datapackage=dp,
+          datasetId=datasetId,
+          lengths=cfg['ingest'].get('kmer-lengths', oceanproteinportal.kmers.KMER_LENGTHS),
+          index_file=cfg['ingest'].get('kmer-index-file', None),
+          fast=cfg['ingest'].get('fast-fasta', True)
+        )
+    phases.add('calculate-kmer-index', updateKmers, depends=['validate-datapackage', 'delete-dataset'])
+
+    def loadPeptides():
+        peptide_row_start = cfg['ingest'].get('peptide-load-row-start', 0)
+        peptide_row_stop = cfg['ingest'].get('peptide-load-row-stop', None)
+        logging.info('***** LOADING PEPTIDES (row=%s, %s) *****' % (peptide_row_start, peptide_row_stop))
+        store.loadPeptides(datapackage=dp, datasetId=datasetId, row_start=peptide_row_start, row_stop=peptide_row_stop)
+    phases.add('load-peptide-data', loadPeptides, depends=['validate-datapackage', 'delete-dataset'])
+
+    # Both update the protein documents, so they don't run at once
+    phases.add('add-peptides-to-proteins', lambda: store.updateProteinsWithPeptide(datapackage=dp, datasetId=datasetId), depends=['load-protein-data', 'load-peptide-data', 'load-fasta'])
+
+    phases.add('calculate-peptide-coverage', lambda: store.updateProteinsWithCoverage(datapackage=dp, datasetId=datasetId), depends=['load-fasta', 'add-peptides-to-proteins'])
+
+    # Rewrites every protein once per block of samples, after the other protein updates
+    def updateAbundances():
+        import oceanproteinportal.abundance
+        block_size = cfg['ingest'].get('abundance-sample-block-size', oceanproteinportal.abundance.SAMPLE_BLOCK_SIZE)
+        store.updateProteinAbundances(datapackage=dp, datasetId=datasetId, block_size=block_size, fast=cfg['ingest'].get('fast-fasta', True))
+    phases.add('calculate-protein-abundance', updateAbundances, depends=['load-protein-data', 'load-fasta', 'add-peptides-to-proteins', 'calculate-peptide-coverage'])
+
+    # Once everything else is written, check the store against this ingest's manifest (or the saved one)
+    def verifyIngest():
+        manifest = store.getManifest()
+        if manifest is not None and len(manifest):
+            resources = saveManifest(cfg, manifest, datasetId)
+        else:
+            resources = loadManifest(cfg, datasetId)
+        checkIngest(cfg, store, dp, datasetId, resources)
+    phases.add('verify-ingest', verifyIngest, depends=[name for name in INGEST_PHASES if name != 'verify-ingest'])
+    return phases
+
+
+
+def replay(config_file, dead_letter_file, confirm=True):
+    """Re-ingest the rows quarantined in a dead-letter file, e.g. once the data is fixed"""
+    import oceanproteinportal.quarantine
+    cfg = initialize(config_file, confirm=confirm)
+    dp = openDatapackage(cfg)
+    datasetId = generateDatasetId(dp)
+
+    rows = oceanproteinportal.quarantine.readDeadLetters(dead_letter_file)
+    # Rows that still fail are quarantined to a fresh dead-letter file
+    replayed_file = dead_letter_file + '.replayed'
+    os.replace(dead_letter_file, replayed_file)
+    logging.info('Replaying %s (moved to %s)' % (dict((type, len(numbers)) for type, numbers in rows.items()), replayed_file))
+    cfg['ingest']['dead-letter-file'] = dead_letter_file
+
+    store = createIngestStore(cfg, dp, datasetId)
+    if 'protein' in rows:
+        logging.info('***** REPLAYING PROTEINS *****')
+        store.loadProteins(datapackage=dp, datasetId=datasetId, mode=cfg['ingest'].get('protein-load-mode', 'index'), rows=rows['protein'])
+    if 'peptide' in rows:
+        logging.info('***** REPLAYING PEPTIDES *****')
+        store.loadPeptides(datapackage=dp, datasetId=datasetId, rows=rows['peptide'])
+    closeQuarantine(store)
+
+
+def validate(config_file, mode=None, confirm=True):
+    """Validate the data files of the configured datapackage, returning the summary"""
+    cfg = initialize(config_file, confirm=confirm)
+    if mode is not None:
+        cfg['ingest']['validation-mode'] = mode
+    dp = openDatapackage(cfg)
+    return checkDatapackage(cfg, dp, strict=False)
+
+
+def checkDatapackage(cfg, dp, strict=True):
+    """Validate the datapackage's data files as configured, raising on errors when strict"""
+    import oceanproteinportal.validate
+    mode = cfg['ingest'].get('validation-mode', 'sample')
+    logging.info('***** VALIDATING THE DATAPACKAGE (%s) *****' % (mode))
+    summary = oceanproteinportal.validate.validateDatapackage(
+      dp,
+      mode=mode,
+      max_errors=cfg['ingest'].get('validation-max-errors', oceanproteinportal.validate.MAX_ERRORS),
+      processes=cfg['ingest'].get('validation-processes', None)
+    )
+    oceanproteinportal.validate.logSummary(summary)
+    if strict and not summary['valid']:
+        raise Exception('Invalid data package: %s errors' % (len(summary['errors'])))
+    return summary
+
+
+def verify(config_file, sample_size=None, confirm=True):
+    """Verify an ingested datapackage against the manifest saved by its ingest, returning the summary"""
+    cfg = initialize(config_file, confirm=confirm)
+    if sample_size is not None:
+        cfg['ingest']['verify-sample-size'] = sample_size
+    dp = openDatapackage(cfg)
+    datasetId = generateDatasetId(dp)
+    store = createIngestStore(cfg, dp, datasetId)
+    return checkIngest(cfg, store, dp, datasetId, loadManifest(cfg, datasetId), strict=False)
+
+
+def saveManifest(cfg, manifest, datasetId):
+    """Save an ingest's manifest where configured, returning its resources"""
+    path = cfg['ingest'].get('ingest-manifest', None)
+    if path is not None:
+        manifest.save(path, datasetId=datasetId)
+        logging.info('Saved the ingest manifest %s' % (path))
+    return manifest.resources()
+
+
+def loadManifest(cfg, datasetId):
+    """Read the configured ingest manifest's resources"""
+    import oceanproteinportal.verify
+    path = cfg['ingest'].get('ingest-manifest', None)
+    if path is None or not os.path.exists(path):
+        raise Exception('No ingest manifest to verify against: set ingest-manifest and ingest the proteins or peptides')
+    saved = oceanproteinportal.verify.readManifest(path)
+    if saved.get('datasetId', None) != datasetId:
+        raise Exception('The ingest manifest %s is for dataset %s, not %s' % (path, saved.get('datasetId', None), datasetId))
+    return saved['resources']
+
+
+def checkIngest(cfg, store, dp, datasetId, resources, strict=True):
+    """Verify the store against an ingest manifest's resources, raising on mismatches when strict"""
+    import oceanproteinportal.verify
+    logging.info('***** VERIFYING THE INGEST (%s) *****' % (datasetId))
+    summary = store.verifyDataset(
+      datapackage=dp,
+      datasetId=datasetId,
+      resources=resources,
+      sample_size=cfg['ingest'].get('verify-sample-size', oceanproteinportal.verify.SAMPLE_SIZE)
+    )
+    oceanproteinportal.verify.logSummary(summary)
+    if strict and not summary['valid']:
+        raise Exception('Ingest verification failed: %s mismatches' % (len(summary['mismatches'])))
+    return summary
+
+
+def updateStats(config_file, confirm=True):
+    """Recalculate the sample statistics of an ingested datapackage"""
+    cfg = initialize(config_file, confirm=confirm)
+    dp = openDatapackage(cfg)
+    datasetId = generateDatasetId(dp)
+    logging.info('***** UPDATING DATASET Sample STATS (%s) *****' % (datasetId))
+    createStore(cfg).updateDatasetSampleStats(datasetId=datasetId)
+
+
+def compileDatapackage(config_file, confirm=True, force=False):
+    """Compile the datapackage's tabular resources to the columnar cache"""
+    import oceanproteinportal.columnar
+    cfg = initialize(config_file, confirm=confirm)
+    dp = openDatapackage(cfg)
+    compiled = oceanproteinportal.columnar.compileDatapackage(dp, force=force)
+    for resource_type, path in compiled.items():
+        logging.info('Compiled %s: %s' % (resource_type, path))
+    return compiled
+
+
+def exportDataset(config_file, datasetId, directory, slices=4, confirm=True):
+    """Export a dataset from the configured store to a datapackage directory"""
+    cfg = initialize(config_file, confirm=confirm)
+    store = createStore(cfg)
+    return store.exportDataset(datasetId=datasetId, directory=directory, slices=slices)
+
+
+def buildTaxonomy(nodes_file, names_file, index_file):
+    """Build the local NCBI taxonomy index from a taxdump's nodes.dmp and names.dmp"""
+    import oceanproteinportal.taxonomy
+    count = oceanproteinportal.taxonomy.buildTaxonomyIndex(nodes_file, names_file, index_file)
+    logging.info('Indexed %s taxa to %s' % (count, index_file))
+    return count
+
+
+def openDatapackage(cfg):
+    """Open and validate the datapackage named by the ingest configuration"""
+    import datapackage
 
     # Inspect the datapackage
     dp = datapackage.DataPackage(cfg['ingest'].get('datapackage', None))
@@ -38,71 +325,81 @@ def ingest(config_file):
     # Validate the Datapackage
     try:
         valid = datapackage.validate(dp.descriptor)
-    except exceptions.ValidationError as exception:
-        for error in datapackage.exception.errors:
+    except datapackage.exceptions.ValidationError as exception:
+        for error in exception.errors:
             logging.error(error)
         raise Exception('Invalid data package')
+    return dp
 
-    # Generate datasetId
-    datasetId = generateDatasetId(datapackage)
-    logging.info('Dataset ID: %s' % (datasetId))
 
-    # execute
-    store_type = cfg.get('store', None)
-    if store_type is None:
-        raise Exception('The configuration does not define an ingest store')
+def createIngestStore(cfg, datapackage, datasetId):
+    """Create the store with the ingest's identifier map, taxonomy, memory budget and quarantine"""
+    store = createStore(cfg)
 
-    module = __import__('oceanproteinportal.store')
-    store_ = getattr(module, store_type)
-    store = store_()
-    
-    # To-Do: Initialize the store...
+    # Identifier map reused across runs instead of store existence lookups
+    id_map_dir = cfg['ingest'].get('id-map-dir', None)
+    if id_map_dir is not None:
+        import oceanproteinportal.idmap
+        store.setIdentifierMap(oceanproteinportal.idmap.openIdentifierMap(id_map_dir, datasetId, version=datapackage.descriptor.get('version', None)))
 
-    if cfg['ingest'].get('load-dataset-metadata', False):
-        logging.info('***** LOADING DATASET METADATA *****')
-        store.loadDatasetMetadata(datapackage=dp, datasetId=datasetId)
+    # Local NCBI taxonomy index (see buildTaxonomy) for taxon names and lineages
+    taxonomy_index = cfg['ingest'].get('ncbi-taxonomy-index', None)
+    if taxonomy_index is not None:
+        import oceanproteinportal.taxonomy
+        store.setTaxonomy(oceanproteinportal.taxonomy.TaxonomyIndex(taxonomy_index))
 
-    if cfg['ingest'].get('load-protein-data', False):
-        protein_row_start = cfg['ingest'].get('protein-load-row-start', 0)
-        protein_row_stop = cfg['ingest'].get('protein-load-row-stop', None)
-        logging.info('***** LOADING PROTEINS (row=%s, %s) *****' % (protein_row_start, protein_row_stop))
-        store.loadProteins(datapackage=dp, datasetId=datasetId, row_start=protein_row_start, row_stop=protein_row_stop)
+    # Spill and flush early instead of growing past a memory budget, e.g. 4G
+    memory_budget = cfg['ingest'].get('memory-budget', None)
+    if memory_budget is not None:
+        import oceanproteinportal.memory
+        store.setMemoryBudget(oceanproteinportal.memory.MemoryBudget(memory_budget))
 
-    if cfg['ingest'].get('calculate-dataset-metadata-stats', False):
-        logging.info('***** UPDATING DATASET Sample STATS *****')
-        store.updateDatasetSampleStats(datasetId=datasetId)
+    # Quarantine bad rows instead of aborting the load
+    dead_letter_file = cfg['ingest'].get('dead-letter-file', None)
+    if dead_letter_file is not None:
+        import oceanproteinportal.quarantine
+        store.setQuarantine(oceanproteinportal.quarantine.Quarantine(
+          dead_letter_file,
+          max_error_rate=cfg['ingest'].get('max-error-rate', oceanproteinportal.quarantine.MAX_ERROR_RATE),
+          max_errors=cfg['ingest'].get('max-errors', None)
+        ))
+    return store
 
-    if cfg['ingest'].get('load-fasta', False):
-        logging.info('***** LOAD PROTEIN FASTA *****')
-        store.loadProteinsFASTA(datapackage=dp, datasetId=datasetId )
 
-    if cfg['ingest'].get('load-peptide-data', False):
-        peptide_row_start = cfg['ingest'].get('peptide-load-row-start', 0)
-        peptide_row_stop = cfg['ingest'].get('peptide-load-row-stop', None)
-        logging.info('***** LOADING PEPTIDES (row=%s, %s) *****' % (peptide_row_start, peptide_row_stop))
-        store.loadPeptide(datapackage=dp, datasetId=datasetId, row_start=peptide_row_start, row_stop=peptide_row_stop)
+def closeQuarantine(store, check=True):
+    """Close the store's quarantine (logging its counters and, with check, raising on too many bad rows), if any"""
+    quarantine = store.getQuarantine()
+    if quarantine is not None:
+        quarantine.close(check=check)
+
 
-    if cfg['ingest'].get('add-peptides-to-proteins', False):
-        storeupdateProteinsWithPeptide(datapackage=dp, datasetId=datasetId )
+def createStore(cfg):
+    """Create the store named by the configuration, e.g. 'ElasticStore'"""
+    store_type = cfg.get('store', None)
+    if store_type is None:
+        raise Exception('The configuration does not define an ingest store')
 
+    module = importlib.import_module('oceanproteinportal.store')
+    store_ = getattr(module, store_type)
+    return store_(**cfg.get('store-params', {}))
+
+
+def initialize(config_file, confirm=True):
+    import yaml
 
-def initialize(config_file):
     # Read the configuration
     with open(config_file, 'r') as yamlfile:
-        cfg = yaml.load(yamlfile)
+        cfg = yaml.safe_load(yamlfile)
 
-    # Setup the logger w. default stream logger
-    log_handlers = [logging.StreamHandler()]
-    # File Logger
+    # Setup the logger: stream (and file) handlers written from a background thread
+    import oceanproteinportal.logs
     log_file = cfg['logging'].get('file', None)
-    if (None is not log_file):
-        log_handlers.append(logging.FileHandler(filename=log_file, mode='a'))
-
     log_level = oceanproteinportal.utils.getLogLevel(cfg['logging'].get('level', 'WARNING'))
-    logging.basicConfig(
+    oceanproteinportal.logs.setupLogging(
         level=log_level,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=log_handlers
+        log_file=log_file,
+        rate_limit=cfg['logging'].get('rate-limit', oceanproteinportal.logs.RATE_LIMIT),
+        rate_interval=cfg['logging'].get('rate-interval', oceanproteinportal.logs.RATE_INTERVAL)
     )
     logging.log(log_level, 'Log Level: %s' % (logging.getLevelName(log_level)))
     if (None is not log_file):
@@ -112,6 +409,8 @@ def initialize(config_file):
     logging.log(log_level, '%s' % (cfg))
 
     # Verify the user wants to ingest
+    if not confirm:
+        return cfg
     proceed = oceanproteinportal.utils.yes_or_no('Do you want to continue ingest with this configuration?')
     if proceed is False:
         logging.log(log_level, 'Quitting ingest.')
@@ -125,3 +424,5 @@ def generateDatasetId(datapackage):
     guname = datapackage.descriptor['name'] + '_ver.' + datapackage.descriptor.get('version', 'noversion')
     return oceanproteinportal.utils.generateGuid( guname )
 
+if __name__ == "__main__":
+    ingest(sys.argv[1])
@@ -8,7 +8,7 @@ def getLatestOntologyVersion():
 
 def getDataFileType(type, ontology_version=None):
     """Read ontology to get data file types, but for now encode here"""
-    if (ontology_version is None)
+    if (ontology_version is None):
         ontology_version = getLatestOntologyVersion()
 
     if (ontology_version == "v1.0"):
@@ -26,8 +26,10 @@ def getTemplateMappings(config_file='config/ontology_template_mappings.yaml'):
 
     !!! Move this information to the ontology !!!
     """
+    import yaml
+
     # Read the configuration
     with open(config_file, 'r') as yamlfile:
-        mappings = yaml.load(yamlfile)
+        mappings = yaml.safe_load(yamlfile)
     return mappings
 
@@ -0,0 +1,140 @@
+import concurrent.futures
+import logging
+import threading
+import time
+"""
+Dependency-aware scheduling of the OceanProteinPortal ingest phases.
+
+An ingest is a small DAG of phases (load the metadata, the proteins, the
+peptides, ...). A PhaseGraph runs every selected phase on a shared thread
+pool as soon as the selected phases it depends on have finished, so e.g. the
+peptides load while the FASTA sequences are attached. Each phase draws on a
+named budget (e.g. 'store') which caps how many phases using it run at once.
+With an oceanproteinportal.memory.MemoryProfiler each phase's peak memory is
+reported next to its run time.
+"""
+
+# Threads shared by the phases
+MAX_WORKERS = 4
+# Phases that may run at once per budget
+BUDGETS = {
+  'store': 2,
+}
+
+class Phase:
+    """A named unit of ingest work with the phases it depends on"""
+
+    def __init__(self, name, run, depends=(), budget='store'):
+        self.name = name
+        self.run = run
+        self.depends = tuple(depends)
+        self.budget = budget
+
+
+class PhaseGraph:
+    """Run phases concurrently in dependency order"""
+
+    def __init__(self, max_workers=MAX_WORKERS, budgets=None, profiler=None):
+        self.__max_workers = max_workers
+        self.__profiler = profiler
+        self.__budgets = dict(BUDGETS)
+        if budgets is not None:
+            self.__budgets.update(budgets)
+        self.__phases = {}
+
+    def __contains__(self, name):
+        return name in self.__phases
+
+    def add(self, name, run, depends=(), budget='store'):
+        """Add a phase; run is called without arguments"""
+        if name in self.__phases:
+            raise Exception('Duplicate ingest phase: %s' % (name))
+        self.__phases[name] = Phase(name, run, depends=depends, budget=budget)
+
+    def order(self, selected=None):
+        """The selected phases (default all) in a dependency order.
+
+        Dependencies that are not selected are taken as already done.
+        """
+        names = list(self.__phases.keys()) if selected is None else [name for name in self.__phases if name in selected]
+        ordered = []
+        visiting = set()
+        done = set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise Exception('Ingest phases depend on each other: %s' % (name))
+            visiting.add(name)
+            for depend in self.__phases[name].depends:
+                if depend not in self.__phases:
+                    raise Exception('Unknown ingest phase %s (needed by %s)' % (depend, name))
+                if depend in names:
+                    visit(depend)
+            visiting.discard(name)
+            done.add(name)
+            ordered.append(name)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    def run(self, selected=None):
+        """Run the selected phases (default all), returning their run times in seconds.
+
+        Once a phase fails no new phase starts; the running ones finish and
+        the first error is raised.
+        """
+        ordered = self.order(selected)
+        waiting = dict((name, set(depend for depend in self.__phases[name].depends if depend in ordered)) for name in ordered)
+        semaphores = {}
+        for name in ordered:
+            budget = self.__phases[name].budget
+            if budget is not None and budget not in semaphores:
+                semaphores[budget] = threading.BoundedSemaphore(self.__budgets.get(budget, 1))
+        timings = {}
+        profiler = self.__profiler
+
+        def runPhase(phase):
+            semaphore = semaphores.get(phase.budget, None)
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                logging.info('***** STARTING PHASE %s *****' % (phase.name))
+                started = time.time()
+                if profiler is not None:
+                    with profiler.phase(phase.name):
+                        phase.run()
+                else:
+                    phase.run()
+                timings[phase.name] = time.time() - started
+                memory = ', ' + profiler.describe(phase.name) if profiler is not None else ''
+                logging.info('***** FINISHED PHASE %s (%.1fs%s) *****' % (phase.name, timings[phase.name], memory))
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        error = None
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix='phase') as executor:
+            while waiting or running:
+                if error is None:
+                    for name in [name for name in ordered if name in waiting and not waiting[name]]:
+                        del waiting[name]
+                        running[executor.submit(runPhase, self.__phases[name])] = name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        logging.error('Ingest phase %s failed: %s' % (name, future.exception()))
+                        if error is None:
+                            error = future.exception()
+                        continue
+                    for depends in waiting.values():
+                        depends.discard(name)
+        if error is not None:
+            raise error
+        return timings
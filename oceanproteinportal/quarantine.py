@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import threading
+"""
+Dead-letter quarantine for rows the OceanProteinPortal loaders cannot load.
+
+Instead of aborting a load on its first bad row, the loaders hand failing
+rows (and bulk items the store rejects) to a Quarantine, which appends them
+with the error to a JSON Lines dead-letter file, counts them, and aborts
+only once the error rate crosses a threshold, checked on every rejection,
+when the rows read reach the minimum for a rate, and when it is closed. readDeadLetters returns the
+quarantined row numbers so they can be replayed once the data is fixed.
+"""
+
+# Abort when more than this fraction of the rows read has failed ...
+MAX_ERROR_RATE = 0.01
+# ... once at least this many rows have been read
+MIN_ROWS_FOR_RATE = 1000
+
+class Quarantine:
+    """Count rows per resource type and write the failing ones to a dead-letter file"""
+
+    def __init__(self, path, max_error_rate=MAX_ERROR_RATE, min_rows=MIN_ROWS_FOR_RATE, max_errors=None):
+        self.__path = path
+        self.__max_error_rate = max_error_rate
+        self.__min_rows = min_rows
+        self.__max_errors = max_errors
+        self.__handle = None
+        # Ingest phases may quarantine rows concurrently
+        self.__lock = threading.RLock()
+        self.counts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getPath(self):
+        """Return the path of the dead-letter file"""
+        return self.__path
+
+    def __counts(self, type):
+        if type not in self.counts:
+            self.counts[type] = {'rows': 0, 'rejected': 0}
+        return self.counts[type]
+
+    def count(self, type):
+        """Count a row read from a resource"""
+        with self.__lock:
+            counts = self.__counts(type)
+            counts['rows'] += 1
+            # Rows rejected before there were enough rows for a rate
+            reached = counts['rows'] == self.__min_rows and counts['rejected'] > 0
+        if reached:
+            self.check(type)
+
+    def errorRate(self, type):
+        """The fraction of a resource type's rows that were rejected"""
+        counts = self.__counts(type)
+        return float(counts['rejected']) / counts['rows'] if counts['rows'] else 0.0
+
+    def reject(self, type, row, data, error, stage='load'):
+        """Quarantine a failing row (or bulk item), then check the error rate"""
+        reason = error if isinstance(error, str) else '%s: %s' % (error.__class__.__name__, error)
+        with self.__lock:
+            if self.__handle is None:
+                directory = os.path.dirname(self.__path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.__handle = open(self.__path, 'a')
+            self.__handle.write(json.dumps({'type': type, 'row': row, 'stage': stage, 'error': reason, 'data': data}, separators=(',', ':'), default=str))
+            self.__handle.write('\n')
+            self.__handle.flush()
+
+            counts = self.__counts(type)
+            counts['rejected'] += 1
+        # Rate limited per call site by oceanproteinportal.logs; the dead-letter file has every row
+        logging.warning('Quarantined %s row[%s] (%s): %s', type, row, stage, reason)
+        self.check(type)
+
+    def check(self, type):
+        """Raise once a resource type's rejected rows cross the thresholds"""
+        counts = self.__counts(type)
+        if self.__max_errors is not None and counts['rejected'] > self.__max_errors:
+            raise Exception('Too many bad %s rows: %s (see %s)' % (type, counts['rejected'], self.__path))
+        if counts['rows'] >= self.__min_rows and self.errorRate(type) > self.__max_error_rate:
+            raise Exception('Error rate of %s rows %.4f exceeds %s (see %s)' % (type, self.errorRate(type), self.__max_error_rate, self.__path))
+
+    def close(self, check=True):
+        """Close the dead-letter file, log the counters and (with check) check the final error rates"""
+        for type, counts in self.counts.items():
+            logging.info('%s rows: %s read, %s quarantined' % (type, counts['rows'], counts['rejected']))
+        with self.__lock:
+            if self.__handle is not None:
+                self.__handle.close()
+                self.__handle = None
+        for type in list(self.counts) if check else []:
+            self.check(type)
+
+
+def readDeadLetters(path):
+    """Read a dead-letter file's quarantined row numbers by resource type"""
+    rows = {}
+    with open(path, 'r') as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get('row', None) is not None:
+                rows.setdefault(entry['type'], set()).add(entry['row'])
+    return rows
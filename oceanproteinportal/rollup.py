@@ -0,0 +1,90 @@
+import oceanproteinportal.utils
+"""
+Abundance rollups for the OceanProteinPortal.
+
+Summing spectral counts by taxon or KEGG pathway with nested aggregations
+over every protein's spectralCount array is slow, so an ingest phase streams
+the protein rows once and keeps per (sample, taxon) and per (sample, pathway)
+totals. Each total becomes a small 'rollup' document whose normalized count
+is its share of the sample's total spectral count. Its fields are named apart
+from the other mapping types' (keyName, totalSpectralCount), which
+Elasticsearch 5 would need mapped alike.
+"""
+
+class AbundanceRollup:
+    """Accumulate spectral counts per (sample, taxon) and (sample, pathway)"""
+
+    def __init__(self):
+        # (kind, sampleId, key) -> [spectral count, proteins]
+        self.__totals = {}
+        # (kind, key) -> name
+        self.__names = {}
+        # sampleId -> spectral count of every protein in the sample
+        self.__samples = {}
+
+    def __len__(self):
+        return len(self.__totals)
+
+    def __add(self, kind, sampleId, key, count):
+        total = self.__totals.get((kind, sampleId, key), None)
+        if total is None:
+            self.__totals[(kind, sampleId, key)] = [count, 1]
+        else:
+            total[0] += count
+            total[1] += 1
+
+    def add(self, sampleId, count, taxon=None, pathways=None):
+        """Add a protein row's spectral count to its sample's taxon and pathways.
+
+        taxon is an ncbiTaxon dict ({'id', 'name', ...}); pathways is a list
+        of KEGG pathway names. Rows without a sample or count are ignored.
+        """
+        if sampleId is None or count is None:
+            return
+        count = float(count)
+        self.__samples[sampleId] = self.__samples.get(sampleId, 0.0) + count
+        if taxon is not None and taxon.get('id', None) is not None:
+            key = str(taxon['id'])
+            self.__add('taxon', sampleId, key, count)
+            if taxon.get('name', None) is not None:
+                self.__names[('taxon', key)] = taxon['name']
+        for pathway in set(pathways or []):
+            if pathway is not None:
+                self.__add('pathway', sampleId, str(pathway), count)
+
+    def sampleTotal(self, sampleId):
+        """The summed spectral count of a sample"""
+        return self.__samples.get(sampleId, 0.0)
+
+    def documents(self, datasetId):
+        """Yield the rollup documents of a dataset"""
+        for (kind, sampleId, key), (count, proteins) in self.__totals.items():
+            sample_total = self.__samples[sampleId]
+            yield {
+              '_dataset': datasetId,
+              'guid': rollupGuid(datasetId, kind, sampleId, key),
+              'kind': kind,
+              'sampleId': sampleId,
+              'key': key,
+              'keyName': self.__names.get((kind, key), key if kind == 'pathway' else None),
+              'totalSpectralCount': count,
+              'normalizedSpectralCount': count / sample_total if sample_total else 0.0,
+              'proteins': proteins
+            }
+
+
+def rollupGuid(datasetId, kind, sampleId, key):
+    """Generate the GUID of a rollup document, stable across reloads"""
+    return oceanproteinportal.utils.generateGuid(datasetId + '_rollup_' + kind + ':' + str(sampleId) + ':' + key)
+
+def rollupRow(rollup, row, taxonomy=None):
+    """Add a mapped protein row (see iterResourceRows) to a rollup"""
+    taxon = None
+    if row.get('ncbi:id', None) is not None:
+        taxon = {'id': row['ncbi:id'], 'name': row.get('ncbi:name', None)}
+        if taxonomy is not None and taxon['name'] is None:
+            taxon['name'] = taxonomy.name(taxon['id'])
+    pathways = row.get('kegg:path', None)
+    if pathways is not None and not isinstance(pathways, list):
+        pathways = [pathways]
+    rollup.add(sampleId=row.get('spectralCount:sampleId', None), count=row.get('spectralCount:count', None), taxon=taxon, pathways=pathways)
@@ -1 +1,2 @@
 from .elasticsearch import *
+from .query import *
@@ -1,17 +1,69 @@
-from Bio import SeqIO
-import decimal
-import datapackage
-import datetime
-import elasticsearch
-import elasticsearch.helpers
 import json
 import logging
-import tableschema.exceptions
-from tableschema import Table
-import yaml
+import math
+import oceanproteinportal.abundance
+import oceanproteinportal.columnar
+import oceanproteinportal.coverage
+import oceanproteinportal.datapackage
+import oceanproteinportal.fasta
+import oceanproteinportal.idmap
+import oceanproteinportal.kmers
+import oceanproteinportal.logs
+import oceanproteinportal.ontology
+import oceanproteinportal.rollup
+import oceanproteinportal.tiles
+import oceanproteinportal.utils
+import oceanproteinportal.verify
+import os
+import threading
+import time
+from .serializer import BULK_CHUNK_ACTIONS, BULK_CHUNK_BYTES, BulkBuffer, ElasticSerializer, getSerializer, jsonDefault
+from .store import DataStore
 """
 Manage an Elasticsearch data store for the Ocean ProteinPortal
+
+The elasticsearch client, tableschema and yaml are imported inside the
+methods that use them so importing the store stays cheap.
+"""
+
+# Matches the spectralCount.dateTime mapping format (date_hour_minute_second)
+SPECTRAL_COUNT_DATE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Stored painless script appending spectral counts not already on a protein (by sampleId)
+APPEND_SPECTRAL_COUNT_SCRIPT_ID = 'opp-append-spectral-counts'
+APPEND_SPECTRAL_COUNT_SCRIPT = """
+if (ctx._source.spectralCount == null) { ctx._source.spectralCount = []; }
+Set samples = new HashSet();
+for (existing in ctx._source.spectralCount) { samples.add(existing.sampleId); }
+for (count in params.spectralCount) {
+  if (samples.add(count.sampleId)) { ctx._source.spectralCount.add(count); }
+}
+if (params.filterSize != null) { ctx._source.filterSize = params.filterSize; }
+"""
+# Stored painless script setting the normalised abundances of a protein's spectral counts (by sampleId)
+SET_ABUNDANCE_SCRIPT_ID = 'opp-set-spectral-count-abundance'
+SET_ABUNDANCE_SCRIPT = """
+if (ctx._source.spectralCount != null) {
+  for (count in ctx._source.spectralCount) {
+    def abundance = params.abundance.get(count.sampleId);
+    if (abundance != null) {
+      count.relativeAbundance = abundance.relativeAbundance;
+      count.nsaf = abundance.nsaf;
+    }
+  }
+}
 """
+STORED_SCRIPTS = {
+  APPEND_SPECTRAL_COUNT_SCRIPT_ID: APPEND_SPECTRAL_COUNT_SCRIPT,
+  SET_ABUNDANCE_SCRIPT_ID: SET_ABUNDANCE_SCRIPT
+}
+
+# Most of a memory budget one bulk chunk may take (it is copied once to be sent)
+BULK_BUDGET_SHARE = 0.05
+# Single document writes to a dataset between notifications of the write listeners
+WRITE_NOTIFY_INTERVAL = BULK_CHUNK_ACTIONS
+# Sequences looked up / resolved per request
+SEQUENCE_BATCH_SIZE = 500
 
 class ElasticStore(DataStore):
     """An Elasticsearch data store.
@@ -28,10 +80,29 @@ class ElasticStore(DataStore):
     __schema_file = '/elasticsearch/mapping.json'
     __config = None
     __store = None
-
-    def __init__(self, host, port, index_name, schema_file_path, http_compress=True, **es_params):
+    __write_listeners = None
+    __write_counts = None
+    __write_lock = None
+    __identifier_map = None
+    __taxonomy = None
+    __quarantine = None
+    __manifest = None
+    __memory_budget = None
+    __routing = True
+    __routing_partition_size = None
+    __serializer = None
+
+    def __init__(self, host, port, index_name, schema_file_path, http_compress=True, routing=True, routing_partition_size=None, serializer=None, **es_params):
         self.__index = index_name
         self.__schema_file = schema_file_path
+        self.__routing = routing
+        self.__routing_partition_size = routing_partition_size
+        self.__write_listeners = []
+        self.__write_counts = {}
+        self.__write_lock = threading.Lock()
+        # orjson, ujson or json; the fastest installed by default
+        self.__serializer = getSerializer(serializer)
+        import elasticsearch
 
         # Config
         self.__config = {
@@ -43,8 +114,9 @@ class ElasticStore(DataStore):
 
         # Store - Setup an Elasticsearch client
         self.__store = elasticsearch.Elasticsearch(
-            hosts=[self.config],
-            http_compress=http_compress
+            hosts=[self.__config],
+            http_compress=http_compress,
+            serializer=ElasticSerializer(self.__serializer)
         )
 
     def getConfig(self):
@@ -59,49 +131,259 @@ class ElasticStore(DataStore):
         """Return the Elasticsearch Index name"""
         return self.__index
 
-    def initialize(self):
-        """Initialize an Elasticsearch Index for the OceanProteinPortal."""
+    def getIndexUUID(self):
+        """Return the UUID of the Elasticsearch Index, or None if it does not exist"""
+        result = self.getStore().indices.get_settings(index=self.getIndex(), ignore=[404])
+        if result.get('status', None) == 404 or self.getIndex() not in result:
+            return None
+        return result[self.getIndex()]['settings']['index']['uuid']
+
+    def getSerializer(self):
+        """Return the JSON serializer of the store's writes"""
+        return self.__serializer
+
+    def isRouted(self):
+        """Whether documents are routed by their dataset"""
+        return bool(self.__routing)
+
+    def getRouting(self, datasetId):
+        """The routing of a dataset's documents: the datasetId, or None when routing is disabled
+
+        With a routing_partition_size the index spreads each dataset over
+        that many shards instead of one, for very large datasets.
+        """
+        if not self.__routing or datasetId is None:
+            return None
+        return datasetId
+
+    def setIdentifierMap(self, identifier_map):
+        """Use an oceanproteinportal.idmap.IdentifierMap instead of store lookups for existence checks
+
+        A map made for an index since recreated is cleared.
+        """
+        self.__identifier_map = identifier_map
+        index_uuid = self.getIndexUUID()
+        if index_uuid is not None and identifier_map.bindIndex(index_uuid):
+            logging.info('Cleared the identifier map of a previous index: %s' % (identifier_map.getPath()))
+
+    def getIdentifierMap(self):
+        """Return the identifier map, if any"""
+        return self.__identifier_map
+
+    def setTaxonomy(self, taxonomy):
+        """Use an oceanproteinportal.taxonomy.TaxonomyIndex to fill in NCBI taxon names and lineages"""
+        self.__taxonomy = taxonomy
+
+    def getTaxonomy(self):
+        """Return the taxonomy index, if any"""
+        return self.__taxonomy
+
+    def setQuarantine(self, quarantine):
+        """Quarantine bad rows to an oceanproteinportal.quarantine.Quarantine instead of aborting loads"""
+        self.__quarantine = quarantine
+
+    def getQuarantine(self):
+        """Return the quarantine, if any"""
+        return self.__quarantine
+
+    def setManifest(self, manifest):
+        """Sum the rows the loaders read into an oceanproteinportal.verify.IngestManifest"""
+        self.__manifest = manifest
+
+    def getManifest(self):
+        """Return the ingest manifest, if any"""
+        return self.__manifest
+
+    def setMemoryBudget(self, budget):
+        """Bound the grouping and bulk buffers by an oceanproteinportal.memory.MemoryBudget"""
+        self.__memory_budget = budget
+
+    def getMemoryBudget(self):
+        """Return the memory budget, if any"""
+        return self.__memory_budget
+
+    def addWriteListener(self, listener):
+        """Register a callable notified with the datasetId whenever a dataset is written"""
+        self.__write_listeners.append(listener)
+
+    def notifyDatasetWrite(self, datasetId):
+        """Tell the write listeners (e.g. query caches) that a dataset changed"""
+        for listener in self.__write_listeners:
+            listener(datasetId)
+
+    def countDatasetWrites(self, datasetId, writes=1):
+        """Count single document writes to a dataset, notifying the write listeners every WRITE_NOTIFY_INTERVAL of them"""
+        if not self.__write_listeners or datasetId is None:
+            return
+        with self.__write_lock:
+            count = self.__write_counts.get(datasetId, 0) + writes
+            notify = count >= WRITE_NOTIFY_INTERVAL
+            self.__write_counts[datasetId] = 0 if notify else count
+        if notify:
+            self.notifyDatasetWrite(datasetId)
+
+    def initialize(self, expected_documents=None, generate_mapping=True, ontology_version=None):
+        """Initialize an Elasticsearch Index for the OceanProteinPortal.
+
+        With generate_mapping the schema file is tuned from the ontology
+        mappings (see oceanproteinportal.store.mapping) and sharded for
+        expected_documents; otherwise it is used as is.
+        """
+        from . import mapping
         es = self.getStore()
         index = self.getIndex()
 
         # Delete the index, but ignore if not found (404)
         result = es.indices.delete(index=index, ignore=[404])
         if ('status' in result and result['status'] == 404):
-            logging.debug('Index did not exist: %s' % (ES_INDEX))
+            logging.debug('Index did not exist: %s' % (index))
         elif (not 'acknowledged' in result or result['acknowledged'] != True):
-            raise Exception("Could not delete the ES index: %s" % (ES_INDEX))
+            raise Exception("Could not delete the ES index: %s" % (index))
         else:
-            logging.info('Deleted Index: %s' % (ES_INDEX))
+            logging.info('Deleted Index: %s' % (index))
 
         # Create the index
-        index_properties = json.loads(open(self.__schema_file).read())
+        with open(self.__schema_file) as schema_file:
+            index_properties = json.load(schema_file)
+        if generate_mapping:
+            if ontology_version is None:
+                ontology_version = oceanproteinportal.ontology.getLatestOntologyVersion()
+            elastic_mappings = {}
+            for type in ('protein', 'peptide'):
+                elastic_mappings[type] = getOntologyMappingFields(type=type, ontology_version=ontology_version)
+            index_properties = mapping.generateIndexBody(
+              index_properties,
+              template_mappings=oceanproteinportal.ontology.getTemplateMappings()[ontology_version],
+              elastic_mappings=elastic_mappings,
+              expected_documents=expected_documents,
+              routing_required=bool(self.__routing),
+              routing_partition_size=self.__routing_partition_size if self.__routing else None
+            )
         result = es.indices.create(
           index=index,
-          body=json.dumps(index_properties, default=elasticDatatypeHandler)
+          body=self.__serializer.dumps(index_properties)
         )
         if (not 'acknowledged' in result or result['acknowledged'] != True):
-            raise Exception("Could not create the ES index: %s with properties: %s" % (ES_INDEX, ES_INDEX_SCHEMA))
+            raise Exception("Could not create the ES index: %s with properties: %s" % (index, index_properties))
         else:
-            logging.info('Created Index: %s' % (ES_INDEX))
+            logging.info('Created Index: %s' % (index))
+        # Whatever the identifier map recorded went with the old index
+        if self.getIdentifierMap() is not None:
+            self.getIdentifierMap().bindIndex(self.getIndexUUID())
         logging.info("Done!")
 
-    def load(self, data, type, id):
-        """Load data into Elasticsearch"""
+    def load(self, data, type, id, datasetId=None):
+        """Load data into Elasticsearch, routed by its dataset"""
+        es = self.getStore()
+        index = self.getIndex()
+
+        if datasetId is None:
+            datasetId = id if type == 'dataset' else data.get('_dataset', None)
+        doc = self.__serializer.dumps(data)
+        logging.debug('%s', doc)
+        res = es.index(index=index, doc_type=type, id=id, body=doc, routing=self.getRouting(datasetId))
+        self.countDatasetWrites(datasetId)
+        return res['result']
+
+    def update(self, data, type, id, datasetId):
+        """Partially update a dataset's document in Elasticsearch"""
+        es = self.getStore()
+        index = self.getIndex()
+
+        doc = self.__serializer.dumps({'doc': data})
+        logging.debug('%s', doc)
+        res = es.update(index=index, doc_type=type, id=id, body=doc, routing=self.getRouting(datasetId))
+        self.countDatasetWrites(datasetId)
+        return res['result']
+
+    def upsert(self, body, type, id, datasetId, retry_on_conflict=3):
+        """Send a dataset's scripted upsert ({'script', 'upsert'}) to Elasticsearch"""
         es = self.getStore()
         index = self.getIndex()
 
-        doc = json.dumps(data, default=elasticDatatypeHandler)
-        logging.debug(doc)
-        res = es.index(index=index, doc_type=type, id=id, body=doc)
+        doc = self.__serializer.dumps(body)
+        logging.debug('%s', doc)
+        res = es.update(index=index, doc_type=type, id=id, body=doc, routing=self.getRouting(datasetId), retry_on_conflict=retry_on_conflict)
+        self.countDatasetWrites(datasetId)
         return res['result']
 
+    def bulk(self, actions, chunk_size=BULK_CHUNK_ACTIONS, max_chunk_bytes=BULK_CHUNK_BYTES, on_success=None, datasetId=None):
+        """Send bulk actions (in elasticsearch.helpers' format), returning (succeeded, errors)
+
+        Each chunk is encoded into one reused bytes buffer and posted as is.
+        With a memory budget chunks are at most BULK_BUDGET_SHARE of it.
+        on_success is called with the result (_type, _id, ...) of each action
+        the store accepted, as soon as its chunk is sent. With a datasetId the
+        write listeners are notified after every chunk.
+        """
+        es = self.getStore()
+        budget = self.getMemoryBudget()
+        if budget is not None:
+            max_chunk_bytes = budget.share(BULK_BUDGET_SHARE, maximum=max_chunk_bytes)
+        buffer = BulkBuffer(self.__serializer, max_actions=chunk_size, max_bytes=max_chunk_bytes)
+        succeeded = 0
+        errors = []
+
+        def flush():
+            nonlocal succeeded
+            res = es.transport.perform_request('POST', '/_bulk', body=buffer.getvalue())
+            buffer.clear()
+            if datasetId is not None:
+                self.notifyDatasetWrite(datasetId)
+            for item in res['items']:
+                result = next(iter(item.values()))
+                if 200 <= result.get('status', 500) < 300:
+                    succeeded += 1
+                    if on_success is not None:
+                        on_success(result)
+                else:
+                    errors.append(item)
+
+        for action in actions:
+            if buffer.add(action):
+                flush()
+        if len(buffer):
+            flush()
+        return succeeded, errors
+
+    def deleteDataset(self, datasetId, slices=5):
+        """Delete a dataset's documents with a routed, sliced delete-by-query"""
+        import elasticsearch
+        es = self.getStore()
+        index = self.getIndex()
+        routing = self.getRouting(datasetId)
+
+        result = es.delete_by_query(
+          index=index,
+          doc_type='protein,peptide,rollup,tile,kmer',
+          body={'query': {'bool': {'filter': [{'term': {'_dataset': datasetId}}]}}},
+          routing=routing,
+          slices=slices,
+          conflicts='proceed',
+          refresh=True
+        )
+        logging.info('Deleted %s documents of dataset %s' % (result.get('deleted', 0), datasetId))
+        for failure in result.get('failures', []):
+            logging.error('*** NOT DELETED: %s' % (failure))
+        try:
+            es.delete(index=index, doc_type='dataset', id=datasetId, routing=routing)
+        except elasticsearch.exceptions.NotFoundError:
+            pass
+
+        # The identifier map no longer describes the store
+        if self.getIdentifierMap() is not None:
+            self.getIdentifierMap().clear()
+        self.notifyDatasetWrite(datasetId)
+        return result.get('deleted', 0)
+
     def loadDatasetMetadata(self, datapackage, datasetId):
         """Load Dataset Metadata"""
+        import elasticsearch
         es = self.getStore()
         index = self.getIndex()
         data = {}
         try:
-            dataset_doc = es.get(index=index, doc_type='dataset', id=datasetId)
+            dataset_doc = es.get(index=index, doc_type='dataset', id=datasetId, routing=self.getRouting(datasetId))
             data = dataset_doc['_source']
         except elasticsearch.exceptions.NotFoundError as exc:
             # New dataset
@@ -138,186 +420,286 @@ class ElasticStore(DataStore):
 
         # Load into Elasticsearch
         result = self.load(data=data, type='dataset', id=datasetId)
-        logging.info('%s - %s', % (datasetId, result))
+        logging.info('%s - %s' % (datasetId, result))
+        self.notifyDatasetWrite(datasetId)
 
-    def loadProteins(self, datapackage, datasetId, row_start=0, row_stop=None):
+    def loadProteins(self, datapackage, datasetId, row_start=0, row_stop=None, mode='index', rows=None):
         """Load Protein Data
 
         Tabular data, so proteins may be repeated for different samples, stations, depths, etc.
         1) Build proteinId first, then lookup if it exists in the store
         2) If not exists, build a new document. Else, update the spectral counts of existing doc
+
+        With an identifier map the store is not read: a protein the map knows
+        has the row's spectral count appended by the stored script, as in
+        append mode, and any other is indexed as a new document.
+
+        mode='append' skips the lookup and appends the spectral counts on the server, see appendProteins.
+        mode='group' groups the rows in memory and writes every protein once, see groupProteins.
+        rows limits the load to a set of row numbers, e.g. replayed dead letters.
         """
+        if mode == 'append':
+            return self.appendProteins(datapackage=datapackage, datasetId=datasetId, row_start=row_start, row_stop=row_stop, rows=rows)
+        if mode == 'group':
+            return self.groupProteins(datapackage=datapackage, datasetId=datasetId, row_start=row_start, row_stop=row_stop, rows=rows)
+
+        import elasticsearch
         es = self.getStore()
         index = self.getIndex()
 
-        # Get the Ontology Version
-        ontology_version = oceanproteinportal.datapackage.getDatapackageOntologyVersion(datapackage)
-
         proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
         if proteinResource is None:
             return
 
         datasetCruises = oceanproteinportal.datapackage.datapackageCruises(datapackage)
-        table = Table(proteinResource.descriptor['path'], schema=proteinResource.descriptor['schema'])
-
-        if (0 < row_start):
-            logging.info("Skipping rows until # %s" % (row_start))
+        identifier_map = self.getIdentifierMap()
+        if identifier_map is not None:
+            self.putScripts()
+        taxonomy = self.getTaxonomy()
+        quarantine = self.getQuarantine()
+        manifest = self.getManifest()
+        # Per-document results are counted, not logged per row
+        results = oceanproteinportal.logs.Counters('Protein documents')
 
         row_count = 0
-        proteinId = None
+        row = None
         data = None
-        PROTEIN_FIELDS = getOntologyMappingFields(type='protein', ontology_version=ontology_version)
         try:
-            for keyed_row in table.iter(keyed=True):
-                row_count += 1
-                if row_count < row_start:
-                    logging.debug("Skipping Row # %s" % (row_count))
-                    continue
-                if row_stop is not None and row_count > row_stop:
-                    logging.info("Stopping at Row# %s" % (row_count))
-                    break
-                logging.debug("Reading Row# %s" % (row_count))
-                row = readKeyedTableRow(keyed_row=keyed_row, elastic_mappings=PROTEIN_FIELDS)
-
-                # Get the unqiue identifier for this protein
-                proteinId = row['proteinId']
-                protein_guid = generateGuid( datapackage.descriptor['name'] + '_protein_' + datasetId + ':' + proteinId )
-
+            for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', row_start=row_start, row_stop=row_stop, quarantine=quarantine, rows=rows, manifest=manifest):
                 try:
-                    res = es.get(index=index, doc_type='protein', id=protein_guid)
-                    # Reuse existing protein document
-                    data = res['_source']
-                except elasticsearch.exceptions.NotFoundError as exc:
-                    # Build a new ES Protein document
-                    data = {
-                      '_dataset': datasetId,
-                      'guid': protein_guid,
-                      'proteinId': proteinId,
-                      'spectralCount': []
-                    }
-
-                    if row['productName'] is not None:
-                        data['productName'] = row['productName']
-                    if row.get('molecularWeight', None) is not None:
-                        data['molecularWeight'] = row['molecularWeight']
-                    if row.get('enzymeCommId', None) is not None:
-                        data['enzymeCommId'] = row['enzymeCommId']
-                    if row.get('uniprotId', None) is not None:
-                        data['uniprotId'] = row['uniprotId']
-                    if row.get('otherIdentifiedProteins', None) is not None:
-                        data['otherIdentifiedProteins'] = row['otherIdentifiedProteins']
-
-                    # NCBI
-                    ncbiTaxon = None
-                    if 'ncbi:id' in row:
-                        ncbiTaxon = {
-                          'id': row['ncbi:id'],
-                          'name': None
-                        }
-                    if 'ncbi:name' in row:
-                        ncbiTaxon['name'] = row['ncbi:name']
-                    if ncbiTaxon is not None:
-                        data['ncbiTaxon'] = ncbiTaxon
-
-                    # Kegg
-                    kegg_pathway = None
-                    pathway = row.get('kegg:path', None)
-                    if pathway is not None:
-                        kegg_pathway = []
-                        for idx,path in enumerate(pathway):
-                            kegg_pathway.append({'value': path, 'index': idx})
-                        data['kegg'] = {
-                          'id': row.get('kegg:id', None),
-                          'description': row.get('kegg:desc', None),
-                          'pathway': kegg_pathway
-                        }
-
-                    # PFams
-                    if 'pfams:id' in row:
-                        data['pfams'] = {
-                          'id': data.get('pfams:id', None),
-                          'name': data.get('pfams:name', None)
-                        }
-                # END of initial protein data setup
-
-                # Handle all the unqiue row data for a certain protein
-                # FilterSize
-                filterSize = {}
-                minimumFilterSize = row.get('filterSize:minimum', None)
-                maximumFilterSize = row.get('filterSize:maximum', None)
-                filterSizeLabel = ''
-                if minimumFilterSize is not None:
-                    filterSize['minimum'] = minimumFilterSize
-                    filterSizeLabel += str(minimumFilterSize)
-                if maximumFilterSize is not None:
-                    filterSize['maximum'] = maximumFilterSize
-                    if filterSizeLabel != '':
-                        filterSizeLabel += ' - ' + str(maximumFilterSize)
+                    # Get the unqiue identifier for this protein
+                    proteinId = row['proteinId']
+                    known = None
+                    if identifier_map is not None:
+                        known = identifier_map.get('protein', proteinId)
+                    if known is not None:
+                        protein_guid = known['guid']
                     else:
-                        filterSize += str(maximumFilterSize)
-                if filterSizeLabel != '':
-                    filterSize['label'] = filterSizeLabel
-                    data['filterSize'] = filterSize
-
-                # Cruise
-                cruise = {
-                  'value': row.get('spectralCount:cruise', None),
-                }
-                if datasetCruises is not None and cruise['value'] in datasetCruises:
-                    cruise['uri'] = datasetCruises[cruise['value']]['uri']
-                # To-do
-                # 1. Lookup the cruise URI in the datapackage
-
-                # Spectral Counts
-                # fix ISO DateTime
-                observationDateTime = None
-                if 'spectralCount:dateTime' in row and row['spectralCount:dateTime'] is not None:
-                    observationDateTime = dateutil.parser.parse(row['spectralCount:dateTime'])
-                    observationDateTime = observationDateTime.strftime(SPECTRAL_COUNT_DATE_TIME_FORMAT)
-                elif 'spectralCount:date' in row and row['spectralCount:date'] is not None:
-                    time = row.get('spectralCount:time', None)
-                    if (time is None):
-                        time = '00:00:00'
-                    observationDateTime = dateutil.parser.parse(row['spectralCount:date'] + 'T' + time)
-                    observationDateTime = observationDateTime.strftime(SPECTRAL_COUNT_DATE_TIME_FORMAT)
-
-                spectralCount = {
-                    'sampleId': row.get('spectralCount:sampleId', None),
-                    'count': row.get('spectralCount:count', None),
-                    'cruise': cruise,
-                    'station': row.get('spectralCount:station', None),
-                    'depth': row.get('spectralCount:depth', None),
-                    'dateTime': observationDateTime,
-                }
-                if (spectralCount['depth'] is not None):
-                    if 'min' not in dataset_depth_stats:
-                        dataset_depth_stats['min'] = spectralCount['depth']
-                        dataset_depth_stats['max'] = spectralCount['depth']
-                    else:
-                        if spectralCount['depth'] < dataset_depth_stats['min']:
-                            dataset_depth_stats['min'] = spectralCount['depth']
-                        if spectralCount['depth'] > dataset_depth_stats['max']:
-                            dataset_depth_stats['max'] = spectralCount['depth']
-
-                if (row['spectralCount:coordinate:lat'] is not None and row['spectralCount:coordinate:lon'] is not None):
-                    spectralCount['coordinate'] = {
-                      'lat': row['spectralCount:coordinate:lat'],
-                      'lon': row['spectralCount:coordinate:lon']
-                    }
-                data['spectralCount'].append(spectralCount)
-                res = self.load(data=data, type='protein', id=data['guid'])
-                logging.info(res['result'])
+                        protein_guid = generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=proteinId)
+
+                    if known is not None:
+                        # Known to exist: append on the server instead of reading the document
+                        results.add(self.upsert(buildProteinUpsert(row=row, datasetId=datasetId, guid=protein_guid, datasetCruises=datasetCruises, taxonomy=taxonomy), type='protein', id=protein_guid, datasetId=datasetId))
+                        if manifest is not None:
+                            manifest.add('protein', row)
+                        continue
+
+                    data = None
+                    # Without an identifier map, look for the stored document
+                    if identifier_map is None:
+                        try:
+                            res = es.get(index=index, doc_type='protein', id=protein_guid, routing=self.getRouting(datasetId))
+                            # Reuse existing protein document
+                            data = res['_source']
+                        except elasticsearch.exceptions.NotFoundError as exc:
+                            pass
+                    if data is None:
+                        # Build a new ES Protein document
+                        data = buildProteinDocument(row=row, datasetId=datasetId, guid=protein_guid, taxonomy=taxonomy)
+
+                    # Handle all the unqiue row data for a certain protein
+                    filterSize = buildFilterSize(row)
+                    if filterSize is not None:
+                        data['filterSize'] = filterSize
+                    data['spectralCount'].append(buildSpectralCount(row=row, datasetCruises=datasetCruises))
+                    results.add(self.load(data=data, type='protein', id=data['guid'], datasetId=datasetId))
+                    if identifier_map is not None:
+                        identifier_map.put('protein', proteinId, guid=protein_guid)
+                    if manifest is not None:
+                        manifest.add('protein', row)
+                except Exception as e:
+                    if quarantine is None:
+                        raise e
+                    quarantine.reject('protein', row_count, row, e)
             # end of for loop of protein rows
         except Exception as e:
-            logging.exception("Error with row[%s]: %s" % (row_count, keyed_row))
+            logging.exception("Error with row[%s]: %s" % (row_count, row))
             raise e
+        finally:
+            results.flush()
+            if identifier_map is not None:
+                identifier_map.commit()
+            self.notifyDatasetWrite(datasetId)
+
+    def appendProteins(self, datapackage, datasetId, row_start=0, row_stop=None, thread_count=4, chunk_size=500, rows=None):
+        """Load Protein Data without reading the existing protein documents
+
+        Every row becomes a bulk scripted upsert: a new protein is created
+        from the upsert document, an existing one has the row's spectral count
+        appended by the stored script (skipping samples it already has). With
+        no read-modify-write, partitions can be loaded in parallel.
+        """
+        import collections
+        import elasticsearch.helpers
+        es = self.getStore()
+        index = self.getIndex()
+
+        proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
+        if proteinResource is None:
+            return
+
+        self.putScripts()
+        datasetCruises = oceanproteinportal.datapackage.datapackageCruises(datapackage)
+        taxonomy = self.getTaxonomy()
+        routing = self.getRouting(datasetId)
+        quarantine = self.getQuarantine()
+        manifest = self.getManifest()
+        # (row number, row) of the actions in flight; bulk results come back in order
+        pending_rows = collections.deque()
+
+        def protein_upserts():
+            for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', row_start=row_start, row_stop=row_stop, quarantine=quarantine, rows=rows, manifest=manifest):
+                try:
+                    protein_guid = generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=row['proteinId'])
+                    action = buildProteinUpsert(row=row, datasetId=datasetId, guid=protein_guid, datasetCruises=datasetCruises, taxonomy=taxonomy)
+                except Exception as e:
+                    if quarantine is None:
+                        raise e
+                    quarantine.reject('protein', row_count, row, e)
+                    continue
+
+                pending_rows.append((row_count, row))
+                action.update({
+                  '_op_type': 'update',
+                  '_index': index,
+                  '_type': 'protein',
+                  '_id': protein_guid,
+                  '_retry_on_conflict': 3
+                })
+                yield routeAction(action, routing)
+
+        loaded = 0
+        try:
+            for ok, item in elasticsearch.helpers.parallel_bulk(es, protein_upserts(), thread_count=thread_count, chunk_size=chunk_size, raise_on_error=False):
+                row_count, row = pending_rows.popleft()
+                if ok:
+                    loaded += 1
+                    self.countDatasetWrites(datasetId)
+                    if manifest is not None:
+                        manifest.add('protein', row)
+                elif quarantine is not None:
+                    quarantine.reject('protein', row_count, item, item.get('update', {}).get('error', 'rejected'), stage='bulk')
+                else:
+                    logging.error('*** PROTEIN NOT LOADED: %s' % (item))
+        finally:
+            logging.info('Appended %s protein rows' % (loaded))
+            self.notifyDatasetWrite(datasetId)
+
+    def groupProteins(self, datapackage, datasetId, row_start=0, row_stop=None, rows=None):
+        """Load Protein Data by grouping the rows in memory first
+
+        The rows are grouped per proteinId into compact array-backed proteins
+        (see oceanproteinportal.store.proteins), then every protein document
+        is built and bulk indexed once. The grouped proteins replace what the
+        store has for them when the rows cover the whole dataset; a load of
+        part of the rows (row_start, row_stop or rows) appends them instead.
+        Whenever the memory budget (see setMemoryBudget) is exceeded the
+        proteins grouped so far are written and dropped; the later counts of
+        a protein written already are appended by the stored script, which
+        skips samples the protein has.
+        """
+        from .proteins import ProteinGrouper
+        index = self.getIndex()
+
+        proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
+        if proteinResource is None:
+            return
+
+        identifier_map = self.getIdentifierMap()
+        quarantine = self.getQuarantine()
+        manifest = self.getManifest()
+        routing = self.getRouting(datasetId)
+        # Part of the rows must not overwrite the proteins' other counts
+        partial = row_start > 1 or row_stop is not None or rows is not None
+        grouper = ProteinGrouper(
+          datasetId,
+          generateGuid=lambda proteinId: generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=proteinId),
+          datasetCruises=oceanproteinportal.datapackage.datapackageCruises(datapackage),
+          taxonomy=self.getTaxonomy(),
+          append=partial
+        )
+        budget = self.getMemoryBudget()
+        if budget is not None or partial:
+            self.putScripts()
+
+        # guid -> (proteinId, rows) of the proteins sent, recorded in the identifier map and manifest once written
+        pending = {}
+        recording = identifier_map is not None or manifest is not None
+
+        def protein_actions():
+            for proteinId, document, spilled in grouper.spill():
+                if recording:
+                    pending[document['guid']] = (proteinId, len(document['spectralCount']))
+                if not spilled:
+                    yield routeAction({
+                      '_index': index,
+                      '_type': 'protein',
+                      '_id': document['guid'],
+                      '_source': document
+                    }, routing)
+                    continue
+                yield routeAction({
+                  '_op_type': 'update',
+                  '_index': index,
+                  '_type': 'protein',
+                  '_id': document['guid'],
+                  '_retry_on_conflict': 3,
+                  'script': {
+                    'stored': APPEND_SPECTRAL_COUNT_SCRIPT_ID,
+                    'params': {'spectralCount': document['spectralCount'], 'filterSize': document.get('filterSize', None)}
+                  },
+                  'upsert': document
+                }, routing)
+
+        def written(result):
+            if result['_id'] not in pending:
+                return
+            proteinId, rows = pending.pop(result['_id'])
+            if identifier_map is not None:
+                identifier_map.put('protein', proteinId, guid=result['_id'], rows=rows)
+            if manifest is not None:
+                manifest.add('protein', {'proteinId': proteinId}, rows=rows)
+
+        def write():
+            loaded, errors = self.bulk(protein_actions(), on_success=written if recording else None, datasetId=datasetId)
+            pending.clear()
+            logging.info('Loaded %s proteins' % (loaded))
+            for error in errors:
+                logging.error('*** PROTEIN NOT LOADED: %s' % (error))
+
+        try:
+            for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', row_start=row_start, row_stop=row_stop, quarantine=quarantine, rows=rows, manifest=manifest):
+                try:
+                    grouper.add(row)
+                except Exception as e:
+                    if quarantine is None:
+                        logging.exception("Error with row[%s]: %s" % (row_count, row))
+                        raise e
+                    quarantine.reject('protein', row_count, row, e)
+                if budget is not None and budget.exceeded():
+                    logging.info('Memory budget exceeded: spilling %s grouped proteins' % (len(grouper)))
+                    write()
+                    budget.spilled()
+            logging.info('Grouped %s protein rows into %s proteins (%s repeated samples skipped)' % (grouper.rows, len(grouper), grouper.duplicates))
+            write()
+        finally:
+            if identifier_map is not None:
+                identifier_map.commit()
+            self.notifyDatasetWrite(datasetId)
+
+    def putScripts(self):
+        """Store the painless scripts used by the scripted upserts"""
+        es = self.getStore()
+        for script_id, source in STORED_SCRIPTS.items():
+            es.transport.perform_request('POST', '/_scripts/' + script_id, body={'script': {'lang': 'painless', 'code': source}})
 
     def updateDatasetSampleStats(self, datasetId):
         """ Update Dataset with sample statistics"""
         # Get existing dataset document
         es = self.getStore()
         index = self.getIndex()
-        dataset_doc = es.get(index=index, doc_type='dataset', id=datasetId)
+        routing = self.getRouting(datasetId)
+        dataset_doc = es.get(index=index, doc_type='dataset', id=datasetId, routing=routing)
 
         # dataset update object
         dataset = {}
@@ -346,7 +728,7 @@ class ElasticStore(DataStore):
             }
           }
         }
-        res = es.search(index=index, doc_type='protein', body=depth_aggs)
+        res = es.search(index=index, doc_type='protein', body=depth_aggs, routing=routing)
         if len(res['aggregations']['depth']) > 0:
             dataset['depth_stats'] = {
                 'max': res['aggregations']['depth']['maximum']['value'],
@@ -378,7 +760,7 @@ class ElasticStore(DataStore):
             }
           }
         }
-        res = es.search(index=index, doc_type='protein', body=filter_size_aggs)
+        res = es.search(index=index, doc_type='protein', body=filter_size_aggs, routing=routing)
         if len(res['aggregations']['filter_size']['buckets']) > 0:
             filters = []
             for agg_filter in res['aggregations']['filter_size']['buckets']:
@@ -416,7 +798,7 @@ class ElasticStore(DataStore):
             }
           }
         }
-        res = es.search(index=index, doc_type='protein', body=cruise_aggs)
+        res = es.search(index=index, doc_type='protein', body=cruise_aggs, routing=routing)
         if len(res['aggregations']['data']['cruises']['buckets']) > 0:
             cruises = []
             logging.info('Cruises to grab stations for: %s' % (res['aggregations']['data']['cruises']['buckets']))
@@ -462,7 +844,7 @@ class ElasticStore(DataStore):
                       }
                     }
                     logging.info(station_search)
-                    station_locations = elastic.search(index=ES_INDEX, doc_type='protein', body=station_search)
+                    station_locations = es.search(index=index, doc_type='protein', body=station_search, routing=routing)
                     if (station_locations['hits']['total'] > 0):
                         for station in station_locations['hits']['hits'][0]['_source']['spectralCount']:
                             logging.info('%s => %s' % (station['station'], lookup_station_coordinates))
@@ -482,110 +864,363 @@ class ElasticStore(DataStore):
             dataset['cruises'] = cruises
 
         # Update the dataset
-        res = self.load(data={'doc': dataset}, type='dataset', id=datasetId)
-        logging.info(res['result'])
+        res = self.update(data=dataset, type='dataset', id=datasetId, datasetId=datasetId)
+        logging.info(res)
+        self.notifyDatasetWrite(datasetId)
+
+    def updateDatasetRollups(self, datapackage, datasetId):
+        """Update the dataset's taxon and KEGG pathway abundance rollups
+
+        The protein rows are streamed once into per (sample, taxon) and
+        (sample, pathway) totals. On a reload only the rollups whose totals
+        changed are rewritten (when an identifier map is set) and rollups
+        that no longer exist are deleted.
+        """
+        proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
+        if proteinResource is None:
+            return
 
-    def loadProteinsFASTA(self, datapackage, datasetId):
-        """Load Proteins FASTA Data"""
+        rollup = oceanproteinportal.rollup.AbundanceRollup()
+        taxonomy = self.getTaxonomy()
+        # Rows the protein load quarantined are skipped, not quarantined again
+        skipped = oceanproteinportal.verify.SkippedRows()
+        for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', quarantine=skipped):
+            oceanproteinportal.rollup.rollupRow(rollup, row, taxonomy=taxonomy)
+        logging.info('Computed %s rollups (%s unreadable rows skipped)' % (len(rollup), skipped.rejected))
+
+        self.replaceDatasetDocuments(datasetId=datasetId, type='rollup', documents=rollup.documents(datasetId))
+
+    def updateDatasetTiles(self, datapackage, datasetId, precisions=oceanproteinportal.tiles.TILE_PRECISIONS):
+        """Update the dataset's station map tiles
+
+        The protein rows are streamed once into per station samples and
+        proteins, which are grouped by geohash at each precision into 'tile'
+        documents (see oceanproteinportal.tiles). As with the rollups only
+        changed tiles are rewritten and tiles no longer in the dataset are
+        deleted.
+        """
+        proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
+        if proteinResource is None:
+            return
+
+        tiles = oceanproteinportal.tiles.StationTiles(precisions=precisions)
+        # Rows the protein load quarantined are skipped, not quarantined again
+        skipped = oceanproteinportal.verify.SkippedRows()
+        for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', quarantine=skipped):
+            oceanproteinportal.tiles.tileRow(tiles, row)
+        logging.info('Tiling %s stations (%s unreadable rows skipped)' % (len(tiles), skipped.rejected))
+
+        self.replaceDatasetDocuments(datasetId=datasetId, type='tile', documents=tiles.documents(datasetId))
+
+    def updateDatasetKmers(self, datapackage, datasetId, lengths=oceanproteinportal.kmers.KMER_LENGTHS, index_file=None, fast=True):
+        """Update the dataset's k-mer posting lists for peptide motif search
+
+        The FASTA sequences are read once into a posting list per k-mer,
+        stored as 'kmer' documents together with the protein table the
+        postings refer to (see oceanproteinportal.kmers). With index_file
+        the same postings are also written to a local index for KmerIndex.
+        As with the rollups only changed documents are rewritten.
+        """
+        fastaResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='fasta')
+        if fastaResource is None:
+            return
+
+        kmers = oceanproteinportal.kmers.KmerBuilder(lengths=lengths)
+        for record_id, sequence in oceanproteinportal.fasta.iterFasta(fastaResource.descriptor['path'], fast=fast):
+            kmers.add(record_id, sequence)
+        logging.info('Indexed %s k-mers of %s proteins' % (kmers.kmers(), len(kmers)))
+
+        if index_file is not None:
+            kmers.write(index_file)
+            logging.info('Wrote the k-mer index %s' % (index_file))
+        self.replaceDatasetDocuments(datasetId=datasetId, type='kmer', documents=kmers.documents(datasetId))
+
+    def replaceDatasetDocuments(self, datasetId, type, documents):
+        """Replace a dataset's documents of a derived type (e.g. rollup, tile) with new ones
+
+        With an identifier map unchanged documents are not rewritten.
+        Documents of the type that are not among the new ones are deleted.
+        """
+        import elasticsearch.helpers
         es = self.getStore()
         index = self.getIndex()
+        identifier_map = self.getIdentifierMap()
+        routing = self.getRouting(datasetId)
+        current = set()
+        # guid -> hash of the documents sent, recorded in the identifier map once written
+        pending = {}
+
+        def actions():
+            for document in documents:
+                current.add(document['guid'])
+                if identifier_map is not None:
+                    doc_hash = oceanproteinportal.idmap.documentHash(document)
+                    if identifier_map.isUnchanged(type, document['guid'], doc_hash):
+                        continue
+                    pending[document['guid']] = doc_hash
+                yield routeAction({
+                  '_index': index,
+                  '_type': type,
+                  '_id': document['guid'],
+                  '_source': document
+                }, routing)
+
+        def written(result):
+            if result['_id'] in pending:
+                identifier_map.put(type, result['_id'], guid=result['_id'], doc_hash=pending.pop(result['_id']))
+
+        try:
+            loaded, errors = self.bulk(actions(), on_success=written if identifier_map is not None else None, datasetId=datasetId)
+            logging.info('Loaded %s changed %s documents' % (loaded, type))
+            for error in errors:
+                logging.error('*** %s NOT LOADED: %s' % (type.upper(), error))
+
+            # Remove the documents no longer in the dataset
+            stale = []
+            for result in elasticsearch.helpers.scan(
+                es,
+                scroll='2m',
+                size=1000,
+                query={'query': {'bool': {'filter': [{'term': {'_dataset': datasetId}}]}}, '_source': False},
+                index=index,
+                doc_type=type,
+                routing=routing
+            ):
+                if result['_id'] not in current:
+                    stale.append(routeAction({'_op_type': 'delete', '_index': index, '_type': type, '_id': result['_id']}, routing))
+            if stale:
+                deleted, errors = self.bulk(stale, datasetId=datasetId)
+                logging.info('Deleted %s stale %s documents' % (deleted, type))
+        finally:
+            if identifier_map is not None:
+                identifier_map.commit()
+            self.notifyDatasetWrite(datasetId)
+
+    def updateProteinAbundances(self, datapackage, datasetId, block_size=oceanproteinportal.abundance.SAMPLE_BLOCK_SIZE, fast=True):
+        """Store each spectral count's relative abundance and NSAF next to its raw count
+
+        The protein lengths come from the FASTA resource (without one, only
+        relative abundances are computed). The protein rows are read once for
+        the per-sample totals, then once per block of block_size samples,
+        whose normalised values are set on the proteins by a stored script
+        (see oceanproteinportal.abundance).
+        """
+        index = self.getIndex()
 
-        # Get the Ontology Version
-        ontology_version = oceanproteinportal.datapackage.getDatapackageOntologyVersion(datapackage)
+        proteinResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='protein')
+        if proteinResource is None:
+            return
+
+        lengths = {}
+        fastaResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='fasta')
+        if fastaResource is not None:
+            lengths = oceanproteinportal.abundance.proteinLengths(oceanproteinportal.fasta.iterFasta(fastaResource.descriptor['path'], fast=fast))
+        else:
+            logging.warning('No FASTA resource: NSAF needs protein lengths')
+
+        def counts():
+            # Rows the protein load quarantined are skipped, not quarantined again
+            skipped = oceanproteinportal.verify.SkippedRows()
+            for row_count, row in iterResourceRows(datapackage=datapackage, resource=proteinResource, type='protein', quarantine=skipped):
+                yield row.get('proteinId', None), row.get('spectralCount:sampleId', None), row.get('spectralCount:count', None)
+
+        abundance = oceanproteinportal.abundance.SampleAbundance(lengths)
+        for proteinId, sampleId, count in counts():
+            abundance.add(proteinId, sampleId, count)
+        logging.info('Normalising %s proteins in %s samples (%s with a length)' % (len(abundance.proteinIds()), len(abundance), len(lengths)))
+
+        self.putScripts()
+        routing = self.getRouting(datasetId)
+        updated = 0
+        try:
+            for block in abundance.blocks(block_size):
+                for proteinId, sampleId, count in counts():
+                    block.add(proteinId, sampleId, count)
+
+                def abundance_updates():
+                    for proteinId, values in block.abundances():
+                        yield routeAction({
+                          '_op_type': 'update',
+                          '_index': index,
+                          '_type': 'protein',
+                          '_id': generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=proteinId),
+                          '_retry_on_conflict': 3,
+                          'script': {
+                            'stored': SET_ABUNDANCE_SCRIPT_ID,
+                            'params': {'abundance': values}
+                          }
+                        }, routing)
+
+                block_updated, errors = self.bulk(abundance_updates(), datasetId=datasetId)
+                updated += block_updated
+                logging.info('Normalised samples %s' % (block.sampleIds()))
+                for error in errors:
+                    logging.error('*** ABUNDANCE NOT UPDATED: %s' % (error))
+        finally:
+            logging.info('Updated the abundances of %s proteins (over %s sample blocks)' % (updated, int(math.ceil(len(abundance) / float(block_size)))))
+            self.notifyDatasetWrite(datasetId)
+
+    def loadProteinsFASTA(self, datapackage, datasetId, fast=True, batch_size=SEQUENCE_BATCH_SIZE):
+        """Load Proteins FASTA Data
+
+        Sequences are stored once, as 'sequence' documents keyed by the hash
+        of the cleaned sequence and shared by every dataset; the protein
+        documents only carry the sequence's hash and length (see
+        resolveSequences for the residues). Sequences already in the store
+        are not written again and, with an identifier map, proteins whose
+        sequence is unchanged are skipped.
+        fast=False parses the FASTA with Bio.SeqIO instead of the memory-mapped reader.
+        """
+        index = self.getIndex()
 
         fastaResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='fasta')
         if fastaResource is None:
             return
 
-        for record in SeqIO.parse(fastaResource.descriptor['path'], "fasta"):
-            results = es.search(
-              scroll="5s",
-              size=1,
-              body={"query":{"bool":{"must":[{"match":{"proteinId.exact": record.id}},{"match":{"_dataset": datasetId}}]}}},
-              index=index,
-              doc_type="protein",
-              filter_path=['hits.hits._id']
-            )
-            if results:
-                if results['hits']['hits']:
-                    for result in results['hits']['hits']:
-                        update = es.update(
-                          index=index,
-                          doc_type="protein",
-                          id=result['_id'],
-                          body={"doc":{"fullSequence":str(record.seq)}},
-                          _source=["fullSequence"]
-                        )
-                        logging.info(update['result'])
-            else:
-                logging.error('*** NOT FOUND: %s - %s' % (record.id, str(record.seq)))
-
-    def loadPeptides(self, datapackage, datasetId, row_start=0, row_stop=None):
-        """Load Peptide Data"""
-
-        # Get the Ontology Version
-        ontology_version = oceanproteinportal.datapackage.getDatapackageOntologyVersion(datapackage)
+        identifier_map = self.getIdentifierMap()
+        routing = self.getRouting(datasetId)
+        counts = {'proteins': 0, 'skipped': 0, 'sequences': 0}
+        # protein guid -> (record id, hash) of the updates sent, recorded in the identifier map once written
+        pending = {}
+
+        def sequence_actions():
+            records = oceanproteinportal.fasta.iterFasta(fastaResource.descriptor['path'], fast=fast)
+            for batch in oceanproteinportal.utils.batches(records, batch_size):
+                sequences = {}
+                proteins = []
+                for record_id, sequence in batch:
+                    sequence = oceanproteinportal.fasta.cleanSequence(sequence)
+                    reference = {'hash': oceanproteinportal.fasta.sequenceHash(sequence), 'length': len(sequence)}
+                    if identifier_map is not None:
+                        doc_hash = oceanproteinportal.idmap.documentHash(reference)
+                        if identifier_map.isUnchanged('proteinSequence', record_id, doc_hash):
+                            counts['skipped'] += 1
+                            continue
+                        pending[generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=record_id)] = (record_id, doc_hash)
+                    sequences[reference['hash']] = sequence
+                    proteins.append((record_id, reference))
+
+                known = self.findSequences(sequences.keys())
+                for hash, sequence in sequences.items():
+                    if hash in known:
+                        continue
+                    counts['sequences'] += 1
+                    yield routeAction({
+                      '_op_type': 'create',
+                      '_index': index,
+                      '_type': 'sequence',
+                      '_id': hash,
+                      '_source': {'hash': hash, 'length': len(sequence), 'residues': sequence}
+                    }, self.getSequenceRouting(hash))
+                for record_id, reference in proteins:
+                    counts['proteins'] += 1
+                    yield routeAction({
+                      '_op_type': 'update',
+                      '_index': index,
+                      '_type': 'protein',
+                      '_id': generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=record_id),
+                      'doc': {'sequence': reference}
+                    }, routing)
+
+        def written(result):
+            if result['_type'] == 'protein' and result['_id'] in pending:
+                record_id, doc_hash = pending.pop(result['_id'])
+                identifier_map.put('proteinSequence', record_id, guid=result['_id'], doc_hash=doc_hash)
 
+        try:
+            updated, errors = self.bulk(sequence_actions(), on_success=written if identifier_map is not None else None, datasetId=datasetId)
+            logging.info('Attached sequences to %s proteins (%s unchanged), stored %s new sequences' % (counts['proteins'], counts['skipped'], counts['sequences']))
+            for error in errors:
+                # Another ingest stored the same sequence first
+                if error.get('create', {}).get('status', None) == 409:
+                    continue
+                logging.error('*** NOT FOUND: %s' % (error))
+        finally:
+            if identifier_map is not None:
+                identifier_map.commit()
+            self.notifyDatasetWrite(datasetId)
+
+    def getSequenceRouting(self, hash):
+        """The routing of a shared sequence document: its own hash, when the store is routed"""
+        return hash if self.isRouted() else None
+
+    def findSequences(self, hashes):
+        """Return the subset of sequence hashes stored already"""
+        return set(self.__getSequences(hashes, source=False).keys())
+
+    def resolveSequences(self, hashes, batch_size=SEQUENCE_BATCH_SIZE):
+        """Get the residues of sequences by hash, as {hash: residues}, in batched lookups"""
+        hashes = list(set(hashes))
+        sequences = {}
+        for offset in range(0, len(hashes), batch_size):
+            for hash, source in self.__getSequences(hashes[offset:offset + batch_size], source=['residues']).items():
+                sequences[hash] = source['residues']
+        return sequences
+
+    def __getSequences(self, hashes, source):
+        es = self.getStore()
+        index = self.getIndex()
+        docs = []
+        for hash in hashes:
+            doc = {'_index': index, '_type': 'sequence', '_id': hash}
+            if self.isRouted():
+                doc['_routing'] = hash
+            docs.append(doc)
+        if not docs:
+            return {}
+        results = es.mget(body={'docs': docs}, _source=source)
+        return dict((doc['_id'], doc.get('_source', None)) for doc in results['docs'] if doc.get('found', False))
+
+    def loadPeptides(self, datapackage, datasetId, row_start=0, row_stop=None, rows=None):
+        """Load Peptide Data (rows limits the load to a set of row numbers)"""
         peptideResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='peptide')
         if peptideResource is None:
             return
 
-        datasetCruises = datapackageCruises(datapackage)
-        table = Table( peptideResource.descriptor['path'], schema=peptideResource.descriptor['schema'] )
-
-        if (0 < row_start):
-            logging.info("Skipping rows until # %s" % (row_start))
-
-        row_count = 0
-        data = None
-        PEPTIDE_FIELDS = getOntologyMappingFields(type='peptide', ontology_version=ontology_version)
-        for keyed_row in table.iter(keyed=True):
-            row_count += 1
-            if row_count < row_start:
-                logging.debug("Skipping Row # %s" % (row_count))
-                continue
-            if row_stop is not None and row_count > row_stop:
-                logging.info("Stopping at Row# %s" % (row_count))
-                break
-            logging.debug("Reading Row# %s" % (row_count))
-            data = readKeyedTableRow(keyed_row=keyed_row, elastic_mappings=PEPTIDE_FIELDS)
-            primaryKey = datasetId + data.get('sampleName') + data.get('proteinId') + data.get('peptideSequence')
-            data['guid'] = generateGuid( datapackage.descriptor['name'] + '_peptide_' + primaryKey )
-
-            filterSize = {}
-            minimumFilterSize = data.get('filterSize:minimum', None)
-            maximumFilterSize = data.get('filterSize:maximum', None)
-            filterSizeLabel = ''
-            if minimumFilterSize is not None:
-                del data['filterSize:minimum']
-                filterSize['minimum'] = minimumFilterSize
-                filterSizeLabel += str(minimumFilterSize)
-            if maximumFilterSize is not None:
-                del data['filterSize:maximum']
-                filterSize['maximum'] = maximumFilterSize
-                if filterSizeLabel != '':
-                    filterSizeLabel += ' - ' + str(maximumFilterSize)
-                else:
-                    filterSize += str(maximumFilterSize)
-            filterSize['label'] = filterSizeLabel
-            data['filterSize'] = filterSize
-
-            if ('coordinate:lat' in data and 'coordinate:lon' in data):
-                data['coordinate'] = {
-                  'lat': data['coordinate:lat'],
-                  'lon': data['coordinate:lon']
-                }
-                del data['coordinate:lat']
-                del data['coordinate:lon']
-
-            # load in ES
-            self.load(data=data, type='peptide', id=data['guid'])
-            logging.info(res['result'])
+        identifier_map = self.getIdentifierMap()
+        skipped = 0
+        quarantine = self.getQuarantine()
+        manifest = self.getManifest()
+        results = oceanproteinportal.logs.Counters('Peptide documents')
+        for row_count, data in iterResourceRows(datapackage=datapackage, resource=peptideResource, type='peptide', row_start=row_start, row_stop=row_stop, quarantine=quarantine, rows=rows, manifest=manifest):
+            try:
+                key = peptideKey(datasetId=datasetId, peptide=data)
+                data = buildPeptideDocument(row=data, datapackage=datapackage, datasetId=datasetId)
+
+                doc_hash = None
+                if identifier_map is not None:
+                    doc_hash = oceanproteinportal.idmap.documentHash(data)
+                    if identifier_map.isUnchanged('peptide', key, doc_hash):
+                        skipped += 1
+                        if manifest is not None:
+                            manifest.add('peptide', data)
+                        continue
+
+                # load in ES
+                result = self.load(data=data, type='peptide', id=data['guid'], datasetId=datasetId)
+                results.add(result)
+                if identifier_map is not None and result in ('created', 'updated'):
+                    identifier_map.put('peptide', key, guid=data['guid'], doc_hash=doc_hash)
+                if manifest is not None:
+                    manifest.add('peptide', data)
+            except Exception as e:
+                if quarantine is None:
+                    raise e
+                quarantine.reject('peptide', row_count, data, e)
+
+        results.flush()
+        if identifier_map is not None:
+            identifier_map.commit()
+            logging.info('Skipped %s unchanged peptides' % (skipped))
+        self.notifyDatasetWrite(datasetId)
 
     def updateProteinsWithPeptide(self, datapackage, datasetId):
         """Update Proteins with their peptides"""
+        import elasticsearch.helpers
         es = self.getStore()
         index = self.getIndex()
+        routing = self.getRouting(datasetId)
+        results = oceanproteinportal.logs.Counters('Proteins updated with peptides')
 
         for result in elasticsearch.helpers.scan(
             es,
@@ -593,7 +1228,8 @@ class ElasticStore(DataStore):
             size=20,
             query={"query":{"bool":{"must":[{"match":{"_dataset": datasetId}}]}}, "_source": ["proteinId"]},
             index=index,
-            doc_type="protein"
+            doc_type="protein",
+            routing=routing
         ):
             protein_doc_id = result['_id']
             protein_id = result['_source']['proteinId']
@@ -605,7 +1241,8 @@ class ElasticStore(DataStore):
                 size=20,
                 query={"query":{"bool":{"must":[{"match":{"identifiedProteins.exact": protein_id}},{"match":{"_dataset": datasetId}}]}}, "_source": ["peptideSequence"]},
                 index=index,
-                doc_type="peptide"
+                doc_type="peptide",
+                routing=routing
             ):
                 peptideSequence = result['_source']['peptideSequence']
                 if peptideSequence not in sequences:
@@ -613,9 +1250,8 @@ class ElasticStore(DataStore):
 
             if sequences:
                 # update the protein
-                logging.debug('Protein Doc: %s, Protein ID: %s, Sequences %s' % (protein_doc_id, protein_id, sequences))
-                res = self.load(data={"doc":{"peptideSequence":sequences}}, type='protein', id=protein_doc_id)
-                logging.info(res['result'])
+                logging.debug('Protein Doc: %s, Protein ID: %s, Sequences %s', protein_doc_id, protein_id, sequences)
+                results.add(self.update(data={"peptideSequence":sequences}, type='protein', id=protein_doc_id, datasetId=datasetId))
                 """update = es.update(
                       index=index,
                       doc_type="protein",
@@ -624,20 +1260,489 @@ class ElasticStore(DataStore):
                       _source=["peptideSequence"]
                 )
                 logging.info(update['result'])"""
+        results.flush()
+        self.notifyDatasetWrite(datasetId)
+
+    def updateProteinsWithCoverage(self, datapackage, datasetId):
+        """Update Proteins with the positions and sequence coverage of their peptides
+
+        The dataset's distinct peptide sequences are compiled into a single
+        matcher and the FASTA resource is streamed through it once.
+        """
+        import elasticsearch.helpers
+        es = self.getStore()
+        index = self.getIndex()
+
+        fastaResource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type='fasta')
+        if fastaResource is None:
+            return
+
+        routing = self.getRouting(datasetId)
+        matcher = oceanproteinportal.coverage.PeptideMatcher()
+        for result in elasticsearch.helpers.scan(
+            es,
+            scroll="2m",
+            size=1000,
+            query={"query":{"bool":{"filter":[{"term":{"_dataset": datasetId}}]}}, "_source": ["peptideSequence"]},
+            index=index,
+            doc_type="peptide",
+            routing=routing
+        ):
+            matcher.add(result['_source'].get('peptideSequence', None))
+        logging.info('Matching %s distinct peptides' % (len(matcher)))
+
+        def coverage_updates():
+            records = oceanproteinportal.fasta.iterFasta(fastaResource.descriptor['path'])
+            for proteinId, coverage in oceanproteinportal.coverage.matchProteins(matcher, records):
+                yield routeAction({
+                  '_op_type': 'update',
+                  '_index': index,
+                  '_type': 'protein',
+                  '_id': generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=proteinId),
+                  'doc': coverage
+                }, routing)
+
+        updated, errors = self.bulk(coverage_updates(), datasetId=datasetId)
+        logging.info('Updated coverage of %s proteins' % (updated))
+        for error in errors:
+            logging.error('*** COVERAGE NOT UPDATED: %s' % (error))
+        self.notifyDatasetWrite(datasetId)
+
+    def verifyDataset(self, datapackage, datasetId, resources, sample_size=oceanproteinportal.verify.SAMPLE_SIZE, seed=None):
+        """Compare a dataset in the store with the manifest of its ingest, returning a summary
+
+        resources is an IngestManifest's resources(). The protein and
+        peptide documents are counted, the sources are checked for changes
+        since the ingest, and sample_size random rows of each are rebuilt
+        into documents and diffed against the stored ones (see
+        oceanproteinportal.verify). The summary is 'valid' without
+        mismatches.
+        """
+        es = self.getStore()
+        index = self.getIndex()
+        routing = self.getRouting(datasetId)
+        summary = {'valid': True, 'counts': {}, 'samples': {}, 'mismatches': []}
+        started = time.time()
+        es.indices.refresh(index=index)
+
+        for type in ('protein', 'peptide'):
+            if type not in resources:
+                continue
+            stored = es.count(index=index, doc_type=type, body={'query': {'bool': {'filter': [{'term': {'_dataset': datasetId}}]}}}, routing=routing)['count']
+            expected = resources[type]['documents']
+            summary['counts'][type] = {'stored': stored, 'expected': expected}
+            if stored != expected:
+                summary['mismatches'].append('%s documents: %s stored, %s expected' % (type, stored, expected))
+
+        for type in oceanproteinportal.verify.changedSources(resources):
+            # Touched or copied files may still hold the rows that were loaded
+            source = resources[type]['source']
+            resource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type=type)
+            if resource is not None and not source.get('partial', False) and os.path.exists(source['path']):
+                checksum = checksumResourceRows(datapackage, resource, type, row_start=source.get('rowStart', 0), row_stop=source.get('rowStop', None))
+                if checksum == resources[type]['checksum']:
+                    logging.info('%s source changed since the ingest, but not its rows' % (type))
+                    continue
+            summary['mismatches'].append('%s source changed since the ingest' % (type))
+
+        datasetCruises = oceanproteinportal.datapackage.datapackageCruises(datapackage)
+        taxonomy = self.getTaxonomy()
+        for type in ('protein', 'peptide'):
+            resource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type=type)
+            if type not in resources or resource is None or not sample_size:
+                continue
+            # Sample the rows that were loaded
+            source = resources[type].get('source', None) or {}
+            lines = oceanproteinportal.verify.sampleLines(resource.descriptor['path'], sample_size, encoding=resource.descriptor.get('encoding', 'utf-8'), seed=seed, row_start=source.get('rowStart', 0), row_stop=source.get('rowStop', None))
+            expected = []
+            for offset, row in readSampledRows(datapackage, resource, type, lines):
+                if row is None:
+                    continue
+                if type == 'protein':
+                    document = buildProteinDocument(row=row, datasetId=datasetId, guid=generateProteinGuid(datapackage=datapackage, datasetId=datasetId, proteinId=row['proteinId']), taxonomy=taxonomy)
+                    document['spectralCount'] = buildSpectralCount(row=row, datasetCruises=datasetCruises)
+                else:
+                    document = buildPeptideDocument(row=row, datapackage=datapackage, datasetId=datasetId)
+                # Compare as stored: JSON values
+                expected.append((offset, json.loads(json.dumps(document, default=jsonDefault))))
+
+            checked = {'checked': len(expected), 'missing': 0, 'different': 0}
+            summary['samples'][type] = checked
+            if not expected:
+                continue
+            docs = []
+            for guid in set(document['guid'] for offset, document in expected):
+                doc = {'_index': index, '_type': type, '_id': guid}
+                if routing is not None:
+                    doc['_routing'] = routing
+                docs.append(doc)
+            found = dict((doc['_id'], doc['_source']) for doc in es.mget(body={'docs': docs})['docs'] if doc.get('found', False))
+
+            for offset, document in expected:
+                stored = found.get(document['guid'], None)
+                if stored is None:
+                    checked['missing'] += 1
+                    summary['mismatches'].append('%s %s (byte %s) is not stored' % (type, document['guid'], offset))
+                    continue
+                differences = []
+                if type == 'protein':
+                    # A protein has a spectral count per row
+                    spectralCount = document.pop('spectralCount')
+                    if not oceanproteinportal.verify.containsEntry(spectralCount, stored.get('spectralCount', None)):
+                        differences.append('spectralCount')
+                differences.extend(oceanproteinportal.verify.diffDocument(document, stored))
+                if differences:
+                    checked['different'] += 1
+                    summary['mismatches'].append('%s %s (byte %s) differs from its row: %s' % (type, document['guid'], offset, ', '.join(differences)))
+
+        summary['valid'] = not summary['mismatches']
+        summary['seconds'] = round(time.time() - started, 1)
+        return summary
+
+    def exportDataset(self, datasetId, directory, slices=4, size=1000, scroll='5m'):
+        """Export a dataset's documents to a tabular datapackage in a directory
+
+        Each of `slices` workers runs one slice of a sliced scroll over the
+        dataset's protein and peptide documents and streams them into its
+        own part files, which are concatenated at the end. Protein sequences
+        are resolved from the shared sequence documents.
+        """
+        import concurrent.futures
+        import elasticsearch.helpers
+        import oceanproteinportal.export
+        es = self.getStore()
+        index = self.getIndex()
+
+        routing = self.getRouting(datasetId)
+        dataset_doc = es.get(index=index, doc_type='dataset', id=datasetId, routing=routing)
+        parts_directory = os.path.join(directory, '.parts')
+        if not os.path.isdir(parts_directory):
+            os.makedirs(parts_directory)
+
+        def export_slice(slice_id):
+            writer = oceanproteinportal.export.ExportPartWriter(parts_directory, slice_id)
+            try:
+                for doc_type in ('protein', 'peptide'):
+                    query = {"query": {"bool": {"filter": [{"term": {"_dataset": datasetId}}]}}}
+                    if slices > 1:
+                        query["slice"] = {"id": slice_id, "max": slices}
+                    results = elasticsearch.helpers.scan(es, query=query, scroll=scroll, size=size, index=index, doc_type=doc_type, routing=routing)
+                    if doc_type == 'peptide':
+                        for result in results:
+                            writer.writePeptide(result['_source'])
+                        continue
+                    # Resolve the proteins' shared sequences a page at a time
+                    for batch in oceanproteinportal.utils.batches(results, size):
+                        proteins = [result['_source'] for result in batch]
+                        sequences = self.resolveSequences(protein['sequence']['hash'] for protein in proteins if protein.get('sequence', None))
+                        for protein in proteins:
+                            writer.writeProtein(protein, sequence=sequences.get((protein.get('sequence', None) or {}).get('hash', None), None))
+            finally:
+                writer.close()
+            return writer.counts
+
+        totals = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=slices) as executor:
+            for counts in executor.map(export_slice, range(slices)):
+                for key, value in counts.items():
+                    totals[key] = totals.get(key, 0) + value
+        logging.info('Exported %s: %s' % (datasetId, totals))
+
+        oceanproteinportal.export.mergeParts(directory, parts_directory, slices)
+        descriptor = oceanproteinportal.export.exportDescriptor(dataset=dataset_doc['_source'], datasetId=datasetId)
+        return oceanproteinportal.export.writeDescriptor(directory, descriptor)
+
+
+def routeAction(action, routing):
+    """Add a routing to a bulk action (when there is one)"""
+    if routing is not None:
+        action['_routing'] = routing
+    return action
+
+def iterResourceRows(datapackage, resource, type, row_start=0, row_stop=None, quarantine=None, rows=None, manifest=None):
+    """Iterate (row number, row) over a tabular resource, mapped to Elasticsearch fields
+
+    Reads the resource's compiled columns when it has been compiled (see
+    oceanproteinportal.columnar), otherwise parses it with tableschema.
+    With a quarantine (oceanproteinportal.quarantine.Quarantine) rows that
+    cannot be cast or mapped are quarantined and skipped instead of ending
+    the iteration. rows limits the iteration to a set of row numbers.
+    With a manifest (oceanproteinportal.verify.IngestManifest) the rows
+    yielded are summed into its checksum; the loaders add the rows they
+    accept to it.
+    """
+    if manifest is not None:
+        manifest.source(type, resource.descriptor['path'], row_start=row_start, row_stop=row_stop, partial=rows is not None)
+    if rows is not None:
+        rows = set(rows)
+        if not rows:
+            return
+        row_start = max(row_start, min(rows))
+        row_stop = max(rows) if row_stop is None else min(row_stop, max(rows))
+
+    # Get the Ontology Version
+    ontology_version = oceanproteinportal.datapackage.getDatapackageOntologyVersion(datapackage)
+    elastic_mappings = getOntologyMappingFields(type=type, ontology_version=ontology_version)
+    fields = {field['name']: field for field in resource.descriptor['schema']['fields']}
+
+    if (0 < row_start):
+        logging.info("Skipping rows until # %s" % (row_start))
+
+    row_count = 0
+    cast = None
+    table = compiled = oceanproteinportal.columnar.openCompiledResource(datapackage, resource)
+    if table is not None:
+        logging.info('Reading compiled resource: %s' % (resource.descriptor.get('name', None)))
+        # Compiled columns are random access, so skip straight to the first row
+        row_count = max(row_start - 1, 0)
+        table_rows = table.iter(keyed=True, start=row_count)
+    else:
+        from tableschema import Table
+        table = Table(resource.descriptor['path'], schema=resource.descriptor['schema'])
+        if quarantine is None:
+            table_rows = table.iter(keyed=True)
+        else:
+            # Cast row by row, so a bad value only costs its row
+            table_rows = table.iter(keyed=True, cast=False)
+            cast = lambda keyed_row: dict(zip(keyed_row.keys(), table.schema.cast_row(list(keyed_row.values()))))
+
+    try:
+        for keyed_row in table_rows:
+            row_count += 1
+            if row_count < row_start:
+                continue
+            if row_stop is not None and row_count > row_stop:
+                logging.info("Stopping at Row# %s" % (row_count))
+                break
+            if rows is not None and row_count not in rows:
+                continue
+            if quarantine is None:
+                row = readKeyedTableRow(fields=fields, keyed_row=keyed_row, elastic_mappings=elastic_mappings)
+                if manifest is not None:
+                    manifest.read(type, row)
+                yield row_count, row
+                continue
+
+            quarantine.count(type)
+            try:
+                if cast is not None:
+                    keyed_row = cast(keyed_row)
+                row = readKeyedTableRow(fields=fields, keyed_row=keyed_row, elastic_mappings=elastic_mappings)
+            except Exception as e:
+                quarantine.reject(type, row_count, keyed_row, e, stage='read')
+                continue
+            if manifest is not None:
+                manifest.read(type, row)
+            yield row_count, row
+    finally:
+        # Unmap the compiled columns even when the caller stops early
+        if compiled is not None:
+            compiled.close()
+
+def checksumResourceRows(datapackage, resource, type, row_start=0, row_stop=None):
+    """Re-read a resource's rows as an ingest reads them, returning their manifest checksum (hex)"""
+    manifest = oceanproteinportal.verify.IngestManifest()
+    skipped = oceanproteinportal.verify.SkippedRows()
+    for row_count, row in iterResourceRows(datapackage=datapackage, resource=resource, type=type, row_start=row_start, row_stop=row_stop, quarantine=skipped, manifest=manifest):
+        pass
+    return manifest.resources().get(type, {}).get('checksum', None)
+
+def readSampledRows(datapackage, resource, type, lines):
+    """Map (offset, values) CSV lines (see oceanproteinportal.verify.sampleLines) to rows, as (offset, row or None if invalid)"""
+    from tableschema import Schema
+    ontology_version = oceanproteinportal.datapackage.getDatapackageOntologyVersion(datapackage)
+    elastic_mappings = getOntologyMappingFields(type=type, ontology_version=ontology_version)
+    fields = {field['name']: field for field in resource.descriptor['schema']['fields']}
+    names = [field['name'] for field in resource.descriptor['schema']['fields']]
+    schema = Schema(resource.descriptor['schema'])
+    for offset, values in lines:
+        try:
+            keyed_row = dict(zip(names, schema.cast_row(values)))
+            yield offset, readKeyedTableRow(fields=fields, keyed_row=keyed_row, elastic_mappings=elastic_mappings)
+        except Exception as e:
+            logging.warning('Unreadable sampled %s row at byte %s: %s' % (type, offset, e))
+            yield offset, None
+
+def buildProteinUpsert(row, datasetId, guid, datasetCruises=None, taxonomy=None):
+    """Build the scripted upsert of a protein row: the stored script appending its spectral count, and the new document otherwise"""
+    spectralCount = buildSpectralCount(row=row, datasetCruises=datasetCruises)
+    filterSize = buildFilterSize(row)
+    upsert = buildProteinDocument(row=row, datasetId=datasetId, guid=guid, taxonomy=taxonomy)
+    upsert['spectralCount'].append(spectralCount)
+    if filterSize is not None:
+        upsert['filterSize'] = filterSize
+    return {
+      'script': {
+        'stored': APPEND_SPECTRAL_COUNT_SCRIPT_ID,
+        'params': {'spectralCount': [spectralCount], 'filterSize': filterSize}
+      },
+      'upsert': upsert
+    }
+
+def buildProteinDocument(row, datasetId, guid, taxonomy=None):
+    """Build a new ES Protein document (without spectral counts) from a protein row
+
+    With a taxonomy (oceanproteinportal.taxonomy.TaxonomyIndex) the NCBI
+    taxon's name, rank and lineage are filled in from the local index.
+    """
+    data = {
+      '_dataset': datasetId,
+      'guid': guid,
+      'proteinId': row['proteinId'],
+      'spectralCount': []
+    }
+
+    if row.get('productName', None) is not None:
+        data['productName'] = row['productName']
+    if row.get('molecularWeight', None) is not None:
+        data['molecularWeight'] = row['molecularWeight']
+    if row.get('enzymeCommId', None) is not None:
+        data['enzymeCommId'] = row['enzymeCommId']
+    if row.get('uniprotId', None) is not None:
+        data['uniprotId'] = row['uniprotId']
+    if row.get('otherIdentifiedProteins', None) is not None:
+        data['otherIdentifiedProteins'] = row['otherIdentifiedProteins']
+
+    # NCBI
+    if 'ncbi:id' in row:
+        data['ncbiTaxon'] = {
+          'id': row['ncbi:id'],
+          'name': row.get('ncbi:name', None)
+        }
+        if taxonomy is not None:
+            taxonomy.resolve(data['ncbiTaxon'])
+
+    # Kegg
+    pathway = row.get('kegg:path', None)
+    if pathway is not None:
+        if not isinstance(pathway, list):
+            pathway = [pathway]
+        kegg_pathway = []
+        for idx,path in enumerate(pathway):
+            kegg_pathway.append({'value': path, 'index': idx})
+        data['kegg'] = {
+          'id': row.get('kegg:id', None),
+          'description': row.get('kegg:desc', None),
+          'pathway': kegg_pathway
+        }
+
+    # PFams
+    if 'pfams:id' in row:
+        data['pfams'] = {
+          'id': row.get('pfams:id', None),
+          'name': row.get('pfams:name', None)
+        }
+    return data
+
+def buildPeptideDocument(row, datapackage, datasetId):
+    """Build the ES Peptide document of a peptide row (in place)"""
+    row['_dataset'] = datasetId
+    row['guid'] = generatePeptideGuid(datapackage=datapackage, datasetId=datasetId, peptide=row)
+
+    filterSize = buildFilterSize(row)
+    row.pop('filterSize:minimum', None)
+    row.pop('filterSize:maximum', None)
+    row['filterSize'] = filterSize if filterSize is not None else {'label': ''}
+
+    if ('coordinate:lat' in row and 'coordinate:lon' in row):
+        row['coordinate'] = {
+          'lat': row['coordinate:lat'],
+          'lon': row['coordinate:lon']
+        }
+        del row['coordinate:lat']
+        del row['coordinate:lon']
+    return row
+
+def buildFilterSize(row):
+    """Build the filterSize of a protein row, or None"""
+    filterSize = {}
+    minimumFilterSize = row.get('filterSize:minimum', None)
+    maximumFilterSize = row.get('filterSize:maximum', None)
+    filterSizeLabel = ''
+    if minimumFilterSize is not None:
+        filterSize['minimum'] = minimumFilterSize
+        filterSizeLabel += str(minimumFilterSize)
+    if maximumFilterSize is not None:
+        filterSize['maximum'] = maximumFilterSize
+        if filterSizeLabel != '':
+            filterSizeLabel += ' - ' + str(maximumFilterSize)
+        else:
+            filterSizeLabel += str(maximumFilterSize)
+    if filterSizeLabel == '':
+        return None
+    filterSize['label'] = filterSizeLabel
+    return filterSize
+
+def buildSpectralCountDateTime(row):
+    """The ISO observation date time of a protein row, or None"""
+    observationDateTime = None
+    if row.get('spectralCount:dateTime', None) is None and row.get('spectralCount:date', None) is None:
+        return observationDateTime
+
+    import dateutil.parser
+    if row.get('spectralCount:dateTime', None) is not None:
+        observationDateTime = dateutil.parser.parse(row['spectralCount:dateTime'])
+        observationDateTime = observationDateTime.strftime(SPECTRAL_COUNT_DATE_TIME_FORMAT)
+    elif row.get('spectralCount:date', None) is not None:
+        time = row.get('spectralCount:time', None)
+        if (time is None):
+            time = '00:00:00'
+        observationDateTime = dateutil.parser.parse(row['spectralCount:date'] + 'T' + time)
+        observationDateTime = observationDateTime.strftime(SPECTRAL_COUNT_DATE_TIME_FORMAT)
+    return observationDateTime
+
+def buildCruise(cruiseId, datasetCruises=None):
+    """Build the cruise of a spectralCount entry"""
+    cruise = {
+      'value': cruiseId,
+    }
+    if datasetCruises is not None and cruise['value'] in datasetCruises:
+        cruise['uri'] = datasetCruises[cruise['value']]['uri']
+    return cruise
+
+def buildSpectralCount(row, datasetCruises=None):
+    """Build the spectralCount entry of a protein row"""
+    spectralCount = {
+        'sampleId': row.get('spectralCount:sampleId', None),
+        'count': row.get('spectralCount:count', None),
+        'cruise': buildCruise(row.get('spectralCount:cruise', None), datasetCruises),
+        'station': row.get('spectralCount:station', None),
+        'depth': row.get('spectralCount:depth', None),
+        # fix ISO DateTime
+        'dateTime': buildSpectralCountDateTime(row),
+    }
+    if (row.get('spectralCount:coordinate:lat', None) is not None and row.get('spectralCount:coordinate:lon', None) is not None):
+        spectralCount['coordinate'] = {
+          'lat': row['spectralCount:coordinate:lat'],
+          'lon': row['spectralCount:coordinate:lon']
+        }
+    return spectralCount
+
+def generateProteinGuid(datapackage, datasetId, proteinId):
+    """Generate the GUID of a dataset's protein document"""
+    return oceanproteinportal.utils.generateGuid( datapackage.descriptor['name'] + '_protein_' + datasetId + ':' + proteinId )
+
+def peptideKey(datasetId, peptide):
+    """The key identifying a peptide row: its dataset, sample, protein and sequence"""
+    return datasetId + peptide.get('sampleName') + peptide.get('proteinId') + peptide.get('peptideSequence')
 
+def generatePeptideGuid(datapackage, datasetId, peptide):
+    """Generate the GUID of a dataset's peptide document from its sample, protein and sequence"""
+    primaryKey = peptideKey(datasetId=datasetId, peptide=peptide)
+    return oceanproteinportal.utils.generateGuid( datapackage.descriptor['name'] + '_peptide_' + primaryKey )
 
-def readKeyedTableRow(keyed_row, elastic_mappings):
-    """Process a keyed table row"""
+def readKeyedTableRow(fields, keyed_row, elastic_mappings):
+    """Process a keyed table row, given the schema field descriptors by name"""
     row = {}
     for field_name, field_value in keyed_row.items():
-        field = table.schema.get_field(field_name)
+        field = fields.get(field_name, None)
         if (None is field or
-          'rdfType' not in field.descriptor or
-          field.descriptor['rdfType'] not in elastic_mappings):
+          'rdfType' not in field or
+          field['rdfType'] not in elastic_mappings):
               continue
 
-        field_type = elastic_mappings[field.descriptor['rdfType']]
-        processed_value = oceanproteinportal.datapackage.processField(value=field_value, descriptor=field.descriptor, field_type=field.descriptor['rdfType'])
+        field_type = elastic_mappings[field['rdfType']]
+        processed_value = oceanproteinportal.datapackage.processField(value=field_value, descriptor=field, field_type=field['rdfType'])
 
         # handle ES arrays
         if field_type not in row:
@@ -649,17 +1754,14 @@ def readKeyedTableRow(keyed_row, elastic_mappings):
             row[field_type] = [existing_data_value, processed_value]
     return row
 
-def getOntologyMappingFields(config_file='config/ontology_elasticsearch_mappings.yaml', type, ontology_version)
+def getOntologyMappingFields(type, ontology_version, config_file='config/ontology_elasticsearch_mappings.yaml'):
     """Read how the ontology maps to Elasticsearch."""
+    import yaml
     # Read the configuration
     with open(config_file, 'r') as yamlfile:
-        mappings = yaml.load(yamlfile)
+        mappings = yaml.safe_load(yamlfile)
     return mappings[ontology_version][type]
 
 def elasticDatatypeHandler(obj):
-    """Datatype Handler for Elasticsearch"""
-    if isinstance(obj, decimal.Decimal):
-        return float(obj)
-    elif isinstance(obj, datetime.datetime):
-        return obj.isoformat()
-    return json.JSONEncoder.default(json.JSONEncoder, obj)
+    """Datatype Handler for Elasticsearch (json.dumps default)"""
+    return jsonDefault(obj)
@@ -0,0 +1,198 @@
+import copy
+import logging
+import math
+"""
+Generate the Elasticsearch index for the OceanProteinPortal.
+
+The index body starts from the hand-maintained schema, takes the types of the
+fields named in the ontology-to-Elasticsearch mappings from the data
+template, and is then tuned for how the portal queries it: fields that are
+only ever read back from _source are neither indexed nor given doc_values,
+keyword fields used in terms aggregations load their global ordinals eagerly
+and the shard count follows the expected number of documents. Index sorting
+would need Elasticsearch 6, which only allows one mapping type per index.
+"""
+
+# Table Schema type -> Elasticsearch type
+ELASTIC_TYPES = {
+  'integer': 'long',
+  'number': 'float',
+  'boolean': 'boolean',
+  'date': 'date',
+  'datetime': 'date',
+  'time': 'keyword',
+  'string': 'keyword',
+}
+# Ontology mapping fields whose document path is not just ':' -> '.' (None: not stored as is)
+DOCUMENT_PATHS = {
+  'ncbi:id': 'ncbiTaxon.id',
+  'ncbi:name': 'ncbiTaxon.name',
+  'kegg:path': 'kegg.pathway.value',
+  'kegg:desc': 'kegg.description',
+  'spectralCount:date': None,
+  'spectralCount:time': None,
+  'spectralCount:dateTime': 'spectralCount.dateTime',
+}
+# Keyword fields used in terms aggregations (sub-fields included). Elasticsearch 5 needs a
+# field shared by several mapping types to be mapped alike in each, so these and the
+# unsearched fields are tuned in every type that has them.
+AGGREGATED_FIELDS = [
+  '_dataset', 'filterSize.label', 'spectralCount.cruise.value.exact', 'spectralCount.station', 'ncbiTaxon.id', 'ncbiTaxon.name.exact', 'kegg.pathway.value',
+  'kind', 'sampleId', 'key',
+]
+# Fields only ever read back from _source
+UNSEARCHED_FIELDS = [
+  'kegg.pathway.index', 'peptideMatches.start', 'peptideMatches.stop', 'spectralCount.cruise.uri',
+  'absoluteUnits_fmol-L', 'bestPeptideIdProb', 'bestSequestDCnScore', 'bestSequestXCorrScore', 'medianRetentionTime', 'plus2HspectraCount', 'plus3HspectraCount', 'plus4HspectraCount', 'proteinMolecularWeight', 'totalPrecursorIntensity', 'totalTIC',
+  'homepage', 'contributors.orcid', 'contributors.uri',
+  'residues', 'samples', 'proteins', 'count', 'offset', 'proteinIds', 'hashes',
+]
+# Mapping types holding properties
+OBJECT_TYPES = ('object', 'nested')
+# Aim for shards of about this many documents
+DOCUMENTS_PER_SHARD = 20000000
+MAX_SHARDS = 32
+
+def documentPath(field):
+    """The document path of an ontology mapping field, e.g. spectralCount:depth -> spectralCount.depth"""
+    if field in DOCUMENT_PATHS:
+        return DOCUMENT_PATHS[field]
+    return field.replace(':', '.')
+
+def className(rdf_class):
+    """The local name of an ontology class, e.g. http://ocean-data.org/schema/data-type/v1.0/DepthMeters -> DepthMeters"""
+    return rdf_class.rstrip('/').rsplit('/', 1)[-1].rsplit('#', 1)[-1]
+
+def findProperty(properties, path, create=False):
+    """Find the mapping of a dotted path (including multi-fields), optionally creating objects on the way"""
+    names = path.split('.')
+    mapping = None
+    for position, name in enumerate(names):
+        last = position == len(names) - 1
+        # A multi-field, e.g. name.exact
+        if mapping is not None and last and name in mapping.get('fields', {}):
+            return mapping['fields'][name]
+        if mapping is not None:
+            if mapping.get('type', 'object') not in OBJECT_TYPES:
+                # A leaf (e.g. a geo_point) has no sub-properties to find or create
+                return None
+            if 'properties' not in mapping:
+                if not create:
+                    return None
+                mapping['properties'] = {}
+            properties = mapping['properties']
+        if name not in properties:
+            if not create:
+                return None
+            properties[name] = {}
+        mapping = properties[name]
+    return mapping
+
+def deriveFieldTypes(mappings, template_mappings, elastic_mappings):
+    """Set the types of the fields named by the ontology mappings from the data template's column types"""
+    for doc_type, classes in elastic_mappings.items():
+        if doc_type not in mappings or not classes:
+            continue
+        column_types = {}
+        for column, column_mapping in template_mappings.get(doc_type, {}).items():
+            if column_mapping.get('class', None) is not None:
+                column_types[className(column_mapping['class'])] = column_mapping.get('type', 'string')
+        properties = mappings[doc_type].setdefault('properties', {})
+        for rdf_class, field in classes.items():
+            # The template names classes by their local name, the Elasticsearch mappings by URI
+            rdf_class = className(rdf_class)
+            if not field or rdf_class not in column_types:
+                continue
+            path = documentPath(field)
+            if path is None:
+                continue
+            elastic_type = ELASTIC_TYPES.get(column_types[rdf_class], 'keyword')
+            mapping = findProperty(properties, path, create=True)
+            if mapping is None or 'properties' in mapping:
+                # Inside a leaf such as spectralCount.coordinate, or an object such as spectralCount.cruise
+                continue
+            current = mapping.get('type', None)
+            if current is None:
+                mapping['type'] = elastic_type
+            elif current != elastic_type and elastic_type != 'keyword' and current not in ('geo_point', 'nested'):
+                # Strings keep the schema's text/keyword choice; other types follow the template
+                logging.info('%s.%s: %s -> %s' % (doc_type, path, current, elastic_type))
+                mapping['type'] = elastic_type
+                mapping.pop('fields', None)
+
+def tuneFieldUsage(mappings):
+    """Drop indexes from unsearched fields and eagerly load ordinals of aggregated ones, in every type having them"""
+    for doc_type in mappings.values():
+        properties = doc_type.get('properties', {})
+        for path in UNSEARCHED_FIELDS:
+            mapping = findProperty(properties, path)
+            if mapping is None or mapping.get('type', None) in (None, 'nested', 'object', 'geo_point'):
+                continue
+            mapping['index'] = False
+            mapping.pop('fields', None)
+            if mapping['type'] != 'text':
+                mapping['doc_values'] = False
+        for path in AGGREGATED_FIELDS:
+            mapping = findProperty(properties, path)
+            if mapping is not None and mapping.get('type', None) == 'keyword':
+                mapping['eager_global_ordinals'] = True
+
+def fieldMappings(properties, prefix=''):
+    """Yield (path, mapping) of every field of a mapping type, objects as just their type"""
+    for name, mapping in properties.items():
+        path = prefix + name
+        if 'properties' in mapping:
+            yield path, {'type': mapping.get('type', 'object')}
+            for field in fieldMappings(mapping['properties'], path + '.'):
+                yield field
+        else:
+            yield path, mapping
+
+def conflictingFields(mappings):
+    """The field paths some mapping types map differently, which Elasticsearch 5 rejects in one index"""
+    found = {}
+    conflicts = set()
+    for doc_type in mappings.values():
+        for path, mapping in fieldMappings(doc_type.get('properties', {})):
+            if path not in found:
+                found[path] = mapping
+            elif found[path] != mapping:
+                conflicts.add(path)
+    return sorted(conflicts)
+
+def shardCount(expected_documents=None):
+    """Pick a shard count from the number of documents expected in the index"""
+    if not expected_documents:
+        return 1
+    return max(1, min(MAX_SHARDS, int(math.ceil(float(expected_documents) / DOCUMENTS_PER_SHARD))))
+
+def generateIndexBody(schema, template_mappings, elastic_mappings, expected_documents=None, routing_required=False, routing_partition_size=None):
+    """Generate the body that creates the index from a base schema and the ontology mappings.
+
+    template_mappings and elastic_mappings are the ontology version's entries
+    of the template and Elasticsearch mapping configs. routing_partition_size
+    spreads each routing value (dataset) over that many shards. Raises if a
+    field is mapped differently by several mapping types.
+    """
+    body = copy.deepcopy(schema)
+    mappings = body.setdefault('mappings', {})
+    deriveFieldTypes(mappings, template_mappings, elastic_mappings)
+    tuneFieldUsage(mappings)
+    conflicts = conflictingFields(mappings)
+    if conflicts:
+        raise Exception('Fields mapped differently by several mapping types: %s' % (', '.join(conflicts)))
+    if routing_required or routing_partition_size:
+        for doc_type in mappings.values():
+            doc_type['_routing'] = {'required': True}
+
+    settings = body.setdefault('settings', {}).setdefault('index', {})
+    settings['number_of_shards'] = shardCount(expected_documents)
+    if routing_partition_size:
+        # A partition must be smaller than the index
+        settings['number_of_shards'] = max(settings['number_of_shards'], routing_partition_size + 1)
+        settings['routing_partition_size'] = routing_partition_size
+    return body
+
+def estimateDocuments(datapackage):
+    """Estimate the documents a datapackage adds from its resources' inferred row counts"""
+    return sum(resource.descriptor.get('opp:rowCount', 0) for resource in datapackage.resources)
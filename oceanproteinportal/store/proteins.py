@@ -0,0 +1,204 @@
+import array
+import math
+from .elasticsearch import buildCruise, buildFilterSize, buildProteinDocument, buildSpectralCountDateTime
+"""
+Group protein rows in memory before they are written to the store.
+
+A dataset's protein table repeats each protein once per sample. Grouping
+keeps one GroupedProtein per proteinId whose spectral counts are parallel
+typed arrays (count, depth, latitude, longitude) plus interned ids for the
+sample, station, cruise and observation time, about 48 bytes per row
+instead of a dict of dicts. The Elasticsearch document shape is only built
+when a protein is serialised. To bound memory the grouped proteins can be
+spilled (written out and dropped) part way; their later rows are grouped
+again and appended to what was written. As with the appending script, a
+protein keeps the first count of each sample, in memory or across spills.
+"""
+
+MISSING = float('nan')
+
+class StringTable:
+    """Intern strings (sample, station and cruise ids, date times) as small integers; 0 is None"""
+
+    __slots__ = ('__ids', '__values')
+
+    def __init__(self):
+        self.__ids = {}
+        self.__values = [None]
+
+    def __len__(self):
+        return len(self.__values) - 1
+
+    def id(self, value):
+        if value is None:
+            return 0
+        found = self.__ids.get(value, None)
+        if found is None:
+            found = len(self.__values)
+            self.__ids[value] = found
+            self.__values.append(value)
+        return found
+
+    def value(self, id):
+        return self.__values[id]
+
+
+def _number(value):
+    return MISSING if value is None else float(value)
+
+def _value(number):
+    return None if math.isnan(number) else number
+
+def _count(number, integer):
+    if math.isnan(number):
+        return None
+    return int(number) if integer else number
+
+
+class SpectralCounts:
+    """The spectral counts of a protein as parallel typed arrays"""
+
+    __slots__ = ('counts', 'depths', 'lats', 'lons', 'samples', 'stations', 'cruises', 'dateTimes', 'integerCounts')
+
+    def __init__(self):
+        self.counts = array.array('d')
+        self.depths = array.array('d')
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self.samples = array.array('I')
+        self.stations = array.array('I')
+        self.cruises = array.array('I')
+        self.dateTimes = array.array('I')
+        # Integer counts are written back as integers
+        self.integerCounts = True
+
+    def __len__(self):
+        return len(self.counts)
+
+    def append(self, count, depth, lat, lon, sample, station, cruise, dateTime):
+        """Append a count; sample, station, cruise and dateTime are StringTable ids"""
+        if count is not None and not isinstance(count, int):
+            self.integerCounts = False
+        self.counts.append(_number(count))
+        self.depths.append(_number(depth))
+        self.lats.append(_number(lat))
+        self.lons.append(_number(lon))
+        self.samples.append(sample)
+        self.stations.append(station)
+        self.cruises.append(cruise)
+        self.dateTimes.append(dateTime)
+
+    def expand(self, strings, datasetCruises=None):
+        """Build the spectralCount entries of the Elasticsearch document"""
+        spectralCount = []
+        for position in range(len(self.counts)):
+            entry = {
+              'sampleId': strings.value(self.samples[position]),
+              'count': _count(self.counts[position], self.integerCounts),
+              'cruise': buildCruise(strings.value(self.cruises[position]), datasetCruises),
+              'station': strings.value(self.stations[position]),
+              'depth': _value(self.depths[position]),
+              'dateTime': strings.value(self.dateTimes[position]),
+            }
+            lat = _value(self.lats[position])
+            lon = _value(self.lons[position])
+            if lat is not None and lon is not None:
+                entry['coordinate'] = {'lat': lat, 'lon': lon}
+            spectralCount.append(entry)
+        return spectralCount
+
+
+class GroupedProtein:
+    """A protein's document fields plus its compact spectral counts"""
+
+    __slots__ = ('document', 'spectralCounts')
+
+    def __init__(self, document):
+        # buildProteinDocument's fields, without the spectralCount list
+        document.pop('spectralCount', None)
+        self.document = document
+        self.spectralCounts = SpectralCounts()
+
+    def toDocument(self, strings, datasetCruises=None):
+        """Expand into the Elasticsearch protein document"""
+        document = dict(self.document)
+        document['spectralCount'] = self.spectralCounts.expand(strings, datasetCruises)
+        return document
+
+
+class ProteinGrouper:
+    """Group mapped protein rows (see iterResourceRows) by proteinId"""
+
+    def __init__(self, datasetId, generateGuid, datasetCruises=None, taxonomy=None, append=False):
+        """append reports every protein as spilled before, for loads of part of a dataset's rows"""
+        self.__append = append
+        self.__datasetId = datasetId
+        self.__generateGuid = generateGuid
+        self.__datasetCruises = datasetCruises
+        self.__taxonomy = taxonomy
+        self.__strings = StringTable()
+        self.__proteins = {}
+        # proteinIds spilled already, whose later rows are appended
+        self.__spilled = set()
+        # Raw date/time columns -> interned ISO date time, parsed once
+        self.__dateTimes = {}
+        self.rows = 0
+        # Rows repeating a sample of their protein, skipped
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.__proteins)
+
+    def add(self, row):
+        """Add a protein row"""
+        proteinId = row['proteinId']
+        protein = self.__proteins.get(proteinId, None)
+        if protein is None:
+            document = buildProteinDocument(row=row, datasetId=self.__datasetId, guid=self.__generateGuid(proteinId), taxonomy=self.__taxonomy)
+            protein = GroupedProtein(document)
+            self.__proteins[proteinId] = protein
+
+        filterSize = buildFilterSize(row)
+        if filterSize is not None:
+            protein.document['filterSize'] = filterSize
+
+        raw_date_time = (row.get('spectralCount:dateTime', None), row.get('spectralCount:date', None), row.get('spectralCount:time', None))
+        dateTime = self.__dateTimes.get(raw_date_time, None)
+        if dateTime is None:
+            dateTime = self.__strings.id(buildSpectralCountDateTime(row))
+            self.__dateTimes[raw_date_time] = dateTime
+
+        strings = self.__strings
+        sample = strings.id(row.get('spectralCount:sampleId', None))
+        if sample in protein.spectralCounts.samples:
+            self.duplicates += 1
+            return
+        protein.spectralCounts.append(
+          count=row.get('spectralCount:count', None),
+          depth=row.get('spectralCount:depth', None),
+          lat=row.get('spectralCount:coordinate:lat', None),
+          lon=row.get('spectralCount:coordinate:lon', None),
+          sample=sample,
+          station=strings.id(row.get('spectralCount:station', None)),
+          cruise=strings.id(row.get('spectralCount:cruise', None)),
+          dateTime=dateTime
+        )
+        self.rows += 1
+
+    def proteinIds(self):
+        """The grouped proteinIds"""
+        return self.__proteins.keys()
+
+    def documents(self):
+        """Yield (proteinId, Elasticsearch document), expanding one protein at a time"""
+        for proteinId, protein in self.__proteins.items():
+            yield proteinId, protein.toDocument(self.__strings, self.__datasetCruises)
+
+    def spill(self):
+        """Yield (proteinId, document, spilled before) for the grouped proteins, dropping each once yielded"""
+        while self.__proteins:
+            proteinId = next(iter(self.__proteins))
+            protein = self.__proteins.pop(proteinId)
+            spilled = self.__append or proteinId in self.__spilled
+            self.__spilled.add(proteinId)
+            yield proteinId, protein.toDocument(self.__strings, self.__datasetCruises), spilled
@@ -0,0 +1,292 @@
+import logging
+import oceanproteinportal.fasta
+import oceanproteinportal.kmers
+import oceanproteinportal.utils
+"""
+Read-side lookups against an ElasticStore for the Ocean Protein Portal
+"""
+
+DEFAULT_PAGE_SIZE = 100
+PROTEIN_SUMMARY_FIELDS = ['guid', '_dataset', 'proteinId', 'productName', 'ncbiTaxon', 'kegg', 'uniprotId', 'enzymeCommId']
+PEPTIDE_SUMMARY_FIELDS = ['guid', '_dataset', 'peptideSequence', 'proteinId', 'identifiedProteins', 'sampleId', 'spectralCountSum']
+SEARCH_FILTER_PATH = ['hits.hits._source', 'hits.hits.sort']
+
+class ElasticQuery:
+    """Common portal lookups on top of an ElasticStore.
+
+    Documents are fetched with `_source` and `filter_path` pruning, listings
+    are paged with `search_after` rather than deep from/size, and dataset
+    metadata and proteins fetched by guid are kept in an LRU+TTL cache that
+    is invalidated whenever the store writes to the owning dataset (and
+    trimmed while the store's memory budget is exceeded).
+    """
+
+    __store = None
+    __cache = None
+
+    def __init__(self, store, cache_size=1024, cache_ttl=300):
+        self.__store = store
+        self.__cache = oceanproteinportal.utils.LRUCache(maxsize=cache_size, ttl=cache_ttl, budget=store.getMemoryBudget())
+        store.addWriteListener(self.invalidateDataset)
+
+    def getStore(self):
+        """Return the ElasticStore being queried"""
+        return self.__store
+
+    def getCache(self):
+        """Return the result cache"""
+        return self.__cache
+
+    def invalidateDataset(self, datasetId):
+        """Drop every cached result belonging to a dataset"""
+        removed = self.__cache.invalidate(datasetId)
+        logging.debug('Invalidated %s cached results for dataset %s' % (removed, datasetId))
+
+    def getDataset(self, datasetId):
+        """Get a dataset's metadata document (cached)"""
+        key = ('dataset', datasetId)
+        dataset = self.__cache.get(key)
+        if dataset is None:
+            dataset = self._getSource(type='dataset', id=datasetId, datasetId=datasetId)
+            if dataset is not None:
+                self.__cache.set(key, dataset, tag=datasetId)
+        return dataset
+
+    def getDatasetSummary(self, datasetId):
+        """Summarize a dataset: its metadata plus protein and peptide counts"""
+        dataset = self.getDataset(datasetId)
+        if dataset is None:
+            return None
+
+        key = ('dataset-summary', datasetId)
+        summary = self.__cache.get(key)
+        if summary is None:
+            summary = {
+              'guid': datasetId,
+              'name': dataset.get('name', None),
+              'version': dataset.get('version', None),
+              'depth_stats': dataset.get('depth_stats', None),
+              'filterSize': dataset.get('filterSize', None),
+              'cruises': dataset.get('cruises', None),
+              'proteins': self._count(type='protein', query=datasetQuery(datasetId), datasetId=datasetId),
+              'peptides': self._count(type='peptide', query=datasetQuery(datasetId), datasetId=datasetId)
+            }
+            self.__cache.set(key, summary, tag=datasetId)
+        return summary
+
+    def getProtein(self, guid, fields=None, datasetId=None):
+        """Get a protein document by its guid (cached)
+
+        Pass the protein's datasetId when the store routes by dataset,
+        otherwise the lookup has to search every shard.
+        """
+        key = ('protein', guid, tuple(fields) if fields is not None else None)
+        protein = self.__cache.get(key)
+        if protein is None:
+            # The cached protein is tagged with its dataset, so fetch _dataset too
+            source_fields = fields
+            if fields is not None and '_dataset' not in fields:
+                source_fields = list(fields) + ['_dataset']
+            protein = self._getSource(type='protein', id=guid, fields=source_fields, datasetId=datasetId)
+            if protein is not None:
+                tag = protein.get('_dataset', None) or datasetId
+                if source_fields is not fields:
+                    protein.pop('_dataset', None)
+                self.__cache.set(key, protein, tag=tag)
+        return protein
+
+    def getProteinByProteinId(self, datasetId, proteinId, fields=None):
+        """Get a dataset's protein document by its proteinId"""
+        query = datasetQuery(datasetId, {'term': {'proteinId.exact': proteinId}})
+        for protein in self._searchAfter(type='protein', query=query, fields=fields, page_size=1, datasetId=datasetId):
+            return protein
+        return None
+
+    def findProteinsByTaxon(self, taxonId, datasetId=None, fields=PROTEIN_SUMMARY_FIELDS, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate the proteins assigned to an NCBI taxon"""
+        query = datasetQuery(datasetId, {
+          'nested': {
+            'path': 'ncbiTaxon',
+            'query': {'term': {'ncbiTaxon.id': taxonId}}
+          }
+        })
+        return self._searchAfter(type='protein', query=query, fields=fields, page_size=page_size, datasetId=datasetId)
+
+    def findProteinsByKeggPathway(self, pathway, datasetId=None, fields=PROTEIN_SUMMARY_FIELDS, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate the proteins on a KEGG pathway"""
+        query = datasetQuery(datasetId, {
+          'nested': {
+            'path': 'kegg',
+            'query': {'term': {'kegg.pathway.value': pathway}}
+          }
+        })
+        return self._searchAfter(type='protein', query=query, fields=fields, page_size=page_size, datasetId=datasetId)
+
+    def findRollups(self, datasetId, kind, sampleId=None, key=None, fields=None, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate a dataset's precomputed 'taxon' or 'pathway' abundance rollups"""
+        clauses = [{'term': {'kind': kind}}]
+        if sampleId is not None:
+            clauses.append({'term': {'sampleId': sampleId}})
+        if key is not None:
+            clauses.append({'term': {'key': key}})
+        query = datasetQuery(datasetId, *clauses)
+        return self._searchAfter(type='rollup', query=query, fields=fields, page_size=page_size, datasetId=datasetId)
+
+    def findTiles(self, precision, top_left=None, bottom_right=None, datasetId=None, fields=None, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate the precomputed station map tiles of a geohash precision, optionally within a bounding box
+
+        top_left and bottom_right are {'lat', 'lon'} corners of the map view.
+        """
+        clauses = [{'term': {'precision': precision}}]
+        if top_left is not None and bottom_right is not None:
+            clauses.append({'geo_bounding_box': {'location': {'top_left': top_left, 'bottom_right': bottom_right}}})
+        query = datasetQuery(datasetId, *clauses)
+        return self._searchAfter(type='tile', query=query, fields=fields, page_size=page_size, datasetId=datasetId)
+
+    def findPeptidesBySequence(self, sequence, datasetId=None, fields=PEPTIDE_SUMMARY_FIELDS, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate the peptides with an exact sequence"""
+        query = datasetQuery(datasetId, {'term': {'peptideSequence': sequence}})
+        return self._searchAfter(type='peptide', query=query, fields=fields, page_size=page_size, datasetId=datasetId)
+
+    def findProteinsByMotif(self, motif, datasetId):
+        """The proteinIds of a dataset (in FASTA order) whose sequences contain a peptide motif
+
+        Intersects the stored postings of the motif's k-mers, then checks the
+        candidates' residues (see oceanproteinportal.kmers). Postings and
+        protein table blocks are cached until the dataset is written.
+        """
+        motif = oceanproteinportal.fasta.cleanSequence(motif)
+        kmers = oceanproteinportal.kmers.queryKmers(motif)
+        if not kmers:
+            raise Exception('Motifs need at least %s residues: %s' % (min(oceanproteinportal.kmers.KMER_LENGTHS), motif))
+
+        postings = self._getKmerDocuments(datasetId, [('kmer', kmer) for kmer in kmers])
+        if len(postings) < len(kmers):
+            return []
+        candidates = oceanproteinportal.kmers.intersect(postings.values())
+        if not candidates:
+            return []
+
+        table_size = oceanproteinportal.kmers.PROTEIN_TABLE_SIZE
+        tables = self._getKmerDocuments(datasetId, [('proteins', block) for block in sorted(set(ordinal // table_size for ordinal in candidates))])
+        proteins = []
+        for ordinal in candidates:
+            table = tables.get(('proteins', ordinal // table_size), None)
+            if table is not None:
+                proteins.append((table['proteinIds'][ordinal % table_size], table['hashes'][ordinal % table_size]))
+        if len(motif) == len(kmers[0]):
+            # The motif is a k-mer itself: nothing left to verify
+            return [proteinId for proteinId, hash in proteins]
+        sequences = self.getSequences(hash for proteinId, hash in proteins)
+        return [proteinId for proteinId, hash in proteins if motif in sequences.get(hash, '')]
+
+    def _getKmerDocuments(self, datasetId, keys):
+        """Get a dataset's k-mer postings and protein table blocks by ('kmer', kmer) and ('proteins', block) keys (cached)"""
+        found = {}
+        missing = {}
+        for key in keys:
+            cached = self.__cache.get(('kmer', datasetId) + key)
+            if cached is not None:
+                found[key] = cached
+            elif key[0] == 'kmer':
+                missing[oceanproteinportal.kmers.kmerGuid(datasetId, key[1])] = key
+            else:
+                missing[oceanproteinportal.kmers.proteinTableGuid(datasetId, key[1])] = key
+        if not missing:
+            return found
+
+        es = self.__store.getStore()
+        index = self.__store.getIndex()
+        routing = self.__store.getRouting(datasetId)
+        docs = []
+        for guid in missing:
+            doc = {'_index': index, '_type': 'kmer', '_id': guid}
+            if routing is not None:
+                doc['_routing'] = routing
+            docs.append(doc)
+        results = es.mget(body={'docs': docs}, _source=['postings', 'proteinIds', 'hashes'])
+        for doc in results['docs']:
+            if not doc.get('found', False):
+                continue
+            key = missing[doc['_id']]
+            if key[0] == 'kmer':
+                value = oceanproteinportal.kmers.decodePostings(doc['_source']['postings'])
+            else:
+                value = doc['_source']
+            self.__cache.set(('kmer', datasetId) + key, value, tag=datasetId)
+            found[key] = value
+        return found
+
+    def getSequences(self, hashes):
+        """Get protein residues by sequence hash (a protein's sequence.hash), as {hash: residues}
+
+        Sequences never change once stored, so they are cached untagged.
+        """
+        sequences = {}
+        missing = []
+        for hash in set(hashes):
+            residues = self.__cache.get(('sequence', hash))
+            if residues is None:
+                missing.append(hash)
+            else:
+                sequences[hash] = residues
+        for hash, residues in self.__store.resolveSequences(missing).items():
+            self.__cache.set(('sequence', hash), residues)
+            sequences[hash] = residues
+        return sequences
+
+    def _getSource(self, type, id, fields=None, datasetId=None):
+        """Get a document's _source, or None if it does not exist"""
+        routing = self.__store.getRouting(datasetId)
+        if routing is None and self.__store.isRouted():
+            # Routed by an unknown dataset: look the id up on every shard
+            for source in self._searchAfter(type=type, query={'ids': {'values': [id]}}, fields=fields, page_size=1):
+                return source
+            return None
+
+        import elasticsearch
+        es = self.__store.getStore()
+        params = {}
+        if fields is not None:
+            params['_source_include'] = fields
+        try:
+            res = es.get(index=self.__store.getIndex(), doc_type=type, id=id, routing=routing, **params)
+        except elasticsearch.exceptions.NotFoundError:
+            return None
+        return res['_source']
+
+    def _count(self, type, query, datasetId=None):
+        """Count the documents matching a query (on the dataset's shard)"""
+        es = self.__store.getStore()
+        res = es.count(index=self.__store.getIndex(), doc_type=type, body={'query': query}, routing=self.__store.getRouting(datasetId))
+        return res['count']
+
+    def _searchAfter(self, type, query, fields=None, page_size=DEFAULT_PAGE_SIZE, sort_field='guid', datasetId=None):
+        """Page through a query's hits with search_after, yielding each _source"""
+        es = self.__store.getStore()
+        index = self.__store.getIndex()
+        routing = self.__store.getRouting(datasetId)
+        body = {
+          'size': page_size,
+          'query': query,
+          'sort': [{sort_field: 'asc'}]
+        }
+        if fields is not None:
+            body['_source'] = fields
+
+        while True:
+            res = es.search(index=index, doc_type=type, body=body, filter_path=SEARCH_FILTER_PATH, routing=routing)
+            hits = res.get('hits', {}).get('hits', [])
+            for hit in hits:
+                yield hit.get('_source', {})
+            if len(hits) < page_size:
+                return
+            body['search_after'] = hits[-1]['sort']
+
+
+def datasetQuery(datasetId, *clauses):
+    """Build a non-scoring bool query, optionally restricted to a dataset"""
+    filters = list(clauses)
+    if datasetId is not None:
+        filters.append({'term': {'_dataset': datasetId}})
+    return {'bool': {'filter': filters}}
@@ -0,0 +1,145 @@
+import datetime
+import decimal
+import json
+"""
+JSON serialisation for the OceanProteinPortal stores.
+
+JSONSerializer encodes documents to UTF-8 bytes with orjson or ujson when
+they are installed and the standard library otherwise, handling Decimal
+and datetime values. ElasticSerializer plugs it into the Elasticsearch
+client's transport, and BulkBuffer encodes bulk actions straight into one
+reused bytes buffer.
+"""
+
+# In order of preference
+SERIALIZERS = ('orjson', 'ujson', 'json')
+# Flush a bulk buffer after this many actions or bytes
+BULK_CHUNK_ACTIONS = 500
+BULK_CHUNK_BYTES = 10 * 1024 * 1024
+# Bulk action metadata, as elasticsearch.helpers.expand_action reads it
+BULK_META_FIELDS = ('_index', '_type', '_id', '_routing', '_parent', '_version', '_version_type', '_retry_on_conflict')
+
+def jsonDefault(obj):
+    """Serialise the values JSON has no type for"""
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError('%s is not JSON serializable' % (type(obj).__name__))
+
+
+class JSONSerializer:
+    """Encode to / decode from UTF-8 JSON with orjson, ujson (5+) or the json module"""
+
+    def __init__(self, name=None):
+        names = SERIALIZERS if name is None else (name,)
+        for candidate in names:
+            if candidate == 'json':
+                self.name = 'json'
+                self.dumps = self.__dumpsJson
+                self.loads = json.loads
+                return
+            try:
+                module = __import__(candidate)
+            except ImportError:
+                continue
+            self.name = candidate
+            self.__module = module
+            self.dumps = self.__dumpsOrjson if candidate == 'orjson' else self.__dumpsUjson
+            self.loads = module.loads
+            return
+        raise Exception('JSON serializer not available: %s' % (name))
+
+    def __dumpsOrjson(self, obj):
+        # Keys such as integer sampleIds become strings, as with json and ujson
+        return self.__module.dumps(obj, default=jsonDefault, option=self.__module.OPT_NON_STR_KEYS)
+
+    def __dumpsUjson(self, obj):
+        return self.__module.dumps(obj, default=jsonDefault, ensure_ascii=False).encode('utf-8')
+
+    def __dumpsJson(self, obj):
+        return json.dumps(obj, default=jsonDefault, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ElasticSerializer:
+    """An Elasticsearch transport serializer backed by a JSONSerializer.
+
+    Bodies that are already encoded pass through. The bulk helpers of the
+    5.x client join lines as str, so other bodies are returned as str.
+    """
+
+    mimetype = 'application/json'
+
+    def __init__(self, serializer):
+        self.__serializer = serializer
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes, bytearray)):
+            return data
+        try:
+            return self.__serializer.dumps(data).decode('utf-8')
+        except (TypeError, ValueError) as e:
+            from elasticsearch.exceptions import SerializationError
+            raise SerializationError(data, e)
+
+    def loads(self, s):
+        try:
+            return self.__serializer.loads(s)
+        except (TypeError, ValueError) as e:
+            from elasticsearch.exceptions import SerializationError
+            raise SerializationError(s, e)
+
+
+class BulkBuffer:
+    """Encode bulk actions (in elasticsearch.helpers' format) into one reused bytes buffer"""
+
+    def __init__(self, serializer, max_actions=BULK_CHUNK_ACTIONS, max_bytes=BULK_CHUNK_BYTES):
+        self.__serializer = serializer
+        self.__max_actions = max_actions
+        self.__max_bytes = max_bytes
+        self.__buffer = bytearray()
+        self.__actions = 0
+
+    def __len__(self):
+        return self.__actions
+
+    def add(self, action):
+        """Append an action, returning True once the buffer should be flushed"""
+        action = dict(action)
+        op_type = action.pop('_op_type', 'index')
+        meta = {}
+        for field in BULK_META_FIELDS:
+            if field in action:
+                meta[field] = action.pop(field)
+        self.__buffer += self.__serializer.dumps({op_type: meta})
+        self.__buffer += b'\n'
+        if op_type != 'delete':
+            source = action.pop('_source', action)
+            if isinstance(source, str):
+                source = source.encode('utf-8')
+            elif not isinstance(source, (bytes, bytearray)):
+                source = self.__serializer.dumps(source)
+            self.__buffer += source
+            self.__buffer += b'\n'
+        self.__actions += 1
+        return self.__actions >= self.__max_actions or len(self.__buffer) >= self.__max_bytes
+
+    def getvalue(self):
+        """The encoded actions"""
+        return bytes(self.__buffer)
+
+    def clear(self):
+        """Empty the buffer, keeping its memory for the next chunk"""
+        del self.__buffer[:]
+        self.__actions = 0
+
+
+_serializers = {}
+
+def getSerializer(name=None):
+    """Get the (shared) JSONSerializer for a library name, or the fastest installed"""
+    if name not in _serializers:
+        _serializers[name] = JSONSerializer(name)
+    return _serializers[name]
@@ -1,5 +1,3 @@
-import datapackage
-
 """
 Manage a data store for the OceanProteinPortal
 """
@@ -22,7 +20,39 @@ class DataStore:
         """Return the store"""
         return self.__store
 
-    def initialize(store):
+    def setIdentifierMap(self, identifier_map):
+        """Use an identifier map for existence checks"""
+        pass
+
+    def setTaxonomy(self, taxonomy):
+        """Use a local NCBI taxonomy index to fill in taxon names and lineages"""
+        pass
+
+    def setQuarantine(self, quarantine):
+        """Quarantine bad rows instead of aborting loads"""
+        pass
+
+    def getQuarantine(self):
+        """Return the quarantine, if any"""
+        return None
+
+    def setMemoryBudget(self, budget):
+        """Bound the store's buffers by a memory budget"""
+        pass
+
+    def getMemoryBudget(self):
+        """Return the memory budget, if any"""
+        return None
+
+    def setManifest(self, manifest):
+        """Sum the rows the loaders read into an ingest manifest"""
+        pass
+
+    def getManifest(self):
+        """Return the ingest manifest, if any"""
+        return None
+
+    def initialize(self, expected_documents=None):
         """Initialize the store."""
         pass
 
@@ -30,11 +60,15 @@ class DataStore:
         """Load data into the store."""
         pass
 
+    def deleteDataset(self, datasetId):
+        """Delete a dataset's documents"""
+        pass
+
     def loadDatasetMetadata(datapackage, datasetId):
         """Load Dataset Metadata"""
         pass
 
-    def loadProteins(datapackage, datasetId, row_start=0, row_stop=None):
+    def loadProteins(datapackage, datasetId, row_start=0, row_stop=None, mode='index', rows=None):
         """Load Protein Data"""
         pass
 
@@ -42,10 +76,42 @@ class DataStore:
         """ Update Dataset with sample statistics"""
         pass
 
-    def loadPeptides(self, datapackage, datasetId, row_start=0, row_stop=None):
+    def updateDatasetRollups(self, datapackage, datasetId):
+        """Update the dataset's taxon and pathway abundance rollups"""
+        pass
+
+    def updateDatasetTiles(self, datapackage, datasetId):
+        """Update the dataset's station map tiles"""
+        pass
+
+    def updateDatasetKmers(self, datapackage, datasetId):
+        """Update the dataset's k-mer posting lists"""
+        pass
+
+    def updateProteinAbundances(self, datapackage, datasetId):
+        """Update the spectral counts with their relative abundances and NSAF"""
+        pass
+
+    def loadPeptides(self, datapackage, datasetId, row_start=0, row_stop=None, rows=None):
         """Load Peptide Data"""
         pass
 
-    def loadProteinsFASTA(self, datapackage, datasetId):
+    def updateProteinsWithPeptide(self, datapackage, datasetId):
+        """Update Proteins with their matching peptides"""
+        pass
+
+    def verifyDataset(self, datapackage, datasetId, resources):
+        """Compare a dataset in the store with the manifest of its ingest"""
+        pass
+
+    def exportDataset(self, datasetId, directory, slices=4):
+        """Export a dataset to a datapackage"""
+        pass
+
+    def loadProteinsFASTA(self, datapackage, datasetId, fast=True):
         """Load FASTA Protein Sequences"""
         pass
+
+    def updateProteinsWithCoverage(self, datapackage, datasetId):
+        """Update Proteins with their peptide sequence coverage"""
+        pass
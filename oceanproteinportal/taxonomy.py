@@ -0,0 +1,171 @@
+import array
+import functools
+import json
+import mmap
+import struct
+"""
+Offline NCBI taxonomy lookups for the OceanProteinPortal.
+
+buildTaxonomyIndex converts the NCBI taxdump nodes.dmp and names.dmp files
+once into a compact binary index (sorted taxon ids with parallel parent,
+rank and scientific-name arrays). TaxonomyIndex memory-maps that index and
+resolves names and lineages with an LRU cache in front, since the same taxon
+ids repeat across most protein rows. No network access is needed.
+"""
+
+TAXONOMY_INDEX_MAGIC = b'OPPTAX1\0'
+TAXONOMY_HEADER = struct.Struct('<8sQQQ')
+DMP_SEPARATOR = '\t|\t'
+SCIENTIFIC_NAME = 'scientific name'
+ROOT_TAXON_ID = 1
+DEFAULT_CACHE_SIZE = 65536
+
+def readDmp(path):
+    """Iterate the fields of each line of an NCBI .dmp file"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as dmp:
+        for line in dmp:
+            line = line.rstrip('\n')
+            if line.endswith('\t|'):
+                line = line[:-2]
+            yield line.split(DMP_SEPARATOR)
+
+def buildTaxonomyIndex(nodes_file, names_file, index_file):
+    """Build a taxonomy index from nodes.dmp and names.dmp, returning the taxon count"""
+    nodes = {}
+    ranks = []
+    rank_ids = {}
+    for fields in readDmp(nodes_file):
+        rank = fields[2]
+        if rank not in rank_ids:
+            rank_ids[rank] = len(ranks)
+            ranks.append(rank)
+        nodes[int(fields[0])] = (int(fields[1]), rank_ids[rank])
+
+    names = {}
+    for fields in readDmp(names_file):
+        if len(fields) > 3 and fields[3] == SCIENTIFIC_NAME:
+            names[int(fields[0])] = fields[1]
+
+    ids = array.array('I', sorted(nodes))
+    parents = array.array('I', (nodes[taxId][0] for taxId in ids))
+    rank_column = array.array('B', (nodes[taxId][1] for taxId in ids))
+    offsets = array.array('Q', [0])
+    blob = bytearray()
+    for taxId in ids:
+        blob += names.get(taxId, '').encode('utf-8')
+        offsets.append(len(blob))
+
+    rank_table = json.dumps(ranks).encode('utf-8')
+    with open(index_file, 'wb') as index:
+        index.write(TAXONOMY_HEADER.pack(TAXONOMY_INDEX_MAGIC, len(ids), len(blob), len(rank_table)))
+        for section in (rank_table, ids.tobytes(), parents.tobytes(), rank_column.tobytes(), offsets.tobytes(), bytes(blob)):
+            index.write(section)
+            index.write(b'\0' * (-len(section) % 8))
+    return len(ids)
+
+
+class TaxonomyIndex:
+    """A memory-mapped NCBI taxonomy index built by buildTaxonomyIndex"""
+
+    def __init__(self, index_file, cache_size=DEFAULT_CACHE_SIZE):
+        self.__file = open(index_file, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, blob_size, rank_size = TAXONOMY_HEADER.unpack_from(self.__map, 0)
+        if magic != TAXONOMY_INDEX_MAGIC:
+            raise Exception('Not a taxonomy index: %s' % (index_file))
+
+        view = memoryview(self.__map)
+        position = TAXONOMY_HEADER.size
+
+        def section(size, typecode=None):
+            nonlocal position
+            data = view[position:position + size]
+            position += size + (-size % 8)
+            return data.cast(typecode) if typecode is not None else data
+
+        self.__ranks = json.loads(bytes(section(rank_size)).decode('utf-8'))
+        self.__ids = section(count * 4, 'I')
+        self.__parents = section(count * 4, 'I')
+        self.__rank_column = section(count, 'B')
+        self.__offsets = section((count + 1) * 8, 'Q')
+        self.__names = section(blob_size)
+
+        self.taxon = functools.lru_cache(maxsize=cache_size)(self._taxon)
+        self.lineage = functools.lru_cache(maxsize=cache_size)(self._lineage)
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def __contains__(self, taxId):
+        return self._position(taxId) is not None
+
+    def _position(self, taxId):
+        """Binary search the sorted ids for a taxon"""
+        try:
+            taxId = int(taxId)
+        except (TypeError, ValueError):
+            return None
+        ids = self.__ids
+        low, high = 0, len(ids)
+        while low < high:
+            middle = (low + high) // 2
+            if ids[middle] < taxId:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(ids) and ids[low] == taxId:
+            return low
+        return None
+
+    def _taxon(self, taxId):
+        """{'id', 'name', 'rank', 'parent'} for a taxon id, or None if unknown"""
+        position = self._position(taxId)
+        if position is None:
+            return None
+        name = bytes(self.__names[self.__offsets[position]:self.__offsets[position + 1]]).decode('utf-8')
+        return {
+          'id': str(self.__ids[position]),
+          'name': name or None,
+          'rank': self.__ranks[self.__rank_column[position]],
+          'parent': str(self.__parents[position])
+        }
+
+    def _lineage(self, taxId):
+        """The taxa from the root down to a taxon id (empty if unknown)"""
+        lineage = []
+        taxon = self.taxon(taxId)
+        while taxon is not None:
+            lineage.append(taxon)
+            if int(taxon['id']) == ROOT_TAXON_ID or taxon['parent'] == taxon['id']:
+                break
+            taxon = self.taxon(taxon['parent'])
+        lineage.reverse()
+        return tuple(lineage)
+
+    def name(self, taxId):
+        """The scientific name of a taxon id"""
+        taxon = self.taxon(taxId)
+        return taxon['name'] if taxon is not None else None
+
+    def resolve(self, ncbiTaxon):
+        """Fill in an ncbiTaxon document's name, rank and lineage in place"""
+        if ncbiTaxon is None or ncbiTaxon.get('id', None) is None:
+            return ncbiTaxon
+        lineage = self.lineage(ncbiTaxon['id'])
+        if not lineage:
+            return ncbiTaxon
+        taxon = lineage[-1]
+        if ncbiTaxon.get('name', None) is None:
+            ncbiTaxon['name'] = taxon['name']
+        ncbiTaxon['rank'] = taxon['rank']
+        # Skip the root ('root', no rank) in the facetable lineage
+        ncbiTaxon['lineage'] = [ancestor['name'] for ancestor in lineage if int(ancestor['id']) != ROOT_TAXON_ID]
+        ncbiTaxon['lineageIds'] = [ancestor['id'] for ancestor in lineage if int(ancestor['id']) != ROOT_TAXON_ID]
+        return ncbiTaxon
+
+    def close(self):
+        self.taxon.cache_clear()
+        self.lineage.cache_clear()
+        self.__ids = self.__parents = self.__rank_column = self.__offsets = self.__names = None
+        self.__map.close()
+        self.__file.close()
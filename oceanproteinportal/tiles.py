@@ -0,0 +1,155 @@
+import oceanproteinportal.utils
+"""
+Station map tiles for the OceanProteinPortal.
+
+Rather than a nested geohash_grid aggregation over every protein's
+spectralCount.coordinate when the portal map pans, an ingest phase streams
+the protein rows once and groups the stations by geohash at several
+precisions (zoom levels). Each (precision, geohash) becomes a small 'tile'
+document with a geo_point location, the stations in it and its sample and
+protein counts, so a map view is a filtered lookup of a dataset's tiles. A
+row naming neither its cruise nor its station is a station of its own
+coordinate.
+"""
+
+# Geohash lengths precomputed, from world to about station scale (~5km x 5km cells at 5)
+TILE_PRECISIONS = (1, 2, 3, 4, 5)
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, lon, precision):
+    """Encode a coordinate as a geohash of some length"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    value = 0
+    even = True
+    while len(code) < precision:
+        if even:
+            middle = (lon_range[0] + lon_range[1]) / 2
+            if lon >= middle:
+                value = (value << 1) | 1
+                lon_range[0] = middle
+            else:
+                value = value << 1
+                lon_range[1] = middle
+        else:
+            middle = (lat_range[0] + lat_range[1]) / 2
+            if lat >= middle:
+                value = (value << 1) | 1
+                lat_range[0] = middle
+            else:
+                value = value << 1
+                lat_range[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(code)
+
+
+class Bitmap:
+    """A growable bitmap of small integers (e.g. interned proteinIds)"""
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, number):
+        byte = number >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (number & 7)
+
+    def union(self, other):
+        size = max(len(self.bits), len(other.bits))
+        merged = int.from_bytes(bytes(self.bits), 'little') | int.from_bytes(bytes(other.bits), 'little')
+        self.bits = bytearray(merged.to_bytes(size, 'little'))
+
+    def __len__(self):
+        return bin(int.from_bytes(bytes(self.bits), 'little')).count('1')
+
+
+class StationTiles:
+    """Accumulate a dataset's stations, their samples and proteins, and group them into tiles"""
+
+    def __init__(self, precisions=TILE_PRECISIONS):
+        self.__precisions = precisions
+        # (cruise, station), or (lat, lon) without either -> {'cruise', 'station', 'lat', 'lon', 'samples', 'proteins', 'spectralCount'}
+        self.__stations = {}
+        self.__proteins = {}
+
+    def __len__(self):
+        return len(self.__stations)
+
+    def add(self, cruise, station, lat, lon, sampleId, proteinId, count=None):
+        """Add a protein row observed at a station. Rows without a coordinate are ignored."""
+        if lat is None or lon is None:
+            return
+        lat = float(lat)
+        lon = float(lon)
+        if cruise is None and station is None:
+            key = ('coordinate', lat, lon)
+        else:
+            key = ('station', cruise, station)
+        found = self.__stations.get(key, None)
+        if found is None:
+            found = {'cruise': cruise, 'station': station, 'lat': lat, 'lon': lon, 'samples': set(), 'proteins': Bitmap(), 'spectralCount': 0.0}
+            self.__stations[key] = found
+        if sampleId is not None:
+            found['samples'].add(sampleId)
+        if proteinId is not None:
+            protein = self.__proteins.get(proteinId, None)
+            if protein is None:
+                protein = len(self.__proteins)
+                self.__proteins[proteinId] = protein
+            found['proteins'].add(protein)
+        if count is not None:
+            found['spectralCount'] += float(count)
+
+    def documents(self, datasetId):
+        """Yield the tile documents of a dataset"""
+        for precision in self.__precisions:
+            tiles = {}
+            for found in self.__stations.values():
+                tiles.setdefault(geohash(found['lat'], found['lon'], precision), []).append(found)
+            for cell, stations in tiles.items():
+                samples = set()
+                proteins = Bitmap()
+                for found in stations:
+                    samples.update(found['samples'])
+                    proteins.union(found['proteins'])
+                yield {
+                  '_dataset': datasetId,
+                  'guid': tileGuid(datasetId, precision, cell),
+                  'precision': precision,
+                  'geohash': cell,
+                  # The stations' centroid, so markers sit on the data rather than the cell centre
+                  'location': {
+                    'lat': sum(found['lat'] for found in stations) / len(stations),
+                    'lon': sum(found['lon'] for found in stations) / len(stations)
+                  },
+                  'stations': sorted(set(found['station'] for found in stations if found['station'] is not None)),
+                  'cruiseIds': sorted(set(found['cruise'] for found in stations if found['cruise'] is not None)),
+                  'samples': len(samples),
+                  'proteins': len(proteins),
+                  'totalSpectralCount': sum(found['spectralCount'] for found in stations)
+                }
+
+
+def tileGuid(datasetId, precision, cell):
+    """Generate the GUID of a tile document, stable across reloads"""
+    return oceanproteinportal.utils.generateGuid(datasetId + '_tile_' + str(precision) + ':' + cell)
+
+def tileRow(tiles, row):
+    """Add a mapped protein row (see iterResourceRows) to the station tiles"""
+    tiles.add(
+      cruise=row.get('spectralCount:cruise', None),
+      station=row.get('spectralCount:station', None),
+      lat=row.get('spectralCount:coordinate:lat', None),
+      lon=row.get('spectralCount:coordinate:lon', None),
+      sampleId=row.get('spectralCount:sampleId', None),
+      proteinId=row.get('proteinId', None),
+      count=row.get('spectralCount:count', None)
+    )
@@ -1,5 +1,9 @@
-import uuid
+import collections
+import itertools
 import logging
+import threading
+import time
+import uuid
 """
 Utility package for general use functions.
 """
@@ -18,6 +22,14 @@ def generateGuid(string_value):
     """Generate a GUID for some string value"""
     return str(uuid.uuid3(uuid.NAMESPACE_DNS, string_value))
 
+def batches(iterable, size):
+    """Yield lists of up to size items from an iterable"""
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
 def yes_or_no(question):
     while "The answer is invalid.":
         reply = str(input(question + ' (y/n): ')).lower().strip()
@@ -25,3 +37,65 @@ def yes_or_no(question):
             return True
         if reply[0] == 'n':
             return False
+
+class LRUCache:
+    """A least-recently-used cache whose entries expire after a time-to-live.
+
+    Entries can be tagged (e.g. with a datasetId) so every entry for that tag
+    can be invalidated at once. With a memory budget
+    (oceanproteinportal.memory.MemoryBudget) the older half of the entries
+    is evicted whenever the budget is exceeded. The cache checks a copy of
+    the budget, so its evictions don't raise the spill threshold of the
+    budget's other users (e.g. the protein grouping).
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, budget=None):
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__budget = budget.copy() if budget is not None else None
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired"""
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is None:
+                return default
+            expires, tag, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self.__entries[key]
+                return default
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tag=None):
+        """Cache a value, evicting the least recently used entry when full"""
+        expires = None
+        if self.__ttl is not None:
+            expires = time.monotonic() + self.__ttl
+        with self.__lock:
+            self.__entries[key] = (expires, tag, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__maxsize:
+                self.__entries.popitem(last=False)
+            if self.__budget is not None and self.__budget.exceeded():
+                for evict in range(len(self.__entries) // 2):
+                    self.__entries.popitem(last=False)
+                self.__budget.spilled()
+
+    def invalidate(self, tag):
+        """Drop every entry carrying the tag"""
+        with self.__lock:
+            stale = [key for key, entry in self.__entries.items() if entry[1] == tag]
+            for key in stale:
+                del self.__entries[key]
+        return len(stale)
+
+    def clear(self):
+        """Drop every entry"""
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,255 @@
+import concurrent.futures
+import csv
+import io
+import logging
+import oceanproteinportal.datapackage
+import oceanproteinportal.fasta
+import os
+import re
+import time
+"""
+Validate the data files of an OceanProteinPortal datapackage before ingest.
+
+The protein and peptide tables and the FASTA file are checked in worker
+processes: every row's width and values against the resource's Table Schema,
+every FASTA record's id and residues. 'sample' mode reads blocks of rows
+spread across each file, 'full' mode splits each file into record-aligned
+byte ranges validated concurrently and streamed a chunk of lines at a time.
+Each worker stops at the error limit and pending work is cancelled once it
+is reached overall, so a broken file is reported in minutes, not hours into
+an ingest. Records end at newlines outside quoted values, as the loaders
+read them, so quoted values may span lines.
+"""
+
+VALIDATION_MODES = ('sample', 'full')
+# Stop once this many errors are found
+MAX_ERRORS = 100
+# Sample mode: rows (or FASTA records) read per block, and blocks spread across each file
+SAMPLE_ROWS = 1000
+SAMPLE_BLOCKS = 20
+# Full mode: bytes of lines read at a time, and byte ranges per file
+CHUNK_BYTES = 1024 * 1024
+PART_BYTES = 256 * 1024 * 1024
+RESIDUES = re.compile('^[A-Za-z*-]*$')
+TYPE_CHECKS = dict(oceanproteinportal.datapackage.FIELD_TYPE_CHECKS)
+
+def validateDatapackage(datapackage, mode='sample', max_errors=MAX_ERRORS, processes=None, sample_rows=SAMPLE_ROWS, sample_blocks=SAMPLE_BLOCKS, part_bytes=PART_BYTES):
+    """Validate a datapackage's protein, peptide and FASTA resources, returning a summary.
+
+    The summary holds the mode, whether the data is 'valid', the rows (or
+    records) read, errors found and whether validation 'stopped' early per
+    resource type, and up to max_errors of the errors themselves.
+    """
+    if mode not in VALIDATION_MODES:
+        raise Exception('Unknown validation mode: %s' % (mode))
+
+    tasks = []
+    for resource_type in ('protein', 'peptide', 'fasta'):
+        resource = oceanproteinportal.datapackage.findResource(datapackage=datapackage, resource_type=resource_type)
+        if resource is None:
+            continue
+        path = resource.descriptor['path']
+        if resource_type == 'fasta':
+            ranges = [(None, None)] if mode == 'sample' else oceanproteinportal.fasta.splitFasta(path, max(1, os.path.getsize(path) // part_bytes))
+            for start, stop in ranges:
+                tasks.append((resource_type, validateFasta, (path, mode, start, stop, max_errors, sample_rows, sample_blocks)))
+        else:
+            schema = resource.descriptor['schema']
+            encoding = resource.descriptor.get('encoding', 'utf-8')
+            ranges = [(None, None)] if mode == 'sample' else splitLines(path, part_bytes)
+            for start, stop in ranges:
+                tasks.append((resource_type, validateTable, (path, schema, encoding, mode, start, stop, max_errors, sample_rows, sample_blocks)))
+
+    summary = {'mode': mode, 'valid': True, 'resources': {}, 'errors': []}
+    started = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {}
+        for resource_type, validate, args in tasks:
+            futures[executor.submit(validate, *args)] = resource_type
+            summary['resources'].setdefault(resource_type, {'rows': 0, 'errors': 0, 'stopped': False})
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            resource_type = futures[future]
+            result = future.result()
+            counts = summary['resources'][resource_type]
+            counts['rows'] += result['rows']
+            counts['errors'] += len(result['errors'])
+            counts['stopped'] = counts['stopped'] or result['stopped']
+            for error in result['errors']:
+                error['type'] = resource_type
+            summary['errors'].extend(result['errors'])
+            if len(summary['errors']) >= max_errors:
+                # Early exit: skip the parts not started yet
+                for pending in futures:
+                    if pending.cancel():
+                        summary['resources'][futures[pending]]['stopped'] = True
+                del summary['errors'][max_errors:]
+    summary['valid'] = not summary['errors']
+    summary['seconds'] = round(time.time() - started, 1)
+    return summary
+
+def logSummary(summary):
+    """Log a validation summary compactly"""
+    for resource_type, counts in summary['resources'].items():
+        logging.info('%s: %s rows, %s errors%s' % (resource_type, counts['rows'], counts['errors'], ' (stopped early)' if counts['stopped'] else ''))
+    for error in summary['errors']:
+        logging.error('%s %s: %s' % (error['type'], describeLocation(error), error['error']))
+    logging.info('Validated (%s) in %ss: %s' % (summary['mode'], summary['seconds'], 'valid' if summary['valid'] else 'INVALID'))
+
+def describeLocation(error):
+    """Where an error is: its FASTA record or row when known, otherwise its byte offset"""
+    if error.get('record', None):
+        return 'record[%s]' % (error['record'])
+    if error.get('row', None) is not None:
+        return 'row[%s]' % (error['row'])
+    return 'byte[%s]' % (error['offset'])
+
+def splitLines(path, part_bytes=PART_BYTES):
+    """Split a file after its header record into record-aligned (start, stop) byte ranges of about part_bytes"""
+    size = os.path.getsize(path)
+    data_start = oceanproteinportal.datapackage.recordOffsets(path, [1]).get(1, size)
+    starts = oceanproteinportal.datapackage.recordStarts(path, range(data_start + part_bytes, size, part_bytes))
+    offsets = [data_start]
+    for position in sorted(starts):
+        offset, record = starts[position]
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def iterLines(handle, mode, start, stop, sample_rows=SAMPLE_ROWS, sample_blocks=SAMPLE_BLOCKS):
+    """Yield (row number or None, byte offset, record) from the data records of an open binary file.
+
+    A record ends at a newline outside quoted values, so it may span lines.
+    Row numbers are known when reading from the first data record, and in
+    sample mode, whose blocks start at records found by a quote-aware scan.
+    """
+    size = os.fstat(handle.fileno()).st_size
+    data_start = oceanproteinportal.datapackage.recordOffsets(handle.name, [1]).get(1, size)
+    if mode == 'sample':
+        positions = [data_start + (size - data_start) * block // sample_blocks for block in range(sample_blocks)]
+        starts = oceanproteinportal.datapackage.recordStarts(handle.name, positions)
+        blocks = [starts[position] + (sample_rows,) for position in positions]
+    else:
+        offset = data_start if start is None else start
+        blocks = [(offset, 1 if offset == data_start else None, None)]
+
+    read_until = data_start
+    read_row = 1
+    for offset, row, limit in blocks:
+        if offset < read_until:
+            # small files: don't read a record of the previous block twice
+            offset, row = read_until, read_row
+        handle.seek(offset)
+        read = 0
+        record = b''
+        quoted = False
+        while limit is None or read < limit:
+            lines = handle.readlines(CHUNK_BYTES) if limit is None else [handle.readline()]
+            if not lines or not lines[0]:
+                break
+            for line in lines:
+                if not record and stop is not None and offset >= stop:
+                    return
+                record += line
+                if line.count(b'"') % 2:
+                    quoted = not quoted
+                if quoted:
+                    continue
+                yield row, offset, record
+                offset += len(record)
+                record = b''
+                read += 1
+                if row is not None:
+                    row += 1
+                read_until, read_row = offset, row
+                if limit is not None and read >= limit:
+                    break
+        if record:
+            # an unterminated quoted value runs to the end of the file
+            yield row, offset, record
+            read_until, read_row = offset + len(record), None
+
+def validateTable(path, schema, encoding, mode, start, stop, max_errors, sample_rows=SAMPLE_ROWS, sample_blocks=SAMPLE_BLOCKS):
+    """Validate (part of) a CSV resource against its Table Schema"""
+    fields = schema['fields']
+    missing_values = set(schema.get('missingValues', ['']))
+    result = {'rows': 0, 'errors': [], 'stopped': False}
+
+    def error(row, offset, message):
+        result['errors'].append({'row': row, 'offset': offset, 'error': message})
+        result['stopped'] = len(result['errors']) >= max_errors
+        return result['stopped']
+
+    with open(path, 'rb') as handle:
+        header = next(csv.reader([handle.readline().decode(encoding).lstrip('\ufeff')]), [])
+        if start is None or start <= handle.tell():
+            names = [field['name'] for field in fields]
+            if header != names:
+                if error(0, 0, 'Header %s does not match the schema fields %s' % (header, names)):
+                    return result
+
+        for row, offset, record in iterLines(handle, mode, start, stop, sample_rows=sample_rows, sample_blocks=sample_blocks):
+            result['rows'] += 1
+            try:
+                values = next(csv.reader(io.StringIO(record.decode(encoding), newline='')), [])
+            except (UnicodeDecodeError, csv.Error) as e:
+                if error(row, offset, '%s: %s' % (e.__class__.__name__, e)):
+                    break
+                continue
+            if not values:
+                continue
+            if len(values) != len(fields):
+                if error(row, offset, 'Expected %s values, found %s' % (len(fields), len(values))):
+                    break
+                continue
+            message = checkValues(fields, values, missing_values)
+            if message is not None and error(row, offset, message):
+                break
+    return result
+
+def checkValues(fields, values, missing_values):
+    """Check a row's values against the fields' types and constraints, returning the first problem"""
+    for field, value in zip(fields, values):
+        if value in missing_values:
+            if field.get('constraints', {}).get('required', False):
+                return '%s is required' % (field['name'])
+            continue
+        check = TYPE_CHECKS.get(field.get('type', 'string'), None)
+        if check is None:
+            continue
+        delimiter = field.get('opp:fieldValueDelimiter', None)
+        for part in (value.split(delimiter) if delimiter else [value]):
+            if part not in missing_values and not check(part):
+                return '%s: %r is not a valid %s' % (field['name'], part, field['type'])
+    return None
+
+def validateFasta(path, mode, start, stop, max_errors, sample_rows=SAMPLE_ROWS, sample_blocks=SAMPLE_BLOCKS):
+    """Validate (part of) a FASTA file: every record needs an id and residues"""
+    result = {'rows': 0, 'errors': [], 'stopped': False}
+    if mode == 'sample':
+        ranges = [(range_start, range_stop, sample_rows) for range_start, range_stop in oceanproteinportal.fasta.splitFasta(path, sample_blocks)]
+    else:
+        ranges = [(start, stop, None)]
+
+    for range_start, range_stop, limit in ranges:
+        read = 0
+        for record_id, sequence in oceanproteinportal.fasta.readFasta(path, start=range_start, stop=range_stop):
+            result['rows'] += 1
+            read += 1
+            message = None
+            if not record_id:
+                message = 'Record without an id'
+            elif not sequence:
+                message = '%s has no sequence' % (record_id)
+            elif not RESIDUES.match(sequence):
+                message = '%s has invalid residues' % (record_id)
+            if message is not None:
+                result['errors'].append({'row': None, 'offset': range_start, 'record': record_id, 'error': message})
+                if len(result['errors']) >= max_errors:
+                    result['stopped'] = True
+                    return result
+            if limit is not None and read >= limit:
+                break
+    return result
@@ -0,0 +1,200 @@
+import csv
+import hashlib
+import json
+import io
+import logging
+import oceanproteinportal.datapackage
+import os
+import random
+import threading
+"""
+Verify an OceanProteinPortal ingest without re-scanning the store.
+
+While the loaders read the protein and peptide rows an IngestManifest sums
+an order-independent checksum of the rows read and fingerprints the source
+files; as the loaders accept rows (built and written) it counts them and the
+distinct documents they make. Verification then only needs a count per
+document type, which must match the manifest, a check that the sources
+haven't changed since (re-reading a source for its checksum only when its
+fingerprint changed), and a random sample of the loaded rows, located with
+one quote-aware pass counting records and read by seeking to their byte
+offsets, rebuilt into documents and diffed against the stored ones fetched
+in one multi-get per type. The store is only read for the sample.
+"""
+
+# Rows sampled per resource type
+SAMPLE_SIZE = 100
+# Row fields identifying the document a row belongs to
+DOCUMENT_KEYS = {
+  'protein': ('proteinId',),
+  'peptide': ('sampleName', 'proteinId', 'peptideSequence'),
+}
+CHECKSUM_MODULUS = 1 << 64
+
+def rowDigest(row):
+    """A 64 bit digest of a mapped row"""
+    encoded = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little')
+
+def fingerprint(path):
+    """The size and modification time of a source file"""
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class IngestManifest:
+    """Per resource type: a checksum of the rows read, and the rows accepted and distinct documents they make"""
+
+    def __init__(self):
+        # Loading phases run concurrently
+        self.__lock = threading.Lock()
+        self.__resources = {}
+        self.__keys = {}
+
+    def __resource(self, type):
+        if type not in self.__resources:
+            self.__resources[type] = {'read': 0, 'rows': 0, 'documents': 0, 'checksum': 0, 'source': None}
+            self.__keys[type] = set()
+        return self.__resources[type]
+
+    def source(self, type, path, row_start=0, row_stop=None, partial=False):
+        """Fingerprint the file a resource type is read from, and the rows read of it
+
+        partial marks a read of selected rows only, whose checksum cannot be
+        compared with a re-read of the source.
+        """
+        with self.__lock:
+            source = fingerprint(path)
+            source.update({'rowStart': row_start, 'rowStop': row_stop, 'partial': partial})
+            self.__resource(type)['source'] = source
+
+    def read(self, type, row):
+        """Sum a row read from the source into the checksum"""
+        digest = rowDigest(row)
+        with self.__lock:
+            resource = self.__resource(type)
+            resource['read'] += 1
+            resource['checksum'] = (resource['checksum'] + digest) % CHECKSUM_MODULUS
+
+    def add(self, type, row, rows=1):
+        """Count a row (or rows of one document) the loader accepted, and the document it went to"""
+        key = hash(tuple(row.get(field, None) for field in DOCUMENT_KEYS.get(type, ())))
+        with self.__lock:
+            resource = self.__resource(type)
+            resource['rows'] += rows
+            self.__keys[type].add(key)
+            resource['documents'] = len(self.__keys[type])
+
+    def __len__(self):
+        return sum(resource['rows'] for resource in self.__resources.values())
+
+    def resources(self):
+        """{type: {'read', 'rows', 'documents', 'checksum' (hex), 'source'}}"""
+        with self.__lock:
+            return dict((type, dict(resource, checksum='%016x' % (resource['checksum']))) for type, resource in self.__resources.items())
+
+    def save(self, path, datasetId=None):
+        """Write the manifest as JSON"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as handle:
+            json.dump({'datasetId': datasetId, 'resources': self.resources()}, handle, indent=2)
+
+
+class SkippedRows:
+    """Stands in for a Quarantine while a source is re-read: unreadable rows are counted and skipped"""
+
+    def __init__(self):
+        self.rows = 0
+        self.rejected = 0
+
+    def count(self, type):
+        self.rows += 1
+
+    def reject(self, type, row, data, error, stage='load'):
+        self.rejected += 1
+
+
+def readManifest(path):
+    """Read a saved manifest's {'datasetId', 'resources'}"""
+    with open(path, 'r') as handle:
+        return json.load(handle)
+
+def changedSources(resources):
+    """The resource types whose source file changed since the manifest was made"""
+    changed = []
+    for type, resource in resources.items():
+        source = resource.get('source', None)
+        if source is None:
+            continue
+        try:
+            current = fingerprint(source['path'])
+        except OSError:
+            changed.append(type)
+            continue
+        if current['size'] != source['size'] or current['mtime'] != source['mtime']:
+            changed.append(type)
+    return changed
+
+def sampleLines(path, size, encoding='utf-8', seed=None, row_start=0, row_stop=None):
+    """Read about `size` distinct random data rows of a CSV file, as (offset, values)
+
+    Rows are numbered from 1 as the loaders number them, and only rows in
+    [row_start, row_stop] are sampled. Whole records are parsed from their
+    start offsets, so quoted values may span lines.
+    """
+    generator = random.Random(seed)
+    rows = oceanproteinportal.datapackage.fileStats(path)['records'] - 1
+    if row_stop is not None:
+        rows = min(rows, row_stop)
+    first = max(row_start or 0, 1)
+    if rows < first:
+        return []
+    chosen = generator.sample(range(first, rows + 1), min(size, rows - first + 1))
+    lines = []
+    with open(path, 'rb') as handle:
+        for row, offset in oceanproteinportal.datapackage.recordOffsets(path, chosen).items():
+            handle.seek(offset)
+            text = io.TextIOWrapper(handle, encoding=encoding, newline='')
+            values = next(csv.reader(text), [])
+            text.detach()
+            if values:
+                lines.append((offset, values))
+    return sorted(lines)
+
+def diffDocument(expected, stored, path=''):
+    """The paths at which a stored document differs from the expected (sub)document"""
+    if isinstance(expected, dict):
+        if not isinstance(stored, dict):
+            return [path or '.']
+        differences = []
+        for key, value in expected.items():
+            if value is None:
+                continue
+            differences.extend(diffDocument(value, stored.get(key, None), path + '.' + key if path else key))
+        return differences
+    if isinstance(expected, list):
+        if not isinstance(stored, list) or len(expected) != len(stored):
+            return [path]
+        differences = []
+        for position, (value, stored_value) in enumerate(zip(expected, stored)):
+            differences.extend(diffDocument(value, stored_value, '%s[%s]' % (path, position)))
+        return differences
+    if expected != stored:
+        return [path]
+    return []
+
+def containsEntry(expected, entries):
+    """Whether a stored list (e.g. spectralCount) holds an entry matching an expected one"""
+    return any(not diffDocument(expected, entry) for entry in entries or [])
+
+def logSummary(summary):
+    """Log a verification summary compactly"""
+    for type, counts in summary['counts'].items():
+        logging.info('%s: %s documents stored, %s expected' % (type, counts['stored'], counts['expected']))
+    for type, checked in summary['samples'].items():
+        logging.info('%s: %s sampled rows checked, %s missing, %s different' % (type, checked['checked'], checked['missing'], checked['different']))
+    for mismatch in summary['mismatches']:
+        logging.error('*** MISMATCH: %s' % (mismatch))
+    logging.info('Verified in %ss: %s' % (summary['seconds'], 'valid' if summary['valid'] else 'MISMATCHED'))
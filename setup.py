@@ -17,5 +17,11 @@ setup(
     author_email='webmaster@oceanproteinportal.org',
     url='https://github.com/oceanproteinportal/oceanproteinportal-py',
     license=license,
-    packages=find_packages(exclude=('tests', 'docs'))
+    packages=find_packages(exclude=('tests', 'docs')),
+    package_data={'oceanproteinportal': ['config/*.json', 'config/*.yaml']},
+    entry_points={
+        'console_scripts': [
+            'oceanproteinportal=oceanproteinportal.cli:main',
+        ],
+    }
 )
@@ -1 +1,1426 @@
+import os
+import subprocess
+import sys
+import time
 
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('Bio', 'datapackage', 'elasticsearch', 'goodtables', 'tableschema', 'yaml')
+# Generous budget for interpreter start + CLI import on a cold container
+STARTUP_BUDGET_SECONDS = 2.0
+
+def run_python(*args):
+    return subprocess.run(
+        [sys.executable] + list(args),
+        cwd=REPO_ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+def test_cli_import_skips_heavy_dependencies():
+    code = (
+        'import sys, oceanproteinportal.cli, oceanproteinportal.store, oceanproteinportal.datapackage; '
+        'print(",".join(sorted(m for m in %r if m in sys.modules)))' % (HEAVY_MODULES,)
+    )
+    result = run_python('-c', code)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ''
+
+def test_cli_help_startup_time():
+    started = time.perf_counter()
+    result = run_python('-m', 'oceanproteinportal', '--help')
+    elapsed = time.perf_counter() - started
+    print('oceanproteinportal --help: %.3fs' % (elapsed))
+    assert result.returncode == 0, result.stderr
+    for command in ('build-package', 'ingest', 'reduce-fasta', 'stats'):
+        assert command in result.stdout
+    assert elapsed < STARTUP_BUDGET_SECONDS
+
+# Synthetic protein table for the grouping memory regression
+GROUPING_PROTEINS = 10000
+GROUPING_SAMPLES = 6
+GROUPING_MEMORY_BUDGET = 4 * 1024 * 1024
+
+def test_protein_grouping_stays_under_memory_budget():
+    import tracemalloc
+    from oceanproteinportal.memory import MemoryBudget
+    from oceanproteinportal.store.proteins import ProteinGrouper
+
+    budget = MemoryBudget(GROUPING_MEMORY_BUDGET, check_interval=0)
+    grouper = ProteinGrouper('dataset', generateGuid=lambda proteinId: 'guid-' + proteinId)
+    written = {}
+    tracemalloc.start()
+    try:
+        for sample in range(GROUPING_SAMPLES):
+            for protein in range(GROUPING_PROTEINS):
+                grouper.add({
+                  'proteinId': 'protein-%s' % (protein),
+                  'productName': 'product of protein %s' % (protein),
+                  'ncbi:id': str(protein % 500),
+                  'spectralCount:sampleId': 'sample-%s' % (sample),
+                  'spectralCount:count': protein % 17,
+                  'spectralCount:station': 'station-%s' % (sample),
+                  'spectralCount:depth': 10.0 * sample,
+                  'spectralCount:coordinate:lat': 10.0 + sample,
+                  'spectralCount:coordinate:lon': -20.0 - sample
+                })
+                if budget.exceeded():
+                    for proteinId, document, spilled in grouper.spill():
+                        written[proteinId] = written.get(proteinId, 0) + len(document['spectralCount'])
+                    budget.spilled()
+        for proteinId, document, spilled in grouper.spill():
+            written[proteinId] = written.get(proteinId, 0) + len(document['spectralCount'])
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print('grouping peak: %.1fM (%s spills)' % (peak / 1048576.0, budget.spills))
+    assert budget.spills > 0
+    assert sum(written.values()) == GROUPING_PROTEINS * GROUPING_SAMPLES
+    assert len(written) == GROUPING_PROTEINS
+    # One row's growth past the check at most, plus the bookkeeping of what was written
+    assert peak < GROUPING_MEMORY_BUDGET * 1.5
+
+CONFIG_DIR = os.path.join(REPO_ROOT, 'oceanproteinportal', 'config')
+
+def read_config(name):
+    import json
+    import yaml
+    with open(os.path.join(CONFIG_DIR, name)) as config_file:
+        if name.endswith('.json'):
+            return json.load(config_file)
+        return yaml.safe_load(config_file)
+
+def test_index_body_derives_types_from_config():
+    from oceanproteinportal.store import mapping
+
+    schema = read_config('elasticsearch_schema.json')
+    template_mappings = read_config('ontology_template_mappings.yaml')['v1.0']
+    elastic_mappings = read_config('ontology_elasticsearch_mappings.yaml')['v1.0']
+    # A schema that drifted from the template: depth is a number in the data template
+    spectralCount = schema['mappings']['protein']['properties']['spectralCount']['properties']
+    spectralCount['depth'] = {'type': 'long'}
+    del spectralCount['station']
+    body = mapping.generateIndexBody(schema, template_mappings, elastic_mappings)
+    derived = body['mappings']['protein']['properties']['spectralCount']['properties']
+    assert derived['depth']['type'] == 'float'
+    assert derived['station']['type'] == 'keyword'
+    # Leaves and objects keep their shape
+    assert derived['coordinate'] == {'type': 'geo_point'}
+    assert 'type' not in derived['cruise']
+    assert derived['cruise']['properties']['value']['type'] == 'text'
+
+def test_index_body_maps_shared_fields_alike_in_every_type():
+    import pytest
+    from oceanproteinportal.store import mapping
+
+    schema = read_config('elasticsearch_schema.json')
+    template_mappings = read_config('ontology_template_mappings.yaml')['v1.0']
+    elastic_mappings = read_config('ontology_elasticsearch_mappings.yaml')['v1.0']
+    body = mapping.generateIndexBody(schema, template_mappings, elastic_mappings, routing_partition_size=2)
+    assert mapping.conflictingFields(body['mappings']) == []
+    assert len(body['mappings']) == 7
+
+    schema['mappings']['tile']['properties']['name'] = {'type': 'keyword'}
+    schema['mappings']['kmer']['properties']['spectralCount'] = {'type': 'nested', 'properties': {'count': {'type': 'long'}}}
+    assert mapping.conflictingFields(schema['mappings']) == ['name', 'spectralCount.count']
+    with pytest.raises(Exception, match='name, spectralCount.count'):
+        mapping.generateIndexBody(schema, template_mappings, elastic_mappings)
+
+def test_find_property_stops_at_leaves():
+    from oceanproteinportal.store.mapping import findProperty
+
+    properties = {'coordinate': {'type': 'geo_point'}, 'name': {'type': 'text', 'fields': {'exact': {'type': 'keyword'}}}}
+    assert findProperty(properties, 'coordinate.lat', create=True) is None
+    assert properties['coordinate'] == {'type': 'geo_point'}
+    assert findProperty(properties, 'name.exact') == {'type': 'keyword'}
+    assert findProperty(properties, 'cruise.value', create=True) == {}
+    assert properties['cruise'] == {'properties': {'value': {}}}
+
+def test_field_tuning_is_the_same_in_every_type():
+    from oceanproteinportal.store.mapping import tuneFieldUsage
+
+    mappings = {
+      'protein': {'properties': {'_dataset': {'type': 'keyword'}, 'proteins': {'type': 'integer'}}},
+      'sequence': {'properties': {'_dataset': {'type': 'keyword'}, 'residues': {'type': 'keyword'}}},
+      'tile': {'properties': {'proteins': {'type': 'integer'}, 'location': {'type': 'geo_point'}}},
+    }
+    tuneFieldUsage(mappings)
+    assert mappings['protein']['properties']['_dataset'] == mappings['sequence']['properties']['_dataset'] == {'type': 'keyword', 'eager_global_ordinals': True}
+    assert mappings['protein']['properties']['proteins'] == mappings['tile']['properties']['proteins'] == {'type': 'integer', 'index': False, 'doc_values': False}
+    assert mappings['tile']['properties']['location'] == {'type': 'geo_point'}
+
+def test_memory_budget_rearms_after_spill():
+    from oceanproteinportal.memory import MemoryBudget, RESPILL_SHARE
+
+    # Resident memory the allocator keeps after a spill
+    usage = [0]
+    budget = MemoryBudget(1000, check_interval=0, usage=lambda: usage[0])
+    usage[0] = 900
+    assert not budget.exceeded()
+    usage[0] = 1200
+    assert budget.exceeded()
+    budget.spilled()
+    assert not budget.exceeded()
+    usage[0] = 1200 + int(1000 * RESPILL_SHARE) - 1
+    assert not budget.exceeded()
+    usage[0] = 1200 + int(1000 * RESPILL_SHARE) + 1
+    assert budget.exceeded()
+    # A spill giving the memory back restores the limit
+    usage[0] = 100
+    budget.spilled()
+    usage[0] = 1001
+    assert budget.exceeded()
+    assert budget.spills == 2
+
+def test_memory_budget_rss_path():
+    from oceanproteinportal.memory import MemoryBudget, currentRSS
+
+    budget = MemoryBudget(currentRSS() // 2, check_interval=0)
+    assert budget.exceeded()
+    budget.spilled()
+    assert not budget.exceeded()
+
+def test_lru_cache_evicts_once_per_spill():
+    from oceanproteinportal.memory import MemoryBudget
+    from oceanproteinportal.utils import LRUCache
+
+    usage = [2000]
+    budget = MemoryBudget(1000, check_interval=0, usage=lambda: usage[0])
+    cache = LRUCache(maxsize=100, budget=budget)
+    for key in 'abcdefgh':
+        cache.set(key, 1)
+    # One eviction (of nothing yet) raised the cache's threshold past usage
+    assert len(cache) == 8
+    usage[0] = 2600
+    cache.set('i', 1)
+    assert len(cache) == 5
+    # The shared budget's threshold did not move: its other users still spill
+    assert budget.exceeded() and budget.spills == 0
+
+def protein_row(protein, sample, count=1):
+    return {
+      'proteinId': 'protein-%s' % (protein),
+      'spectralCount:sampleId': 'sample-%s' % (sample),
+      'spectralCount:count': count
+    }
+
+def test_protein_grouper_keeps_first_count_per_sample():
+    from oceanproteinportal.store.proteins import ProteinGrouper
+
+    grouper = ProteinGrouper('dataset', generateGuid=lambda proteinId: 'guid-' + proteinId)
+    grouper.add(protein_row(1, 'a', count=3))
+    grouper.add(protein_row(1, 'a', count=5))
+    grouper.add(protein_row(1, 'b', count=7))
+    assert grouper.duplicates == 1
+    (proteinId, document, spilled), = list(grouper.spill())
+    assert not spilled
+    assert [(entry['sampleId'], entry['count']) for entry in document['spectralCount']] == [('sample-a', 3), ('sample-b', 7)]
+    # After a spill the protein's later rows are appended
+    grouper.add(protein_row(1, 'c'))
+    (proteinId, document, spilled), = list(grouper.spill())
+    assert spilled
+    assert [entry['sampleId'] for entry in document['spectralCount']] == ['sample-c']
+
+def test_protein_grouper_appends_partial_loads():
+    from oceanproteinportal.store.proteins import ProteinGrouper
+
+    grouper = ProteinGrouper('dataset', generateGuid=lambda proteinId: 'guid-' + proteinId, append=True)
+    grouper.add(protein_row(1, 'a'))
+    grouper.add(protein_row(2, 'a'))
+    assert [spilled for proteinId, document, spilled in grouper.spill()] == [True, True]
+
+def test_identifier_map_round_trip_and_index_binding(tmp_path):
+    import uuid
+    from oceanproteinportal.idmap import documentHash, openIdentifierMap
+
+    guid = str(uuid.uuid4())
+    doc_hash = documentHash({'b': 1, 'a': [1, 2]})
+    assert doc_hash == documentHash({'a': [1, 2], 'b': 1})
+    with openIdentifierMap(str(tmp_path / 'maps'), 'dataset', version='1.0') as identifier_map:
+        assert not identifier_map.bindIndex('index-1')
+        identifier_map.put('protein', 'P1', guid=guid, rows=2, doc_hash=doc_hash)
+        identifier_map.put('protein', 'P1', guid=guid, rows=3, doc_hash=doc_hash)
+        assert identifier_map.get('protein', 'P1') == {'guid': guid, 'version': '1.0', 'rows': 5, 'hash': doc_hash}
+        assert identifier_map.get('peptide', 'P1') is None
+        assert identifier_map.contains('protein', ['P1', 'P2']) == {'P1'}
+        assert identifier_map.isUnchanged('protein', 'P1', doc_hash)
+    with openIdentifierMap(str(tmp_path / 'maps'), 'dataset') as identifier_map:
+        assert not identifier_map.bindIndex('index-1')
+        assert identifier_map.count('protein') == 1
+        # A recreated index invalidates what the map recorded
+        assert identifier_map.bindIndex('index-2')
+        assert identifier_map.count('protein') == 0
+
+def test_ingest_manifest_counts_accepted_rows(tmp_path):
+    from oceanproteinportal.verify import IngestManifest, changedSources, readManifest
+
+    source = tmp_path / 'proteins.csv'
+    source.write_text('protein_id,sample_id\n')
+    rows = [{'proteinId': 'P%s' % (i % 4), 'spectralCount:sampleId': 'S%s' % (i)} for i in range(10)]
+    forwards = IngestManifest()
+    backwards = IngestManifest()
+    forwards.source('protein', str(source))
+    for row in rows:
+        forwards.read('protein', row)
+    for row in reversed(rows):
+        backwards.read('protein', row)
+    # A rejected row is read, not added
+    for row in rows[:-1]:
+        forwards.add('protein', row)
+    resources = forwards.resources()
+    assert resources['protein']['checksum'] == backwards.resources()['protein']['checksum']
+    assert (resources['protein']['read'], resources['protein']['rows'], resources['protein']['documents']) == (10, 9, 4)
+    assert len(forwards) == 9
+    forwards.save(str(tmp_path / 'manifest.json'), datasetId='dataset')
+    saved = readManifest(str(tmp_path / 'manifest.json'))
+    assert saved['datasetId'] == 'dataset'
+    assert changedSources(saved['resources']) == []
+    source.write_text('protein_id,sample_id\nP1,S1\n')
+    assert changedSources(saved['resources']) == ['protein']
+
+def test_verify_samples_lines_and_diffs_documents(tmp_path):
+    from oceanproteinportal.verify import containsEntry, diffDocument, sampleLines
+
+    source = tmp_path / 'proteins.csv'
+    source.write_text('protein_id,count\n' + ''.join('P%s,%s\n' % (i, i) for i in range(100)))
+    lines = sampleLines(str(source), 20, seed=1)
+    assert 0 < len(lines) <= 20
+    assert all(values == ['P%s' % (values[1]), values[1]] for offset, values in lines)
+    assert sampleLines(str(source), 20, seed=1) == lines
+    assert diffDocument({'a': 1, 'b': {'c': [1, 2]}, 'skipped': None}, {'a': 1.0, 'b': {'c': [1, 3]}}) == ['b.c[1]']
+    assert diffDocument({'a': [1]}, {'a': [1, 2]}) == ['a']
+    assert containsEntry({'sampleId': 'S1', 'count': 2}, [{'sampleId': 'S0', 'count': 2}, {'sampleId': 'S1', 'count': 2, 'nsaf': 0.5}])
+
+def test_verify_samples_whole_records_of_the_loaded_rows(tmp_path):
+    import csv
+    from oceanproteinportal.datapackage import recordOffsets
+    from oceanproteinportal.verify import sampleLines
+
+    source = tmp_path / 'proteins.csv'
+    with open(str(source), 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['protein_id', 'name', 'count'])
+        for i in range(1, 61):
+            writer.writerow(['P%s' % (i), 'line one\nline "two"\n,three' if i % 3 == 0 else 'name %s' % (i), i])
+    with open(str(source), newline='') as handle:
+        expected = dict((row, values) for row, values in enumerate(csv.reader(handle)))
+    data = source.read_bytes()
+    for chunk_size in (1, 5, 64, 1 << 20):
+        offsets = recordOffsets(str(source), [0, 1, 3, 4, 30, 60], chunk_size=chunk_size)
+        assert sorted(offsets) == [0, 1, 3, 4, 30, 60]
+        for row, offset in offsets.items():
+            assert next(csv.reader(data[offset:].decode('utf-8').splitlines(True))) == expected[row]
+
+    lines = sampleLines(str(source), 100, seed=3)
+    assert len(lines) == 60
+    assert [values for offset, values in lines] == [expected[row] for row in range(1, 61)]
+    # Only the rows a partial load read are sampled
+    lines = sampleLines(str(source), 5, seed=3, row_start=21, row_stop=30)
+    assert len(lines) == 5
+    assert all(21 <= int(values[2]) <= 30 and values == expected[int(values[2])] for offset, values in lines)
+    assert sampleLines(str(source), 5, row_start=61) == []
+
+def test_columnar_columns_round_trip(tmp_path):
+    import datetime
+    import json
+    from oceanproteinportal.columnar import ColumnarTable, ColumnWriter
+
+    fields = [{'name': 'id', 'type': 'string'}, {'name': 'count', 'type': 'integer'}, {'name': 'depth', 'type': 'number'}, {'name': 'seen', 'type': 'date'}, {'name': 'ok', 'type': 'boolean'}]
+    rows = [
+      ['P1', 3, 1.5, datetime.date(2020, 1, 2), True],
+      [None, None, None, None, None],
+      ['Pé', -1, 0.0, datetime.date(2021, 3, 4), False],
+    ]
+    writers = [ColumnWriter(str(tmp_path), index, field['type']) for index, field in enumerate(fields)]
+    for values in rows:
+        for writer, value in zip(writers, values):
+            writer.append(value)
+    for writer in writers:
+        writer.close()
+    (tmp_path / 'meta.json').write_text(json.dumps({'rows': len(rows), 'fields': fields}))
+    table = ColumnarTable(str(tmp_path))
+    try:
+        assert len(table) == 3
+        assert list(table.iter()) == rows
+        assert list(table.iter(keyed=True, start=2)) == [dict(zip(table.headers, rows[2]))]
+    finally:
+        table.close()
+
+def test_content_hash_is_computed_once(tmp_path, monkeypatch):
+    import oceanproteinportal.datapackage
+    from oceanproteinportal import columnar
+
+    source = tmp_path / 'proteins.csv'
+    source.write_text('protein_id\nP1\n')
+    hashed = []
+    fileStats = oceanproteinportal.datapackage.fileStats
+    monkeypatch.setattr(oceanproteinportal.datapackage, 'fileStats', lambda path: hashed.append(path) or fileStats(path))
+    first = columnar.contentHash(str(source))
+    assert columnar.contentHash(str(source)) == first
+    assert len(hashed) == 1
+    source.write_text('protein_id\nP2\nP3\n')
+    assert columnar.contentHash(str(source)) != first
+    assert len(hashed) == 2
+
+def test_serializers_agree_on_documents():
+    import datetime
+    import decimal
+    import json
+    from oceanproteinportal.store.serializer import BulkBuffer, JSONSerializer
+
+    document = {
+      'abundance': {17: {'nsaf': 0.5}, 'S2': {'nsaf': 0.25}},
+      'count': decimal.Decimal('2.5'),
+      'dateTime': datetime.datetime(2020, 1, 2, 3, 4, 5),
+      'tags': ('a', 'b'),
+      'name': 'café'
+    }
+    expected = {'abundance': {'17': {'nsaf': 0.5}, 'S2': {'nsaf': 0.25}}, 'count': 2.5, 'dateTime': '2020-01-02T03:04:05', 'tags': ['a', 'b'], 'name': 'café'}
+    for name in ('orjson', 'ujson', 'json'):
+        try:
+            serializer = JSONSerializer(name)
+        except Exception:
+            continue
+        assert json.loads(serializer.dumps(document).decode('utf-8')) == expected, name
+        assert serializer.loads(serializer.dumps(document)) == expected, name
+
+    buffer = BulkBuffer(JSONSerializer('json'), max_actions=2)
+    assert not buffer.add({'_index': 'i', '_type': 'protein', '_id': '1', '_routing': 'd', '_source': {'a': 1}})
+    assert buffer.add({'_op_type': 'delete', '_index': 'i', '_type': 'protein', '_id': '2'})
+    lines = [json.loads(line) for line in buffer.getvalue().decode('utf-8').splitlines()]
+    assert lines == [{'index': {'_index': 'i', '_type': 'protein', '_id': '1', '_routing': 'd'}}, {'a': 1}, {'delete': {'_index': 'i', '_type': 'protein', '_id': '2'}}]
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.getvalue() == b''
+
+class FakeQueryStore:
+    """Just what ElasticQuery needs of a routed ElasticStore, over an in-memory index"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = 0
+        self.listeners = []
+
+    def getMemoryBudget(self):
+        return None
+
+    def addWriteListener(self, listener):
+        self.listeners.append(listener)
+
+    def notifyDatasetWrite(self, datasetId):
+        for listener in self.listeners:
+            listener(datasetId)
+
+    def getRouting(self, datasetId):
+        return datasetId
+
+    def isRouted(self):
+        return True
+
+    def getIndex(self):
+        return 'index'
+
+    def getStore(self):
+        return self
+
+    def search(self, index, doc_type, body, filter_path=None, routing=None):
+        self.searches += 1
+        hits = []
+        for guid in body['query']['ids']['values']:
+            source = self.documents[guid]
+            hits.append({'_source': dict((field, value) for field, value in source.items() if field in body.get('_source', source))})
+        return {'hits': {'hits': hits}}
+
+class FakeElasticsearch:
+    """An elasticsearch.Elasticsearch client recording the requests an ElasticStore sends"""
+
+    def __init__(self, *args, **kwargs):
+        self.requests = []
+        self.transport = self
+        self.indices = self
+
+    def perform_request(self, method, url, body=None):
+        import json
+        if url != '/_bulk':
+            self.requests.append((url, body))
+            return {'acknowledged': True}
+        lines = [json.loads(line) for line in bytes(body).decode('utf-8').splitlines()]
+        self.requests.append(('bulk', {'actions': lines}))
+        items = []
+        position = 0
+        while position < len(lines):
+            op_type, meta = next(iter(lines[position].items()))
+            position += 1 if op_type == 'delete' else 2
+            items.append({op_type: dict(meta, status=201, result='created')})
+        return {'items': items}
+
+    def get_settings(self, index, ignore=None):
+        return {'status': 404}
+
+    def scan(self, **kwargs):
+        self.requests.append(('scan', kwargs))
+        return []
+
+    def get(self, **kwargs):
+        self.requests.append(('get', kwargs))
+        raise sys.modules['elasticsearch.exceptions'].NotFoundError(404, 'not_found')
+
+    def parallel_bulk(self, actions):
+        actions = list(actions)
+        self.requests.append(('parallel_bulk', {'actions': actions}))
+        for action in actions:
+            yield True, {action['_op_type']: {'_id': action['_id'], 'status': 201}}
+
+    def __getattr__(self, name):
+        # index, update, delete, delete_by_query, ...: recorded, answered as not found
+        def request(**kwargs):
+            self.requests.append((name, kwargs))
+            return {'result': 'created', 'found': False, 'deleted': 0, 'docs': [], 'count': 0}
+        return request
+
+def elastic_store(monkeypatch, **kwargs):
+    """An ElasticStore over a FakeElasticsearch client"""
+    import types
+
+    module = types.ModuleType('elasticsearch')
+    module.Elasticsearch = FakeElasticsearch
+    module.helpers = types.ModuleType('elasticsearch.helpers')
+    module.helpers.scan = lambda client, **kwargs: client.scan(**kwargs)
+    module.helpers.parallel_bulk = lambda client, actions, **kwargs: client.parallel_bulk(actions)
+    module.exceptions = types.ModuleType('elasticsearch.exceptions')
+    module.exceptions.NotFoundError = type('NotFoundError', (Exception,), {})
+    for name, value in (('elasticsearch', module), ('elasticsearch.helpers', module.helpers), ('elasticsearch.exceptions', module.exceptions)):
+        monkeypatch.setitem(sys.modules, name, value)
+    from oceanproteinportal.store.elasticsearch import ElasticStore
+    return ElasticStore('localhost', 9200, 'opp', 'schema.json', **kwargs)
+
+def strict_resource_rows(rows):
+    """An iterResourceRows over mapped rows, where None is a row that only a quarantine gets past"""
+    def iterResourceRows(datapackage, resource, type, quarantine=None, **kwargs):
+        for row_count, row in enumerate(rows, start=1):
+            if quarantine is not None:
+                quarantine.count(type)
+            if row is None:
+                if quarantine is None:
+                    raise ValueError('Row %s: cannot cast "n/a" to number' % (row_count))
+                quarantine.reject(type, row_count, {}, ValueError('cannot cast'), stage='read')
+                continue
+            yield row_count, row
+    return iterResourceRows
+
+def bulk_sources(client, type):
+    """The documents a FakeElasticsearch client was sent in bulk index actions of a type"""
+    sources = []
+    for name, request in client.requests:
+        if name != 'bulk':
+            continue
+        actions = request['actions']
+        for meta, source in zip(actions[::2], actions[1::2]):
+            if meta.get('index', {}).get('_type', None) == type:
+                sources.append(source)
+    return sources
+
+def test_rollups_skip_rows_the_protein_load_quarantined(monkeypatch):
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.store import elasticsearch
+
+    store = elastic_store(monkeypatch)
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type)
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 2, 'ncbi:id': '2'},
+      None,
+      {'proteinId': 'P2', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 6, 'ncbi:id': '2'},
+    ]))
+    store.updateDatasetRollups(datapackage=None, datasetId='ds')
+    rollups = bulk_sources(store.getStore(), 'rollup')
+    assert [(rollup['key'], rollup['totalSpectralCount']) for rollup in rollups] == [('2', 8.0)]
+
+def test_store_routes_reads_and_writes_by_dataset(monkeypatch):
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.store import elasticsearch
+
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type)
+    monkeypatch.setattr(datapackage, 'datapackageCruises', lambda datapackage: {})
+    monkeypatch.setattr(elasticsearch, 'generateProteinGuid', lambda datapackage, datasetId, proteinId: 'guid-' + proteinId)
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 1, 'ncbi:id': '2'},
+    ]))
+    for routing, expected in ((True, 'ds'), (False, None)):
+        store = elastic_store(monkeypatch, routing=routing)
+        store.load(data={'name': 'dataset'}, type='dataset', id='ds')
+        store.update(data={'name': 'renamed'}, type='dataset', id='ds', datasetId='ds')
+        store.loadProteins(datapackage=None, datasetId='ds')
+        store.updateDatasetRollups(datapackage=None, datasetId='ds')
+        store.deleteDataset('ds')
+        requests = store.getStore().requests
+        routed = [(name, request['routing']) for name, request in requests if name in ('index', 'update', 'get', 'delete_by_query', 'delete')]
+        assert routed == [('index', expected), ('update', expected), ('get', expected), ('index', expected), ('delete_by_query', expected), ('delete', expected)]
+        metas = [next(iter(meta.values())) for name, request in requests if name == 'bulk' for meta in request['actions'][::2]]
+        assert metas and [meta.get('_routing', None) for meta in metas] == [expected] * len(metas)
+
+def test_index_body_requires_routing_with_a_partition_size():
+    from oceanproteinportal.store import mapping
+
+    schema = read_config('elasticsearch_schema.json')
+    template_mappings = read_config('ontology_template_mappings.yaml')['v1.0']
+    elastic_mappings = read_config('ontology_elasticsearch_mappings.yaml')['v1.0']
+    body = mapping.generateIndexBody(schema, template_mappings, elastic_mappings)
+    assert not [doc_type for doc_type in body['mappings'].values() if '_routing' in doc_type]
+    assert body['settings']['index']['number_of_shards'] == 1
+    assert 'routing_partition_size' not in body['settings']['index']
+
+    body = mapping.generateIndexBody(schema, template_mappings, elastic_mappings, routing_partition_size=3)
+    assert [doc_type['_routing'] for doc_type in body['mappings'].values()] == [{'required': True}] * len(body['mappings'])
+    # A partition must be smaller than the index
+    assert body['settings']['index']['routing_partition_size'] == 3
+    assert body['settings']['index']['number_of_shards'] == 4
+    expected_documents = mapping.DOCUMENTS_PER_SHARD * 6
+    body = mapping.generateIndexBody(schema, template_mappings, elastic_mappings, expected_documents=expected_documents, routing_partition_size=3)
+    assert body['settings']['index']['number_of_shards'] == max(4, mapping.shardCount(expected_documents))
+
+def test_append_mode_sends_scripted_upserts(monkeypatch):
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.store import elasticsearch
+
+    store = elastic_store(monkeypatch)
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type)
+    monkeypatch.setattr(datapackage, 'datapackageCruises', lambda datapackage: {})
+    monkeypatch.setattr(elasticsearch, 'generateProteinGuid', lambda datapackage, datasetId, proteinId: 'guid-' + proteinId)
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      {'proteinId': 'P1', 'productName': 'one', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 1, 'filterSize:minimum': 0.2},
+      {'proteinId': 'P1', 'productName': 'one', 'spectralCount:sampleId': 'S2', 'spectralCount:count': 3},
+    ]))
+    store.loadProteins(datapackage=None, datasetId='ds', mode='append')
+    requests = store.getStore().requests
+    # The stored scripts are put before the upserts, and nothing is read
+    assert ('/_scripts/' + elasticsearch.APPEND_SPECTRAL_COUNT_SCRIPT_ID) in [name for name, request in requests]
+    assert 'get' not in [name for name, request in requests]
+    actions = [request for name, request in requests if name == 'parallel_bulk'][0]['actions']
+    assert [(action['_op_type'], action['_type'], action['_id'], action['_routing'], action['_retry_on_conflict']) for action in actions] == [('update', 'protein', 'guid-P1', 'ds', 3)] * 2
+    first, second = actions
+    assert first['script']['stored'] == elasticsearch.APPEND_SPECTRAL_COUNT_SCRIPT_ID
+    assert [(count['sampleId'], count['count']) for count in first['script']['params']['spectralCount']] == [('S1', 1)]
+    assert first['script']['params']['filterSize'] == first['upsert']['filterSize']
+    assert second['script']['params']['filterSize'] is None
+    assert [count['sampleId'] for count in second['script']['params']['spectralCount']] == ['S2']
+    # A new protein is created from the upsert document, with only its row's count
+    assert (second['upsert']['guid'], second['upsert']['_dataset'], second['upsert']['productName']) == ('guid-P1', 'ds', 'one')
+    assert [count['sampleId'] for count in second['upsert']['spectralCount']] == ['S2']
+
+def test_index_mode_appends_to_proteins_the_identifier_map_knows(monkeypatch, tmp_path):
+    import json
+    import uuid
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.idmap import openIdentifierMap
+    from oceanproteinportal.store import elasticsearch
+
+    guids = {'P1': str(uuid.uuid4()), 'P2': str(uuid.uuid4())}
+    store = elastic_store(monkeypatch)
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type)
+    monkeypatch.setattr(datapackage, 'datapackageCruises', lambda datapackage: {})
+    monkeypatch.setattr(elasticsearch, 'generateProteinGuid', lambda datapackage, datasetId, proteinId: guids[proteinId])
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 1},
+      {'proteinId': 'P2', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 2},
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S2', 'spectralCount:count': 3},
+    ]))
+    with openIdentifierMap(str(tmp_path / 'maps'), 'ds') as identifier_map:
+        identifier_map.put('protein', 'P1', guid=guids['P1'])
+        store.setIdentifierMap(identifier_map)
+        store.loadProteins(datapackage=None, datasetId='ds')
+    requests = store.getStore().requests
+    assert 'get' not in [name for name, request in requests]
+    assert [request['id'] for name, request in requests if name == 'index'] == [guids['P2']]
+    updates = [request for name, request in requests if name == 'update']
+    assert [update['id'] for update in updates] == [guids['P1'], guids['P1']]
+    body = json.loads(updates[1]['body'])
+    assert body['script']['stored'] == elasticsearch.APPEND_SPECTRAL_COUNT_SCRIPT_ID
+    assert [count['sampleId'] for count in body['script']['params']['spectralCount']] == ['S2']
+    assert body['upsert']['guid'] == guids['P1']
+
+def test_query_cache_tags_proteins_by_dataset():
+    from oceanproteinportal.store.query import ElasticQuery
+
+    store = FakeQueryStore({'g1': {'guid': 'g1', '_dataset': 'd1', 'proteinId': 'P1', 'productName': 'one'}})
+    query = ElasticQuery(store)
+    # Without its datasetId the protein is looked up on every shard
+    assert query.getProtein('g1', fields=['proteinId']) == {'proteinId': 'P1'}
+    assert query.getProtein('g1', fields=['proteinId']) == {'proteinId': 'P1'}
+    assert store.searches == 1
+    store.documents['g1']['proteinId'] = 'P1-renamed'
+    store.notifyDatasetWrite('d2')
+    assert query.getProtein('g1', fields=['proteinId']) == {'proteinId': 'P1'}
+    store.notifyDatasetWrite('d1')
+    assert query.getProtein('g1', fields=['proteinId']) == {'proteinId': 'P1-renamed'}
+    assert store.searches == 2
+
+def test_lru_cache_expires_and_invalidates(monkeypatch):
+    from oceanproteinportal import utils
+
+    now = [100.0]
+    monkeypatch.setattr(utils.time, 'monotonic', lambda: now[0])
+    cache = utils.LRUCache(maxsize=2, ttl=10)
+    cache.set('a', 1, tag='d1')
+    cache.set('b', 2, tag='d2')
+    assert cache.get('a') == 1
+    cache.set('c', 3, tag='d1')
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert cache.invalidate('d1') == 2
+    assert len(cache) == 0
+    cache.set('d', 4)
+    now[0] += 11
+    assert cache.get('d', 'expired') == 'expired'
+
+def test_quarantine_checks_rates_late_and_on_close(tmp_path):
+    import pytest
+    from oceanproteinportal.quarantine import Quarantine, readDeadLetters
+
+    path = str(tmp_path / 'dead' / 'letters.jsonl')
+    quarantine = Quarantine(path, max_error_rate=0.1, min_rows=10)
+    for row in range(1, 4):
+        quarantine.count('protein')
+        quarantine.reject('protein', row, {'proteinId': 'P%s' % (row)}, ValueError('bad'))
+    # 3 of 10 rows rejected: caught once there are enough rows for a rate
+    with pytest.raises(Exception, match='Error rate'):
+        for row in range(4, 11):
+            quarantine.count('protein')
+    # Closing checks the final rates too, unless the load failed anyway
+    with pytest.raises(Exception, match='Error rate'):
+        quarantine.close()
+    quarantine.close(check=False)
+    assert readDeadLetters(path) == {'protein': {1, 2, 3}}
+
+    quarantine = Quarantine(str(tmp_path / 'letters.jsonl'), max_error_rate=0.1, min_rows=10)
+    for row in range(20):
+        quarantine.count('peptide')
+    quarantine.reject('peptide', 2, {}, 'rejected', stage='bulk')
+    quarantine.close()
+    assert quarantine.errorRate('peptide') == 0.05
+
+def test_schema_stores_residues_unindexed():
+    residues = read_config('elasticsearch_schema.json')['mappings']['sequence']['properties']['residues']
+    assert residues == {'type': 'keyword', 'index': False, 'doc_values': False}
+
+def test_export_descriptor_declares_array_delimiters(monkeypatch):
+    from oceanproteinportal import datapackage, export
+
+    monkeypatch.chdir(os.path.join(REPO_ROOT, 'oceanproteinportal'))
+    descriptor = export.exportDescriptor({'guid': 'ds'}, 'ds', ontology_version='v1.0')
+    fields = dict(
+      (field['name'], field)
+      for resource in descriptor['resources'] for field in resource.get('schema', {}).get('fields', [])
+    )
+    for column in export.ARRAY_COLUMNS:
+        assert fields[column]['opp:fieldValueDelimiter'] == export.EXPORT_DELIMITER
+    assert 'opp:fieldValueDelimiter' not in fields['protein_id']
+
+    # An exported array column reads back as the values it was written from
+    peptide = {'proteinId': 'P1', 'identifiedProteins': ['P1', 'P2', 'P3']}
+    value = export.peptideRow(peptide)[[column for column, getter in export.PEPTIDE_COLUMNS].index('other_protein_ids')]
+    assert datapackage.processField(value, fields['other_protein_ids'], 'peptide') == ['P1', 'P2', 'P3']
+
+def test_infer_counts_csv_records_not_lines(tmp_path):
+    import csv
+    from oceanproteinportal import datapackage
+
+    path = tmp_path / 'proteins.csv'
+    with open(str(path), 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['protein_id', 'protein_name', 'spectral_count'])
+        writer.writerow(['P1', 'a "quoted"\nname\nover lines', '3'])
+        writer.writerow(['P2', 'plain', '1'])
+        writer.writerow(['P3', 'comma, and\r\nbreak', '2'])
+    with open(str(path), newline='') as handle:
+        records = sum(1 for row in csv.reader(handle))
+
+    descriptor = datapackage.inferTabularDescriptor({'path': str(path)}, field_mappings={'spectral_count': {'type': 'integer'}})
+    assert descriptor['opp:rowCount'] == records - 1 == 3
+    assert [field['type'] for field in descriptor['schema']['fields']][2] == 'integer'
+    # The quote state carries across chunk boundaries
+    for chunk_size in (1, 2, 3, 7):
+        stats = datapackage.fileStats(str(path), chunk_size=chunk_size)
+        assert stats['records'] == records
+        assert stats['lines'] > records
+        assert stats['hash'] == datapackage.fileStats(str(path))['hash']
+
+    # A last record without a line break still counts
+    path.write_bytes(b'protein_id\nP1\n"P2"')
+    assert datapackage.inferTabularDescriptor({'path': str(path)})['opp:rowCount'] == 2
+
+def test_peptide_matcher_finds_every_occurrence():
+    import random
+    from oceanproteinportal.coverage import PeptideMatcher, matchProteins, sequenceCoverage
+
+    generator = random.Random(7)
+    proteins = [(str(index), ''.join(generator.choice('ACDE') for _ in range(60))) for index in range(20)]
+    # Overlapping peptides, ones that are suffixes of others, and duplicates after cleaning
+    peptides = ['ACD', 'CD', 'D', 'CDEA', 'EEE', ' acd ', 'AAAAAAAAAAAAA']
+    matcher = PeptideMatcher(peptides)
+    assert len(matcher) == 6
+    assert 'acd' in matcher and 'W' not in matcher
+
+    for proteinId, sequence in proteins:
+        expected = sorted(
+          (start + 1, start + len(peptide), peptide)
+          for peptide in matcher.getPeptides()
+          for start in range(len(sequence) - len(peptide) + 1)
+          if sequence.startswith(peptide, start)
+        )
+        assert sorted(matcher.match(sequence)) == expected
+        assert sorted(matcher.match(sequence.lower())) == expected
+
+    try:
+        matcher.add('WW')
+        assert False, 'added a peptide after building'
+    except Exception as error:
+        assert 'after the matcher has been built' in str(error)
+
+    coverage = dict(matchProteins(PeptideMatcher(['MKT', 'KTA', 'QQ']), [('p1', 'MKTAYIAK'), ('p2', 'WWWW')]))
+    assert list(coverage) == ['p1']
+    assert coverage['p1']['sequenceCoverage'] == 50.0
+    assert [(match['sequence'], match['start'], match['stop']) for match in coverage['p1']['peptideMatches']] == [('MKT', 1, 3), ('KTA', 2, 4)]
+    assert sequenceCoverage(10, [(1, 3), (2, 5), (8, 8), (4, 4)]) == 60.0
+    # As read from a FASTA file: wrapped lines and a trailing stop
+    coverage = dict(matchProteins(PeptideMatcher(['KTAY']), [('p1', 'mk\nta y\nIAKQW*')]))
+    assert coverage['p1']['sequenceCoverage'] == 40.0
+    assert coverage['p1']['peptideMatches'] == [{'sequence': 'KTAY', 'start': 2, 'stop': 5}]
+    assert sequenceCoverage(0, [(1, 1)]) == 0.0
+
+def test_fasta_round_trip_and_split(tmp_path):
+    from oceanproteinportal import fasta
+
+    records = [('P%s description %s' % (index, index), 'MKT' * (index * 7 + 1)) for index in range(50)]
+    path = tmp_path / 'proteins.fasta'
+    with open(str(path), 'w') as handle:
+        fasta.writeFasta(handle, records, width=10)
+    expected = [(header.split()[0], sequence) for header, sequence in records]
+
+    assert list(fasta.iterFasta(str(path))) == expected
+    assert [description for _, description, _ in fasta.readFasta(str(path), descriptions=True)] == [header for header, _ in records]
+    # Header-aligned ranges read back every record exactly once
+    for parts in (1, 2, 3, 16, 500):
+        ranges = fasta.splitFasta(str(path), parts)
+        assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+        assert [record for start, stop in ranges for record in fasta.readFasta(str(path), start, stop)] == expected
+
+    # Windows line breaks, blank lines and a record without residues
+    path.write_bytes(b'>a x\r\nMK T\r\n\r\nAY*\r\n>b\r\n>c\nQQ')
+    assert list(fasta.readFasta(str(path))) == [('a', 'MKTAY*'), ('b', ''), ('c', 'QQ')]
+    path.write_bytes(b'')
+    assert list(fasta.readFasta(str(path))) == []
+    assert fasta.splitFasta(str(path), 4) == [(0, 0)]
+
+    assert fasta.cleanSequence(' mk t\nay* ') == 'MKTAY'
+    assert fasta.sequenceHash(fasta.cleanSequence('mkt\n')) == fasta.sequenceHash('MKT')
+
+def test_infer_field_types_from_sampled_blocks(tmp_path):
+    import hashlib
+    from oceanproteinportal import datapackage
+
+    assert datapackage.inferFieldType(['1', '', '-2']) == 'integer'
+    assert datapackage.inferFieldType(['1', '2.5']) == 'number'
+    assert datapackage.inferFieldType(['True', 'false']) == 'boolean'
+    assert datapackage.inferFieldType(['2017-01-31']) == 'date'
+    assert datapackage.inferFieldType(['2017-01-31T10:00:00Z']) == 'datetime'
+    assert datapackage.inferFieldType(['1', 'x']) == 'string'
+    assert datapackage.inferFieldType(['']) == 'string'
+
+    path = tmp_path / 'peptides.csv'
+    lines = ['\ufeffsample_id,depth_m,peptide_sequence,note']
+    lines.extend('S%s,%s,PEPTIDE%s,' % (row, row * 0.5, row) for row in range(5000))
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    header, samples = datapackage.sampleCsvRows(str(path), sample_rows=20, sample_blocks=5)
+    assert header == ['sample_id', 'depth_m', 'peptide_sequence', 'note']
+    assert 20 * 4 <= len(samples) <= 20 * 5
+    assert len(set(tuple(row) for row in samples)) == len(samples)
+
+    descriptor = datapackage.inferTabularDescriptor({'path': str(path)}, field_mappings={'sample_id': {'type': 'string'}}, sample_rows=20, sample_blocks=5)
+    assert [(field['name'], field['type']) for field in descriptor['schema']['fields']] == [
+      ('sample_id', 'string'), ('depth_m', 'number'), ('peptide_sequence', 'string'), ('note', 'string')
+    ]
+    assert descriptor['opp:rowCount'] == 5000
+    assert descriptor['bytes'] == path.stat().st_size
+    assert descriptor['hash'] == hashlib.md5(path.read_bytes()).hexdigest()
+    assert 'bytes' not in datapackage.inferTabularDescriptor({'path': str(path)}, stats=False)
+
+def test_export_parts_merge_into_export_files(tmp_path):
+    import csv
+    from oceanproteinportal import export
+
+    parts_directory = tmp_path / 'parts'
+    parts_directory.mkdir()
+    protein = {
+      'proteinId': 'P1',
+      'productName': 'name, with comma',
+      'kegg': {'id': 'K1', 'pathway': [{'value': 'second', 'index': 1}, {'value': 'first', 'index': 0}]},
+      'otherIdentifiedProteins': ['P2', None, 'P3'],
+      'spectralCount': [
+        {'sampleId': 'S1', 'count': 3, 'depth': 10.5, 'dateTime': '2017-01-31T10:20:30', 'cruise': {'value': 'C1'}, 'coordinate': {'lat': 1.0, 'lon': 2.0}},
+        {'sampleId': 'S2', 'count': 1},
+      ]
+    }
+    writers = [export.ExportPartWriter(str(parts_directory), part) for part in range(2)]
+    writers[0].writeProtein(protein, sequence='MKTAY')
+    writers[1].writeProtein({'proteinId': 'P4', 'fullSequence': 'QQ'})
+    writers[1].writeProtein({'proteinId': 'P5'})
+    writers[1].writePeptide({'sampleName': 'S1', 'proteinId': 'P1', 'peptideSequence': 'MKT', 'identifiedProteins': ['P1']})
+    for writer in writers:
+        writer.close()
+    assert writers[0].counts == {'protein': 1, 'proteinRows': 2, 'peptide': 0}
+    assert writers[1].counts == {'protein': 2, 'proteinRows': 2, 'peptide': 1}
+
+    export.mergeParts(str(tmp_path), str(parts_directory), 2)
+    assert not parts_directory.exists()
+    with open(str(tmp_path / export.EXPORT_FILES['protein']), newline='') as handle:
+        rows = list(csv.DictReader(handle))
+    assert [column for column, getter in export.PROTEIN_COLUMNS] == list(rows[0].keys())
+    assert [(row['protein_id'], row['sample_id']) for row in rows] == [('P1', 'S1'), ('P1', 'S2'), ('P4', ''), ('P5', '')]
+    assert rows[0]['protein_name'] == 'name, with comma'
+    assert rows[0]['kegg_pathway'] == 'first || second'
+    assert rows[0]['other_identified_proteins'] == 'P2 || P3'
+    assert (rows[0]['date_y-m-d'], rows[0]['time_h-m-s'], rows[0]['cruise_id']) == ('2017-01-31', '10:20:30', 'C1')
+    with open(str(tmp_path / export.EXPORT_FILES['peptide']), newline='') as handle:
+        peptides = list(csv.DictReader(handle))
+    assert [(row['sample_id'], row['peptide_sequence'], row['other_protein_ids']) for row in peptides] == [('S1', 'MKT', 'P1')]
+    with open(str(tmp_path / export.EXPORT_FILES['fasta'])) as handle:
+        assert handle.read() == '>P1\nMKTAY\n>P4\nQQ\n'
+
+def test_exported_files_read_back_for_ingest(tmp_path, monkeypatch):
+    from oceanproteinportal import export, fasta, validate, verify
+
+    parts_directory = tmp_path / 'parts'
+    parts_directory.mkdir()
+    writer = export.ExportPartWriter(str(parts_directory), 0)
+    for index in range(50):
+        writer.writeProtein({
+          'proteinId': 'P%s' % (index),
+          'productName': 'protein, %s' % (index),
+          'otherIdentifiedProteins': ['Q%s' % (index), 'R%s' % (index)],
+          'spectralCount': [{'sampleId': 'S1', 'count': index, 'depth': 5.5, 'dateTime': '2017-01-31T10:20:30'}]
+        }, sequence='MKTAY' * (index + 1))
+        writer.writePeptide({'sampleName': 'S1', 'proteinId': 'P%s' % (index), 'peptideSequence': 'MKT', 'spectralCountSum': index})
+    writer.close()
+    export.mergeParts(str(tmp_path), str(parts_directory), 1)
+    monkeypatch.chdir(os.path.join(REPO_ROOT, 'oceanproteinportal'))
+    resources = dict((resource['path'], resource) for resource in export.exportDescriptor({'guid': 'ds'}, 'ds', ontology_version='v1.0')['resources'])
+    assert sorted(resources) == sorted(export.EXPORT_FILES.values())
+
+    fasta_path = str(tmp_path / export.EXPORT_FILES['fasta'])
+    records = list(fasta.readFasta(fasta_path))
+    assert records[3] == ('P3', 'MKTAY' * 4) and len(records) == 50
+    assert sum(len(list(fasta.readFasta(fasta_path, start, stop))) for start, stop in fasta.splitFasta(fasta_path, 4)) == 50
+    assert validate.validateFasta(fasta_path, 'full', 0, None, 10)['errors'] == []
+    for kind in ('protein', 'peptide'):
+        path = str(tmp_path / export.EXPORT_FILES[kind])
+        for mode in validate.VALIDATION_MODES:
+            result = validate.validateTable(path, resources[export.EXPORT_FILES[kind]]['schema'], 'utf-8', mode, None, None, 10, sample_rows=5, sample_blocks=4)
+            assert result['errors'] == [] and result['rows'] > 0
+        sampled = verify.sampleLines(path, 10, seed=1)
+        width = len(export.PROTEIN_COLUMNS if kind == 'protein' else export.PEPTIDE_COLUMNS)
+        assert sampled and all(len(values) == width for offset, values in sampled)
+
+def test_taxonomy_index_round_trip(tmp_path):
+    from oceanproteinportal.taxonomy import TaxonomyIndex, buildTaxonomyIndex
+
+    nodes = tmp_path / 'nodes.dmp'
+    names = tmp_path / 'names.dmp'
+    nodes.write_text(
+      '1\t|\t1\t|\tno rank\t|\n'
+      '2\t|\t1\t|\tsuperkingdom\t|\n'
+      '1117\t|\t2\t|\tphylum\t|\n'
+      '1129\t|\t1117\t|\tgenus\t|\n'
+      '167542\t|\t1129\t|\tspecies\t|\n'
+      '99\t|\t1\t|\tno rank\t|\n'
+    )
+    names.write_text(
+      '1\t|\troot\t|\t\t|\tscientific name\t|\n'
+      '2\t|\tBacteria\t|\tBacteria <bacteria>\t|\tscientific name\t|\n'
+      '2\t|\teubacteria\t|\t\t|\tgenbank common name\t|\n'
+      '1117\t|\tCyanobacteria\t|\t\t|\tscientific name\t|\n'
+      '1129\t|\tSynechococcus\t|\t\t|\tscientific name\t|\n'
+      '167542\t|\tProchlorococcus marinus str. MIT 9312\t|\t\t|\tscientific name\t|\n'
+    )
+    index_file = str(tmp_path / 'taxonomy.idx')
+    assert buildTaxonomyIndex(str(nodes), str(names), index_file) == 6
+
+    index = TaxonomyIndex(index_file, cache_size=4)
+    try:
+        assert len(index) == 6
+        assert '1129' in index and 3 not in index and 'x' not in index
+        assert index.name(2) == 'Bacteria'
+        assert index.taxon('99') == {'id': '99', 'name': None, 'rank': 'no rank', 'parent': '1'}
+        assert [taxon['id'] for taxon in index.lineage('167542')] == ['1', '2', '1117', '1129', '167542']
+        assert index.lineage(12345) == ()
+
+        ncbiTaxon = index.resolve({'id': '167542', 'name': None})
+        assert ncbiTaxon['name'] == 'Prochlorococcus marinus str. MIT 9312'
+        assert ncbiTaxon['rank'] == 'species'
+        assert ncbiTaxon['lineage'] == ['Bacteria', 'Cyanobacteria', 'Synechococcus', 'Prochlorococcus marinus str. MIT 9312']
+        assert ncbiTaxon['lineageIds'] == ['2', '1117', '1129', '167542']
+        # A name from the data wins, unknown taxa stay as they are
+        assert index.resolve({'id': '1129', 'name': 'Syn'})['name'] == 'Syn'
+        assert index.resolve({'id': '12345'}) == {'id': '12345'}
+        assert index.resolve(None) is None
+    finally:
+        index.close()
+
+    (tmp_path / 'bad.idx').write_bytes(b'\0' * 64)
+    try:
+        TaxonomyIndex(str(tmp_path / 'bad.idx'))
+        assert False, 'opened a file that is not an index'
+    except Exception as error:
+        assert 'Not a taxonomy index' in str(error)
+
+def test_abundance_rollup_totals_per_sample():
+    from oceanproteinportal.rollup import AbundanceRollup, rollupGuid, rollupRow
+
+    class Names:
+        def name(self, taxId):
+            return {'1129': 'Synechococcus'}.get(taxId, None)
+
+    rollup = AbundanceRollup()
+    rows = [
+      {'spectralCount:sampleId': 'S1', 'spectralCount:count': '3', 'ncbi:id': '1129', 'kegg:path': ['Photosynthesis', 'Photosynthesis', 'Glycolysis']},
+      {'spectralCount:sampleId': 'S1', 'spectralCount:count': 1, 'ncbi:id': '1129', 'ncbi:name': 'Syn', 'kegg:path': 'Glycolysis'},
+      {'spectralCount:sampleId': 'S1', 'spectralCount:count': 4},
+      {'spectralCount:sampleId': 'S2', 'spectralCount:count': 2, 'ncbi:id': '2'},
+      {'spectralCount:sampleId': None, 'spectralCount:count': 9, 'ncbi:id': '2'},
+      {'spectralCount:sampleId': 'S2', 'ncbi:id': '2'},
+    ]
+    for row in rows:
+        rollupRow(rollup, row, taxonomy=Names())
+    assert len(rollup) == 4
+    assert rollup.sampleTotal('S1') == 8.0 and rollup.sampleTotal('S3') == 0.0
+
+    documents = dict(((document['kind'], document['sampleId'], document['key']), document) for document in rollup.documents('ds'))
+    assert sorted(documents) == [('pathway', 'S1', 'Glycolysis'), ('pathway', 'S1', 'Photosynthesis'), ('taxon', 'S1', '1129'), ('taxon', 'S2', '2')]
+    taxon = documents[('taxon', 'S1', '1129')]
+    assert (taxon['totalSpectralCount'], taxon['proteins'], taxon['normalizedSpectralCount']) == (4.0, 2, 0.5)
+    # The name the data gives wins over the looked up one
+    assert taxon['keyName'] == 'Syn'
+    assert taxon['guid'] == rollupGuid('ds', 'taxon', 'S1', '1129') != rollupGuid('ds', 'taxon', 'S2', '1129')
+    # A protein counts once per pathway however often the pathway is listed
+    assert documents[('pathway', 'S1', 'Photosynthesis')]['totalSpectralCount'] == 3.0
+    assert documents[('pathway', 'S1', 'Glycolysis')]['keyName'] == 'Glycolysis'
+    assert documents[('taxon', 'S2', '2')]['keyName'] is None
+    assert documents[('taxon', 'S2', '2')]['normalizedSpectralCount'] == 1.0
+
+def test_phase_graph_runs_in_dependency_order_within_budgets():
+    import threading
+    from oceanproteinportal.phases import PhaseGraph
+
+    lock = threading.Lock()
+    events = []
+    running = {'store': 0, 'peak': 0}
+
+    def phase(name, sleep=0.05):
+        def run():
+            with lock:
+                events.append(('start', name))
+                running['store'] += 1
+                running['peak'] = max(running['peak'], running['store'])
+            time.sleep(sleep)
+            with lock:
+                running['store'] -= 1
+                events.append(('end', name))
+        return run
+
+    graph = PhaseGraph(max_workers=4, budgets={'store': 2})
+    graph.add('metadata', phase('metadata'))
+    graph.add('proteins', phase('proteins'), depends=['metadata'])
+    graph.add('peptides', phase('peptides'), depends=['metadata'])
+    graph.add('fasta', phase('fasta'), depends=['metadata'])
+    graph.add('rollups', phase('rollups'), depends=['proteins', 'fasta'])
+    assert graph.order() == ['metadata', 'proteins', 'peptides', 'fasta', 'rollups']
+    # Unselected dependencies count as done
+    assert graph.order(['rollups', 'fasta']) == ['fasta', 'rollups']
+
+    timings = graph.run()
+    assert sorted(timings) == ['fasta', 'metadata', 'peptides', 'proteins', 'rollups']
+    position = dict((event, index) for index, event in enumerate(events))
+    for name, depends in (('proteins', 'metadata'), ('peptides', 'metadata'), ('rollups', 'proteins'), ('rollups', 'fasta')):
+        assert position[('end', depends)] < position[('start', name)]
+    assert running['peak'] == 2
+
+    try:
+        graph.add('metadata', phase('metadata'))
+        assert False, 'added a phase twice'
+    except Exception as error:
+        assert 'Duplicate ingest phase' in str(error)
+
+    cyclic = PhaseGraph()
+    cyclic.add('a', phase('a'), depends=['b'])
+    cyclic.add('b', phase('b'), depends=['a'])
+    unknown = PhaseGraph()
+    unknown.add('a', phase('a'), depends=['missing'])
+    for graph, message in ((cyclic, 'depend on each other'), (unknown, 'Unknown ingest phase')):
+        try:
+            graph.order()
+            assert False, message
+        except Exception as error:
+            assert message in str(error)
+
+def test_phase_graph_stops_after_a_failure():
+    from oceanproteinportal.phases import PhaseGraph
+
+    ran = []
+
+    def fail():
+        raise ValueError('no store')
+
+    graph = PhaseGraph(max_workers=2)
+    graph.add('metadata', fail)
+    graph.add('unrelated', lambda: ran.append('unrelated'), budget=None)
+    graph.add('proteins', lambda: ran.append('proteins'), depends=['metadata'])
+    try:
+        graph.run()
+        assert False, 'the failure was not raised'
+    except ValueError as error:
+        assert str(error) == 'no store'
+    assert ran == ['unrelated']
+
+def test_validate_tables_and_fasta(tmp_path):
+    from oceanproteinportal import ontology, validate
+
+    fields = [
+      {'name': 'protein_id', 'type': 'string', 'constraints': {'required': True}},
+      {'name': 'spectral_count', 'type': 'number'},
+      {'name': 'depths', 'type': 'integer', 'opp:fieldValueDelimiter': ' || '},
+    ]
+    schema = {'fields': fields, 'missingValues': ['', 'NA']}
+    assert validate.checkValues(fields, ['P1', '2.5', '10 || 20'], {'', 'NA'}) is None
+    assert validate.checkValues(fields, ['NA', '1', ''], {'', 'NA'}) == 'protein_id is required'
+    assert validate.checkValues(fields, ['P1', 'x', ''], {'', 'NA'}) == "spectral_count: 'x' is not a valid number"
+    assert validate.checkValues(fields, ['P1', '1', '10 || deep'], {'', 'NA'}) == "depths: 'deep' is not a valid integer"
+
+    table = tmp_path / 'proteins.csv'
+    lines = ['protein_id,spectral_count,depths']
+    lines.extend('P%s,%s,%s || %s' % (row, row, row, row + 1) for row in range(1000))
+    lines[101] = 'P100,many,1'
+    lines[501] = 'P500,1'
+    table.write_text('\n'.join(lines) + '\n')
+
+    # Full mode over record-aligned ranges reports each bad row once, by row number in the first range
+    ranges = validate.splitLines(str(table), part_bytes=2000)
+    assert len(ranges) > 3 and ranges[-1][1] == table.stat().st_size
+    results = [validate.validateTable(str(table), schema, 'utf-8', 'full', start, stop, 10) for start, stop in ranges]
+    assert sum(result['rows'] for result in results) == 1000
+    errors = [error for result in results for error in result['errors']]
+    assert [error['error'] for error in errors] == ["spectral_count: 'many' is not a valid number", 'Expected 3 values, found 2']
+    assert errors[0]['row'] == 101
+    with open(str(table), 'rb') as handle:
+        handle.seek(errors[1]['offset'])
+        assert handle.readline() == b'P500,1\n'
+
+    result = validate.validateTable(str(table), schema, 'utf-8', 'full', None, None, 1)
+    assert result['stopped'] and len(result['errors']) == 1 and result['rows'] == 101
+    sampled = validate.validateTable(str(table), schema, 'utf-8', 'sample', None, None, 10, sample_rows=5, sample_blocks=4)
+    assert sampled['rows'] == 20 and not sampled['stopped']
+    assert 'does not match' in validate.validateTable(str(table), {'fields': fields[:2]}, 'utf-8', 'full', None, None, 10)['errors'][0]['error']
+
+    fasta = tmp_path / 'proteins.fasta'
+    fasta.write_text('>P1\nMKTAY*\n>P2\n\n>P3\nMK7A\n>P4\nQQ\n')
+    result = validate.validateFasta(str(fasta), 'full', 0, None, 10)
+    assert result['rows'] == 4
+    assert [(error['record'], error['error']) for error in result['errors']] == [('P2', 'P2 has no sequence'), ('P3', 'P3 has invalid residues')]
+    assert validate.describeLocation(result['errors'][0]) == 'record[P2]'
+    assert validate.describeLocation({'row': None, 'offset': 12}) == 'byte[12]'
+
+    class Resource:
+        def __init__(self, type, path, schema=None):
+            self.descriptor = {'path': str(path), 'odo-dt:dataType': {'@id': ontology.getDataFileType(type)}}
+            if schema is not None:
+                self.descriptor['schema'] = schema
+
+    class Package:
+        descriptor = {'ontology-version': 'v1.0'}
+        resources = [Resource('protein', table, schema), Resource('fasta', fasta)]
+
+    summary = validate.validateDatapackage(Package(), mode='full', max_errors=3, processes=2, part_bytes=2000)
+    assert not summary['valid']
+    assert summary['resources']['protein']['rows'] == 1000 and summary['resources']['fasta']['rows'] == 4
+    assert len(summary['errors']) == 3
+    assert set(error['type'] for error in summary['errors']) <= {'protein', 'fasta'}
+
+def test_validate_reads_quoted_values_spanning_lines(tmp_path):
+    import csv
+    from oceanproteinportal import datapackage, validate
+
+    fields = [{'name': 'protein_id', 'type': 'string'}, {'name': 'protein_name', 'type': 'string'}, {'name': 'spectral_count', 'type': 'number'}]
+    table = tmp_path / 'proteins.csv'
+    with open(str(table), 'w', newline='') as handle:
+        writer = csv.writer(handle, lineterminator='\n')
+        writer.writerow([field['name'] for field in fields])
+        for row in range(1, 301):
+            name = 'name %s' % (row) if row % 4 else 'first line\n"quoted", second\nthird\n'
+            writer.writerow(['P%s' % (row), name, 'many' if row == 252 else row])
+    with open(str(table), newline='') as handle:
+        records = list(csv.reader(handle))
+    offsets = datapackage.recordOffsets(str(table), range(301))
+    size = table.stat().st_size
+    # Every position maps to the next record start, never into a quoted value
+    starts = datapackage.recordStarts(str(table), range(0, size + 1, 7), chunk_size=64)
+    for position, (offset, record) in starts.items():
+        if record is None:
+            assert offset == size and position > offsets[300]
+        else:
+            assert offsets[record] == offset and position <= offset and (record == 0 or offsets[record - 1] < position)
+
+    ranges = validate.splitLines(str(table), part_bytes=500)
+    assert len(ranges) > 3 and ranges[0][0] == offsets[1] and set(start for start, stop in ranges) <= set(offsets.values())
+    results = [validate.validateTable(str(table), {'fields': fields}, 'utf-8', 'full', start, stop, 10) for start, stop in ranges]
+    assert sum(result['rows'] for result in results) == 300
+    errors = [error for result in results for error in result['errors']]
+    assert [(error['offset'], error['error']) for error in errors] == [(offsets[252], "spectral_count: 'many' is not a valid number")]
+    sampled = validate.validateTable(str(table), {'fields': fields}, 'utf-8', 'sample', None, None, 10, sample_rows=10, sample_blocks=100)
+    assert sampled['rows'] == 300
+    assert [(error['row'], error['offset']) for error in sampled['errors']] == [(252, offsets[252])]
+    assert records[252][1] == 'first line\n"quoted", second\nthird\n'
+
+def test_abundances_skip_rows_the_protein_load_quarantined(monkeypatch):
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.store import elasticsearch
+
+    store = elastic_store(monkeypatch)
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type if resource_type == 'protein' else None)
+    monkeypatch.setattr(elasticsearch, 'generateProteinGuid', lambda datapackage, datasetId, proteinId: 'guid-' + proteinId)
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 1},
+      {'proteinId': 'P2', 'spectralCount:sampleId': 'S2', 'spectralCount:count': 2},
+      None,
+      {'proteinId': 'P2', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 3},
+    ]))
+    store.updateProteinAbundances(datapackage=None, datasetId='ds', block_size=1)
+    updates = []
+    for name, request in store.getStore().requests:
+        if name == 'bulk':
+            actions = request['actions']
+            updates.extend((meta['update']['_id'], body['script']['params']['abundance']) for meta, body in zip(actions[::2], actions[1::2]))
+    # One bulk request per block of samples
+    assert [sorted(abundance) for guid, abundance in updates] == [['S1'], ['S1'], ['S2']]
+    assert dict((guid, abundance['S1']['relativeAbundance']) for guid, abundance in updates[:2]) == {'guid-P1': 0.25, 'guid-P2': 0.75}
+
+def test_sample_abundance_matches_direct_nsaf():
+    import random
+    from oceanproteinportal.abundance import SampleAbundance, proteinLengths
+
+    generator = random.Random(3)
+    lengths = proteinLengths([('P%s' % (protein), 'mk\nt' * (protein + 1) + '*') for protein in range(30)])
+    assert lengths['P0'] == 3 and lengths['P2'] == 9
+    # P30 has no sequence: it counts in the relative abundance but not the NSAF
+    rows = [
+      ('P%s' % (generator.randrange(31)), 'S%s' % (generator.randrange(7)), generator.randrange(1, 20))
+      for _ in range(400)
+    ]
+
+    abundance = SampleAbundance(lengths)
+    for row in rows:
+        abundance.add(*row)
+    abundance.add(None, 'S0', 1)
+    abundance.add('P0', 'S0', None)
+    assert len(abundance) == 7
+
+    counts = {}
+    for proteinId, sampleId, count in rows:
+        counts[(proteinId, sampleId)] = counts.get((proteinId, sampleId), 0) + count
+    found = {}
+    blocks = list(abundance.blocks(block_size=3))
+    assert [len(block.sampleIds()) for block in blocks] == [3, 3, 1]
+    for block in blocks:
+        for row in rows:
+            block.add(*row)
+        for proteinId, values in block.abundances():
+            for sampleId, value in values.items():
+                assert (proteinId, sampleId) not in found
+                found[(proteinId, sampleId)] = value
+    assert sorted(found) == sorted(counts)
+
+    for (proteinId, sampleId), value in found.items():
+        total = sum(count for (protein, sample), count in counts.items() if sample == sampleId)
+        weighted = sum(count / lengths[protein] for (protein, sample), count in counts.items() if sample == sampleId and protein in lengths)
+        assert abs(value['relativeAbundance'] - counts[(proteinId, sampleId)] / total) < 1e-12
+        if proteinId in lengths:
+            assert abs(value['nsaf'] - counts[(proteinId, sampleId)] / lengths[proteinId] / weighted) < 1e-12
+        else:
+            assert value['nsaf'] is None
+    for sampleId in ('S0', 'S3'):
+        assert abs(sum(value['nsaf'] or 0 for (protein, sample), value in found.items() if sample == sampleId) - 1.0) < 1e-9
+
+def test_station_tiles_group_stations_by_geohash():
+    from oceanproteinportal.tiles import Bitmap, StationTiles, geohash, tileGuid, tileRow
+
+    assert geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    assert geohash(42.6, -5.6, 5) == 'ezs42'
+    assert geohash(-90.0, -180.0, 2) == '00' and geohash(90.0, 180.0, 2) == 'zz'
+
+    bitmap = Bitmap()
+    for number in (0, 7, 8, 100, 7):
+        bitmap.add(number)
+    other = Bitmap()
+    other.add(3)
+    other.add(100)
+    bitmap.union(other)
+    assert len(bitmap) == 5 and len(Bitmap()) == 0
+
+    tiles = StationTiles(precisions=(1, 5))
+    rows = [
+      ('C1', 'st1', '42.6', '-5.6', 'S1', 'P1', 2),
+      ('C1', 'st1', '42.6', '-5.6', 'S1', 'P2', 1),
+      ('C1', 'st2', '42.61', '-5.59', 'S2', 'P1', 4),
+      ('C2', 'st9', '-30.0', '150.0', 'S3', 'P3', 1),
+      ('C2', 'st10', None, '150.0', 'S4', 'P4', 8),
+    ]
+    for cruise, station, lat, lon, sampleId, proteinId, count in rows:
+        tileRow(tiles, {
+          'spectralCount:cruise': cruise, 'spectralCount:station': station,
+          'spectralCount:coordinate:lat': lat, 'spectralCount:coordinate:lon': lon,
+          'spectralCount:sampleId': sampleId, 'proteinId': proteinId, 'spectralCount:count': count
+        })
+    assert len(tiles) == 3
+
+    documents = dict(((document['precision'], document['geohash']), document) for document in tiles.documents('ds'))
+    assert sorted(documents) == [(1, 'e'), (1, 'r'), (5, 'ezs42'), (5, 'r6dtm')]
+    tile = documents[(5, 'ezs42')]
+    assert tile['stations'] == ['st1', 'st2'] and tile['cruiseIds'] == ['C1']
+    assert (tile['samples'], tile['proteins'], tile['totalSpectralCount']) == (2, 2, 7.0)
+    assert abs(tile['location']['lat'] - 42.605) < 1e-9 and abs(tile['location']['lon'] + 5.595) < 1e-9
+    assert tile['guid'] == tileGuid('ds', 5, 'ezs42') != tileGuid('ds', 1, 'e')
+    # Every precision covers every station
+    for precision in (1, 5):
+        assert sum(document['totalSpectralCount'] for (level, cell), document in documents.items() if level == precision) == 8.0
+
+    # Rows without a cruise or station are stations of their own coordinates
+    tiles = StationTiles(precisions=(5,))
+    tiles.add(None, None, 42.6, -5.6, 'S1', 'P1', 1)
+    tiles.add(None, None, '42.6', '-5.6', 'S2', 'P2', 1)
+    tiles.add(None, None, -30.0, 150.0, 'S3', 'P3', 1)
+    tiles.add('C1', None, -30.0, 150.0, 'S4', 'P4', 1)
+    assert len(tiles) == 3
+    documents = dict((document['geohash'], document) for document in tiles.documents('ds'))
+    assert sorted(documents) == ['ezs42', 'r6dtm']
+    assert (documents['ezs42']['samples'], documents['ezs42']['stations'], documents['ezs42']['cruiseIds']) == (2, [], [])
+    assert documents['r6dtm']['cruiseIds'] == ['C1']
+
+def test_tiles_skip_rows_the_protein_load_quarantined(monkeypatch):
+    from oceanproteinportal import datapackage
+    from oceanproteinportal.store import elasticsearch
+
+    store = elastic_store(monkeypatch)
+    monkeypatch.setattr(datapackage, 'findResource', lambda datapackage, resource_type: resource_type)
+    monkeypatch.setattr(elasticsearch, 'iterResourceRows', strict_resource_rows([
+      None,
+      {'proteinId': 'P1', 'spectralCount:sampleId': 'S1', 'spectralCount:count': 2, 'spectralCount:coordinate:lat': 42.6, 'spectralCount:coordinate:lon': -5.6},
+    ]))
+    store.updateDatasetTiles(datapackage=None, datasetId='ds', precisions=(5,))
+    tiles = bulk_sources(store.getStore(), 'tile')
+    assert [(tile['geohash'], tile['totalSpectralCount']) for tile in tiles] == [('ezs42', 2.0)]
+
+def test_rate_limit_filter_and_counters(monkeypatch, caplog):
+    import logging
+    from oceanproteinportal import logs
+
+    now = [1000.0]
+    monkeypatch.setattr(logs.time, 'time', lambda: now[0])
+
+    def record(line, level=logging.INFO):
+        return logging.LogRecord('opp', level, 'loader.py', line, 'row %s', (line,), None)
+
+    rate_filter = logs.RateLimitFilter(limit=2, interval=10.0)
+    assert [rate_filter.filter(record(1)) for _ in range(5)] == [True, True, False, False, False]
+    # Other call sites and errors are not limited
+    assert rate_filter.filter(record(2))
+    assert all(rate_filter.filter(record(1, logging.ERROR)) for _ in range(5))
+    now[0] += 10.0
+    passed = record(1)
+    assert rate_filter.filter(passed)
+    assert passed.getMessage() == 'row 1 [3 similar messages suppressed]'
+    assert logs.RateLimitFilter(limit=0).filter(record(1))
+
+    caplog.set_level(logging.INFO)
+    with logs.Counters('peptides', interval=30.0) as counters:
+        counters.add('created')
+        counters.add('created', 4)
+        assert caplog.messages == []
+        now[0] += 30.0
+        counters.add('updated')
+        assert caplog.messages == ["peptides: {'created': 5, 'updated': 1}"]
+        assert (counters.get('created'), counters.get('missing')) == (5, 0)
+    assert caplog.messages[-1] == "peptides: {'created': 5, 'updated': 1}" and len(caplog.messages) == 2
+
+def test_setup_logging_writes_through_the_queue(tmp_path):
+    import logging
+    from oceanproteinportal import logs
+
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    log_file = tmp_path / 'ingest.log'
+    try:
+        logs.setupLogging(level=logging.INFO, log_file=str(log_file), rate_limit=3, rate_interval=60.0)
+        assert [handler.__class__.__name__ for handler in root.handlers] == ['QueueHandler']
+        for row in range(10):
+            logging.info('loaded row %s', row)
+        logging.error('failed')
+        logs.stopLogging()
+        lines = log_file.read_text().splitlines()
+        assert [line.split('] ', 1)[1] for line in lines] == ['loaded row 0', 'loaded row 1', 'loaded row 2', 'failed']
+        assert lines[0].split(' [')[1].startswith('INFO')
+    finally:
+        logs.stopLogging()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved[0]:
+            root.addHandler(handler)
+        root.setLevel(saved[1])
+
+def test_kmer_index_search_matches_a_scan(tmp_path):
+    import random
+    from oceanproteinportal import fasta, kmers
+
+    generator = random.Random(11)
+    proteins = [('P%s' % (index), ''.join(generator.choice('ACDEFGHIK') for _ in range(generator.randrange(1, 80)))) for index in range(200)]
+    proteins.append(('PX', 'mk t\nay*'))
+    builder = kmers.KmerBuilder()
+    for proteinId, sequence in proteins:
+        builder.add(proteinId, sequence)
+    builder.add('P0', 'WWWWW')
+    assert len(builder) == 201
+
+    assert kmers.decodeKmer(kmers.kmerCode('MKTAY')) == 'MKTAY'
+    assert kmers.kmerCode('MK1') is None
+    assert kmers.kmerCodes('ABCXAB', 2) == set(kmers.kmerCode(kmer) for kmer in ('AB', 'BC', 'CX', 'XA'))
+    assert kmers.kmerCodes('AB-CD', 3) == set()
+    assert kmers.queryKmers('ACDEFG') == ['ACDEF', 'CDEFG'] and kmers.queryKmers('AC') == []
+    assert list(kmers.decodePostings(kmers.encodePostings([0, 5, 200, 70000, 70001]))) == [0, 5, 200, 70000, 70001]
+    assert kmers.intersect([[1, 2, 3, 9], [2, 9], [0, 2, 9, 10]]) == [2, 9] and kmers.intersect([]) == []
+
+    index_file = str(tmp_path / 'kmers.idx')
+    assert builder.write(index_file) == builder.kmers()
+    index = kmers.KmerIndex(index_file)
+    try:
+        assert len(index) == 201 and index.lengths() == (3, 4, 5)
+        assert index.residues(200) == 'MKTAY' and index.proteinId(200) == 'PX'
+        motifs = ['A', 'DE', 'CDE', 'ACDE', 'GHIKA', 'ACDEFG', 'KKKKKKK', 'mkta', 'W', 'KAYM', '']
+        motifs.extend(sequence[offset:offset + 7] for proteinId, sequence in generator.sample(proteins, 20) for offset in (0, 3))
+        for motif in motifs:
+            cleaned = motif.upper()
+            expected = [proteinId for proteinId, sequence in proteins if cleaned and cleaned in fasta.cleanSequence(sequence)]
+            assert index.search(motif) == expected, motif
+    finally:
+        index.close()
+
+    documents = list(builder.documents('ds', table_size=64))
+    tables = [document for document in documents if document['kind'] == 'proteins']
+    assert [(table['offset'], table['count']) for table in tables] == [(0, 64), (64, 64), (128, 64), (192, 9)]
+    assert [proteinId for table in tables for proteinId in table['proteinIds']][:3] == ['P0', 'P1', 'P2']
+    postings = dict((document['kmer'], document) for document in documents if document['kind'] == 'kmer')
+    assert len(postings) == builder.kmers()
+    assert list(kmers.decodePostings(postings['MKT']['postings'])) == [200]
+    assert postings['MKT']['guid'] == kmers.kmerGuid('ds', 'MKT')
+
+    (tmp_path / 'bad.idx').write_bytes(b'\0' * 64)
+    try:
+        kmers.KmerIndex(str(tmp_path / 'bad.idx'))
+        assert False, 'opened a file that is not an index'
+    except Exception as error:
+        assert 'Not a k-mer index' in str(error)